@@ -85,7 +85,18 @@ class _BaseCheck(object):
                                            "the target "
                                            "interface" % (n_name, n_id))
                             continue
-                        peer_if_conf = network["nodes"][n_id][peer_if]
+                        peer = network["nodes"][n_id]
+                        try:
+                            peer_if_numbers = peer.as_int("if_numbers")
+                        except (KeyError, ValueError):
+                            # reported by the check of the peer node
+                            continue
+                        if int(if_num) >= peer_if_numbers:
+                            self.add_error("%s: peer node %s has only %d "
+                                           "interfaces" % (n_name, n_id,
+                                                           peer_if_numbers))
+                            continue
+                        peer_if_conf = peer[peer_if]
                         if peer_if_conf != "%s.%d" % (n_name, if_id):
                             self.add_error("%s: peer node %s does not have "
                                            "the right config for the target "
@@ -34,6 +34,10 @@ class CommonCheck(_BaseCheck):
         for key in ("image_dir", "config_dir"):
             if key not in network["config"]:
                 self.add_error("key %s is mandatory in the config part" % key)
+        self.check_args("config", network["config"], {
+            "lazy": {"type": "bool", "mandatory": False},
+            "idle_timeout": {"type": "int", "mandatory": False},
+        })
 
         # check nodes
         for n_name in network["nodes"]:
@@ -144,6 +144,9 @@ class NetemConsole(Cmd):
             elif attrs["state"] == "loaded" and self.spinner is not None:
                 self.spinner.stop()
                 self.spinner = None
+            elif attrs["state"] == "progress" and self.spinner is not None:
+                self.spinner.set_progress(
+                    "(%d/%d) " % (attrs["done"], attrs["total"]))
         elif sig["name"] == "watch":
             attrs = sig["attrs"]
             if attrs["state"] == "error":
@@ -286,6 +289,12 @@ class NetemConsole(Cmd):
         self.pinfo("Reload the project, please wait ... ")
         self.__send_cmd("reload")
 
+    @netmem_cmd(catch_error=False)
+    def do_update(self):
+        """Apply the changes of the topology, only modified nodes restart"""
+        self.pinfo("Update the project, please wait ... ")
+        self.__send_cmd("update")
+
     @netmem_cmd()
     def do_edit(self):
         """Edit the topology"""
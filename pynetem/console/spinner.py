@@ -29,6 +29,7 @@ class Spinner(object):
         self.delay = delay
         self.text = text
         self.color = color
+        self.progress = ""
         # start the thread
         self.busy = True
         self.thread = threading.Thread(target=self.spinner_task)
@@ -40,17 +41,21 @@ class Spinner(object):
     def spinner_task(self):
         sys.stdout.write(self.color+self.text+DEFAULT)
         while self.busy:
-            sys.stdout.write(next(self.spinner_generator))
+            progress = self.progress
+            sys.stdout.write(progress+next(self.spinner_generator))
             sys.stdout.flush()
             time.sleep(self.delay)
-            sys.stdout.write('\b')
+            sys.stdout.write('\b' * (len(progress)+1))
             sys.stdout.flush()
 
+    def set_progress(self, progress):
+        self.progress = progress
+
     def __stop(self, msg):
         if self.busy:
             self.busy = False
             self.thread.join()
-            sys.stdout.write(msg)
+            sys.stdout.write(self.progress+msg)
 
     def stop(self):
         self.__stop(GREEN+'OK\n'+DEFAULT)
@@ -16,10 +16,13 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import re
+import os
 import socket
 import logging
+import threading
 from pynetem import NetemError
-from pynetem.daemon.server import CMD_LIST
+from pynetem.daemon.server import CMD_LIST, JSON_CMD_LIST
+from pynetem.daemon.protocol import read_msg, build_request
 
 
 def build_cmd_func(cmd, nb_args):
@@ -28,23 +31,132 @@ def build_cmd_func(cmd, nb_args):
         if len(args) != nb_args:
             raise NetemError("Wrong number of arguments for cmd %s" % cmd)
 
-        cmd_line = "%s %s" % (cmd, " ".join(args))
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        try:
-            sock.connect(self.socket_path)
-        except socket.error as err:
-            raise NetemError("Unable to connect to daemon: %s" % err)
+        transaction = self.current_transaction()
+        if transaction is not None:
+            # the command is sent later within a batch
+            transaction.add(cmd, args)
+            return None
 
-        sock.sendall(cmd_line.encode("utf-8"))
-        ans = sock.recv(1024).decode("utf-8").strip()
-        sock.close()
-        if not ans.startswith("OK"):
-            raise NetemError("Daemon returns an error:\n\t%s" % ans)
-        return ans.replace("OK ", "")
+        ans = self.send_request(cmd, args)
+        if ans["state"] != "OK":
+            raise NetemError("Daemon returns an error:\n\t%s"
+                             % ans["content"])
+        return ans["content"]
 
     return cmd_func
 
 
+class _DaemonRequest(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.answer = None
+
+    def set_answer(self, answer):
+        self.answer = answer
+        self.event.set()
+
+
+class _DaemonTransaction(object):
+
+    def __init__(self, client, rollback):
+        self.client = client
+        self.rollback = rollback
+        self.commands = []
+        self.results = None
+        self.nested = False
+        self.callbacks = []
+
+    def add(self, cmd, args):
+        self.commands.append([cmd] + list(args))
+
+    def add_callbacks(self, on_success, on_failure):
+        self.callbacks.append((on_success, on_failure))
+
+    def __enter__(self):
+        self.nested = not self.client.begin_transaction(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.nested:
+            return False
+        self.client.end_transaction(self)
+        if exc_type is not None:
+            self.__run_callbacks(success=False)
+            return False
+        try:
+            if len(self.commands) > 0:
+                self.commit()
+        except NetemError:
+            self.__run_callbacks(success=False)
+            raise
+        self.__run_callbacks(success=True)
+        return False
+
+    def __run_callbacks(self, success):
+        for on_success, on_failure in self.callbacks:
+            callback = success and on_success or on_failure
+            if callback is not None:
+                callback()
+
+    def commit(self):
+        results = self.client.batch(self.commands, self.rollback)
+        for idx, result in enumerate(results):
+            if result["state"] != "OK":
+                raise NetemError(
+                    "Daemon returns an error for %s:\n\t%s"
+                    % (" ".join(self.commands[idx]), result["content"]))
+        if len(results) != len(self.commands):
+            raise NetemError("Batch has been interrupted by the daemon")
+        self.results = [r["content"] for r in results]
+        return self.results
+
+
+class _DaemonJob(object):
+    """
+    Command executed by the daemon in background, see
+    NetemDaemonClient.submit
+    """
+
+    def __init__(self, client, cmd, args, on_progress):
+        self.client = client
+        self.cmd = cmd
+        self.args = args
+        self.job_id = None
+        self.state = None
+        self.content = None
+        self.on_progress = on_progress
+        self.__done = threading.Event()
+
+    def set_event(self, event):
+        if event["state"] == "progress":
+            if self.on_progress is not None:
+                try:
+                    self.on_progress(self, event["content"])
+                except Exception as err:
+                    logging.error("Job progress callback fails: %s" % err)
+            return
+        self.state, self.content = event["state"], event["content"]
+        self.__done.set()
+
+    def is_done(self):
+        return self.__done.is_set()
+
+    def wait(self, timeout=None):
+        if not self.__done.wait(timeout):
+            raise NetemError("Job %s is still running" % self.cmd)
+        if self.state == "cancelled":
+            raise NetemError("Job %s has been cancelled" % self.cmd)
+        if self.state != "OK":
+            raise NetemError("Daemon returns an error:\n\t%s"
+                             % self.content)
+        return self.content
+
+    def cancel(self):
+        if not self.is_done():
+            self.client.job_cancel(str(self.job_id))
+
+
 class NetemDaemonClient(object):
     __instance = None
 
@@ -55,13 +167,175 @@ class NetemDaemonClient(object):
         return cls.__instance
 
     def __init__(self):
+        self.socket_path = None
+        self.__sock = None
+        self.__pid = None
+        self.__lock = threading.Lock()
+        self.__requests = {}
+        self.__jobs = {}
+        self.__last_id = 0
+        self.__local = threading.local()
+
         # define a method for each command
         for cmd in CMD_LIST:
             reg_exp = re.compile(CMD_LIST[cmd])
             cmd_func = build_cmd_func(cmd, reg_exp.groups)
             cmd_func.__name__ = cmd
 
+            setattr(NetemDaemonClient, cmd, cmd_func)
+        for cmd in JSON_CMD_LIST:
+            cmd_func = build_cmd_func(cmd, JSON_CMD_LIST[cmd])
+            cmd_func.__name__ = cmd
+
             setattr(NetemDaemonClient, cmd, cmd_func)
 
     def set_socket_path(self, s_path):
+        if s_path != self.socket_path:
+            self.close()
         self.socket_path = s_path
+
+    def transaction(self, rollback=True):
+        """
+        Return a context manager, all commands called in this context
+        by the current thread are sent in one batch when it exits
+        """
+        return _DaemonTransaction(self, rollback)
+
+    def current_transaction(self):
+        return getattr(self.__local, "transaction", None)
+
+    def begin_transaction(self, transaction):
+        if self.current_transaction() is not None:
+            return False
+        self.__local.transaction = transaction
+        return True
+
+    def end_transaction(self, transaction):
+        if self.current_transaction() is transaction:
+            self.__local.transaction = None
+
+    def on_commit(self, on_success=None, on_failure=None):
+        """
+        Call on_success once the commands called before by the current
+        thread have been executed, or on_failure if its transaction
+        fails. Wrappers update their state with it
+        """
+        transaction = self.current_transaction()
+        if transaction is not None:
+            transaction.add_callbacks(on_success, on_failure)
+        elif on_success is not None:
+            on_success()
+
+    def submit(self, cmd, *args, **kwargs):
+        """
+        Run a command as a daemon job and return without waiting for its
+        result. on_progress(job, content) is called from the reader thread
+        for each progress event of the job
+        """
+        logging.debug("Submit daemon job: %s -> %s" % (cmd, args))
+        job = _DaemonJob(self, cmd, args, kwargs.get("on_progress"))
+        ans = self.send_request("job_submit", [cmd, list(args)], job=job)
+        if ans["state"] != "OK":
+            raise NetemError("Daemon returns an error:\n\t%s"
+                             % ans["content"])
+        job.job_id = ans["content"]
+        return job
+
+    def send_request(self, cmd, args, job=None):
+        request = _DaemonRequest()
+        with self.__lock:
+            self.__connect()
+            self.__last_id += 1
+            req_id = self.__last_id
+            self.__requests[req_id] = request
+            if job is not None:
+                # events may arrive before the caller gets the answer
+                self.__jobs[req_id] = job
+            try:
+                self.__sock.sendall(build_request(req_id, cmd, args))
+            except socket.error as err:
+                del self.__requests[req_id]
+                self.__jobs.pop(req_id, None)
+                self.__disconnect()
+                raise NetemError("Unable to send command to daemon: %s" % err)
+
+        request.event.wait()
+        if request.answer is None:
+            raise NetemError("Connection with the daemon has been lost")
+        return request.answer
+
+    def close(self):
+        with self.__lock:
+            if self.__sock is not None and self.__pid == os.getpid():
+                try:
+                    self.__sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+            self.__disconnect()
+
+    def __connect(self):
+        # the connection is not shared with a forked process
+        if self.__sock is not None and self.__pid != os.getpid():
+            self.__sock.close()
+            self.__sock, self.__requests, self.__jobs = None, {}, {}
+        if self.__sock is not None:
+            return
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except (socket.error, TypeError) as err:
+            sock.close()
+            raise NetemError("Unable to connect to daemon: %s" % err)
+        self.__sock, self.__pid = sock, os.getpid()
+        reader = threading.Thread(target=self.__read_answers, args=(sock,))
+        reader.daemon = True
+        reader.start()
+
+    def __disconnect(self):
+        sock, self.__sock = self.__sock, None
+        if sock is not None:
+            sock.close()
+        requests, self.__requests = self.__requests, {}
+        for request in requests.values():
+            request.set_answer(None)
+        jobs, self.__jobs = self.__jobs, {}
+        for job in jobs.values():
+            job.set_event({
+                "state": "error",
+                "content": "Connection with the daemon has been lost"
+            })
+
+    def __read_answers(self, sock):
+        with sock.makefile("rb") as r_file:
+            while True:
+                try:
+                    answer = read_msg(r_file)
+                except (NetemError, OSError, ValueError) as err:
+                    logging.error("Unable to read daemon answer: %s" % err)
+                    answer = None
+                if answer is None:
+                    break
+                if "event" in answer:
+                    self.__dispatch_event(answer)
+                    continue
+                with self.__lock:
+                    request = self.__requests.pop(answer["id"], None)
+                    if request is not None and answer["state"] != "OK":
+                        self.__jobs.pop(answer["id"], None)
+                if request is not None:
+                    request.set_answer(answer)
+
+        logging.debug("Connection with the daemon is closed")
+        with self.__lock:
+            if self.__sock is sock:
+                self.__disconnect()
+
+    def __dispatch_event(self, event):
+        with self.__lock:
+            if event["state"] == "progress":
+                job = self.__jobs.get(event["id"])
+            else:
+                job = self.__jobs.pop(event["id"], None)
+        if job is not None:
+            job.set_event(event)
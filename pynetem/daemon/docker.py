@@ -0,0 +1,508 @@
+# pynetem: network emulator
+# Copyright (C) 2015-2021 Mickael Royer <mickael.royer@recherche.enac.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import io
+import os
+import re
+import shlex
+import tarfile
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import docker
+from docker.utils import kwargs_from_env, parse_repository_tag
+from pynetem import NetemError
+from pynetem.ui.config import NetemConfig
+from pynetem.daemon.jobs import JobCancelled, check_cancelled
+from pynetem.daemon.jobs import report_progress
+
+# container path in docker cp format, <container>:<path>
+CONTAINER_PATH = re.compile(r"^([^:/]+):(.+)$")
+
+# marker written after each command of a script with its exit code
+SCRIPT_MARKER = "@@pynetem-script@@"
+SCRIPT_RESULT = re.compile(r"\n%s ([0-9]+) ([0-9]+)\n" % SCRIPT_MARKER)
+
+
+def split_container_path(path):
+    match_obj = CONTAINER_PATH.match(path)
+    if match_obj is None:
+        return None, path
+    return match_obj.groups()
+
+
+def check_script_results(c_name, commands, results, stop_on_error):
+    """
+    Raise an error if a script has been interrupted: every command has
+    a result, or with stop_on_error the last result is a failure
+    """
+    if len(results) == len(commands):
+        return
+    if stop_on_error and len(results) > 0 and results[-1]["code"] != 0:
+        return
+    raise NetemError("%s: script interrupted after %d of %d commands"
+                     % (c_name, len(results), len(commands)))
+
+
+def extract_member(tar, member, target_dir):
+    """
+    Extract a file or a directory of a container archive in target_dir.
+    Existing symlinks are never followed and extracted files belong to
+    the daemon user, as with docker cp
+    """
+    path = target_dir
+    for part in [p for p in member.name.split("/") if p not in ("", ".")]:
+        if os.path.islink(path) and path != target_dir:
+            raise NetemError("Unable to extract %s: %s is a symlink"
+                             % (member.name, path))
+        path = os.path.join(path, part)
+    if os.path.islink(path):
+        os.unlink(path)
+
+    mode = member.mode & 0o777
+    if member.isdir():
+        if not os.path.isdir(path):
+            os.mkdir(path, mode)
+        return
+    src = tar.extractfile(member)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW,
+                 mode)
+    with os.fdopen(fd, "wb") as dst:
+        dst.write(src.read())
+
+
+class DockerInventory(object):
+    """
+    In-memory list of the docker containers and images. The inventory
+    is loaded once then kept up to date with the docker events stream
+    """
+    RETRY_DELAY = 2
+
+    def __init__(self, api, events_api):
+        self.api = api
+        self.events_api = events_api
+        self.synced = False
+        self.__containers = {}
+        self.__images = set()
+        self.__lock = threading.Lock()
+        self.__stream = None
+        self.__running = False
+        self.__thread = None
+
+    def start(self):
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__follow_events)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        self.__running = False
+        stream = self.__stream
+        if stream is not None and hasattr(stream, "close"):
+            stream.close()
+
+    def container_exists(self, c_name):
+        with self.__lock:
+            return c_name in self.__containers
+
+    def get_container_names(self, prefix=""):
+        with self.__lock:
+            return [n for n in self.__containers if n.startswith(prefix)]
+
+    def image_present(self, image_name):
+        with self.__lock:
+            return image_name in self.__images
+
+    def add_container(self, c_name, c_id=None):
+        with self.__lock:
+            self.__containers[c_name] = c_id
+
+    def remove_container(self, c_name, c_id=None):
+        # with c_id, the entry is kept if the name has been reused by a
+        # new container, the late destroy event of the old one is ignored
+        with self.__lock:
+            if c_id is None or self.__containers.get(c_name) == c_id:
+                self.__containers.pop(c_name, None)
+
+    def add_image(self, image_name):
+        with self.__lock:
+            self.__images.add(image_name)
+
+    def sync(self):
+        containers = {}
+        for container in self.api.containers(all=True):
+            for name in container["Names"]:
+                containers[name.lstrip("/")] = container["Id"]
+        with self.__lock:
+            self.__containers = containers
+        self.sync_images()
+
+    def sync_images(self):
+        images = set()
+        for image in self.api.images():
+            images.update(image.get("RepoTags") or [])
+        with self.__lock:
+            self.__images = images
+
+    def __follow_events(self):
+        while self.__running:
+            # events are replayed since the last sync so that nothing
+            # happening between the sync and the subscription is lost
+            since = int(time.time())
+            try:
+                self.sync()
+                self.__stream = self.events_api.events(
+                    since=since, decode=True,
+                    filters={"type": ["container", "image"]})
+                self.synced = True
+                logging.debug("Docker inventory is synchronized")
+                for event in self.__stream:
+                    self.__handle_event(event)
+            except Exception as err:
+                logging.warning("Docker events stream error: %s" % err)
+            self.synced, self.__stream = False, None
+            if self.__running:
+                time.sleep(self.RETRY_DELAY)
+
+    def __handle_event(self, event):
+        e_type, action = event.get("Type"), event.get("Action", "")
+        actor = event.get("Actor", {})
+        attributes = actor.get("Attributes", {})
+        if e_type == "container":
+            name = attributes.get("name")
+            if name is None:
+                return
+            if action == "create":
+                self.add_container(name, actor.get("ID"))
+            elif action == "destroy":
+                self.remove_container(name, actor.get("ID"))
+            elif action == "rename":
+                old_name = attributes.get("oldName", "")
+                self.remove_container(old_name.lstrip("/"), actor.get("ID"))
+                self.add_container(name, actor.get("ID"))
+        elif e_type == "image":
+            if action == "pull":
+                self.add_image(actor.get("ID"))
+            elif action == "tag":
+                self.add_image(attributes.get("name"))
+            elif action in ("untag", "delete", "import", "load"):
+                # these events do not give the concerned tags
+                self.sync_images()
+
+
+class DockerManager(object):
+    """
+    Wrapper around docker.APIClient used by the daemon. All the threads
+    of the daemon share the same client and its pool of connections
+    with the docker engine
+    """
+    __instance = None
+    __instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        with cls.__instance_lock:
+            if cls.__instance is None:
+                pool_size = NetemConfig.instance().getint(
+                    "daemon", "docker_connections")
+                cls.__instance = cls(pool_size)
+        return cls.__instance
+
+    def __init__(self, pool_size):
+        self.pool_size = pool_size
+        kwargs = kwargs_from_env()
+        kwargs["version"] = "auto"
+        try:
+            try:
+                self.api = docker.APIClient(max_pool_size=pool_size, **kwargs)
+            except TypeError:
+                # old docker SDK without max_pool_size argument
+                self.api = docker.APIClient(**kwargs)
+            # the events stream keeps its connection busy, use another client
+            events_api = docker.APIClient(**kwargs)
+        except docker.errors.DockerException as err:
+            raise NetemError("Unable to connect to docker engine: %s" % err)
+        self.inventory = DockerInventory(self.api, events_api)
+        self.inventory.start()
+
+    def request(self, method, *args, **kwargs):
+        try:
+            return getattr(self.api, method)(*args, **kwargs)
+        except docker.errors.APIError as err:
+            raise NetemError("Docker %s error: %s" % (method, err.explanation))
+        except docker.errors.DockerException as err:
+            raise NetemError("Docker %s error: %s" % (method, err))
+
+    def close(self):
+        self.inventory.stop()
+        self.api.close()
+
+    def get_container_names(self, prefix=""):
+        if self.inventory.synced:
+            return self.inventory.get_container_names(prefix)
+        containers = self.request("containers", all=True)
+        names = []
+        for container in containers:
+            names.extend([n.lstrip("/") for n in container["Names"]])
+        return [n for n in names if n.startswith(prefix)]
+
+    def container_exists(self, c_name):
+        if self.inventory.synced:
+            return self.inventory.container_exists(c_name)
+        try:
+            self.api.inspect_container(c_name)
+        except docker.errors.NotFound:
+            return False
+        except docker.errors.APIError as err:
+            raise NetemError("Docker inspect error: %s" % err.explanation)
+        return True
+
+    def create(self, name, c_name, image, ipv6=False):
+        sysctls = None
+        if ipv6:
+            sysctls = {"net.ipv6.conf.all.disable_ipv6": "0"}
+        host_config = self.api.create_host_config(
+            privileged=True, cap_add=["ALL"],
+            network_mode="none", sysctls=sysctls)
+        container = self.request(
+            "create_container", image, name=c_name,
+            hostname=name, host_config=host_config)
+        self.inventory.add_container(c_name, container["Id"])
+
+    def start(self, c_name):
+        self.request("start", c_name)
+
+    def stop(self, c_name, timeout=2):
+        if not self.container_exists(c_name):
+            return False
+        try:
+            self.api.stop(c_name, timeout=timeout)
+        except docker.errors.NotFound:
+            return False
+        except docker.errors.APIError as err:
+            raise NetemError("Docker stop error: %s" % err.explanation)
+        return True
+
+    def remove(self, c_name, force=False):
+        if not self.container_exists(c_name):
+            return False
+        try:
+            self.api.remove_container(c_name, force=force)
+        except docker.errors.NotFound:
+            self.inventory.remove_container(c_name)
+            return False
+        except docker.errors.APIError as err:
+            raise NetemError("Docker remove error: %s" % err.explanation)
+        self.inventory.remove_container(c_name)
+        return True
+
+    def remove_all(self, c_names):
+        """
+        Kill and remove containers concurrently, return the list of errors
+        """
+        if len(c_names) == 0:
+            return []
+        errors = []
+        workers = min(len(c_names), self.pool_size)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self.remove, c, force=True)
+                       for c in c_names]
+            for idx, (c_name, future) in enumerate(zip(c_names, futures)):
+                try:
+                    future.result()
+                except NetemError as err:
+                    errors.append("%s: %s" % (c_name, err))
+                report_progress("%d/%d containers removed"
+                                % (idx + 1, len(c_names)))
+                try:
+                    check_cancelled()
+                except JobCancelled:
+                    for pending in futures:
+                        pending.cancel()
+                    raise
+        return errors
+
+    def pid(self, c_name):
+        infos = self.request("inspect_container", c_name)
+        return infos["State"]["Pid"]
+
+    def exec_run(self, c_name, cmd_line):
+        cmd = cmd_line
+        if not isinstance(cmd_line, list):
+            cmd = shlex.split(cmd_line)
+        exec_id = self.request("exec_create", c_name, cmd)["Id"]
+        output = self.request("exec_start", exec_id)
+        exit_code = self.request("exec_inspect", exec_id)["ExitCode"]
+        return exit_code, output.decode("utf-8", "replace")
+
+    def exec_script(self, c_name, commands, stop_on_error=True):
+        """
+        Run a list of shell commands in one exec session, return for
+        each executed command its exit code and its output
+        """
+        script = []
+        for idx, command in enumerate(commands):
+            script.append("(%s) 2>&1" % command)
+            script.append("ret=$?")
+            script.append("printf '\\n%s %d %%d\\n' $ret"
+                          % (SCRIPT_MARKER, idx))
+            if stop_on_error:
+                script.append("[ $ret -eq 0 ] || exit 0")
+        # the script always exits with 0, even when it stops on error
+        exit_code, output = self.exec_run(
+            c_name, ["sh", "-c", "\n".join(script)])
+        if exit_code != 0:
+            raise NetemError("%s: script exec fails (%s): %s"
+                             % (c_name, exit_code, output.strip()))
+
+        results, start = [], 0
+        for match_obj in SCRIPT_RESULT.finditer(output):
+            idx, code = [int(g) for g in match_obj.groups()]
+            if idx != len(results):
+                raise NetemError("%s: unexpected result for command %d "
+                                 "of the script" % (c_name, idx))
+            results.append({
+                "cmd": commands[idx],
+                "code": code,
+                "output": output[start:match_obj.start()].strip("\n"),
+            })
+            start = match_obj.end()
+        check_script_results(c_name, commands, results, stop_on_error)
+        return results
+
+    def copy(self, source, dest):
+        s_container, s_path = split_container_path(source)
+        d_container, d_path = split_container_path(dest)
+        if s_container is not None and d_container is None:
+            self.get_file(s_container, s_path, d_path)
+        elif s_container is None and d_container is not None:
+            self.put_file(s_path, d_container, d_path)
+        else:
+            raise NetemError("copy between %s and %s is not "
+                             "supported" % (source, dest))
+
+    def get_file(self, c_name, c_path, host_path):
+        try:
+            stream, _ = self.api.get_archive(c_name, c_path)
+            data = io.BytesIO(b"".join(stream))
+        except docker.errors.DockerException as err:
+            raise NetemError("Unable to get %s:%s: %s" % (c_name, c_path, err))
+        if os.path.isdir(host_path):
+            target_dir, target_name = host_path, None
+        else:
+            target_dir = os.path.dirname(host_path) or "."
+            target_name = os.path.basename(host_path)
+        with tarfile.open(fileobj=data) as tar:
+            members = tar.getmembers()
+            root_name = os.path.basename(c_path.rstrip("/"))
+            for member in members:
+                parts = member.name.split("/")
+                if member.name.startswith("/") or ".." in parts:
+                    raise NetemError("Unsafe path %s in archive" % member.name)
+                # only regular files and directories are copied, links
+                # could make the daemon write outside of the target
+                if not member.isfile() and not member.isdir():
+                    raise NetemError("Unsupported member %s in archive, "
+                                     "only files and directories can be "
+                                     "copied" % member.name)
+                if target_name is not None:
+                    member.name = target_name + member.name[len(root_name):]
+            try:
+                for member in members:
+                    extract_member(tar, member, target_dir)
+            except OSError as err:
+                raise NetemError("Unable to extract %s:%s in %s: %s"
+                                 % (c_name, c_path, host_path, err))
+
+    def put_file(self, host_path, c_name, c_path):
+        if not os.path.exists(host_path):
+            raise NetemError("Path %s does not exist" % host_path)
+        # first, consider that the destination is a directory
+        try:
+            self.api.put_archive(
+                c_name, c_path,
+                self.__build_archive(host_path, os.path.basename(host_path)))
+            return
+        except docker.errors.APIError as err:
+            logging.debug("Docker put %s in %s:%s fails (%s), consider "
+                          "it as a file" % (host_path, c_name, c_path, err))
+        self.request(
+            "put_archive", c_name, os.path.dirname(c_path) or "/",
+            self.__build_archive(host_path, os.path.basename(c_path)))
+
+    def put_files(self, c_name, files):
+        """
+        Copy a list of (host_path, container_path) in the container
+        with one archive
+        """
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode="w") as tar:
+            for host_path, c_path in files:
+                if not os.path.exists(host_path):
+                    raise NetemError("Path %s does not exist" % host_path)
+                if os.path.islink(host_path):
+                    raise NetemError("Path %s is a symlink" % host_path)
+                tar.add(host_path, arcname=c_path.lstrip("/"),
+                        filter=self.__root_owner)
+        self.request("put_archive", c_name, "/", data.getvalue())
+
+    def get_files(self, c_name, files):
+        """
+        Copy a list of (container_path, host_path) from the container
+        """
+        for c_path, host_path in files:
+            self.get_file(c_name, c_path, host_path)
+
+    def image_present(self, image_name):
+        if self.inventory.synced:
+            return self.inventory.image_present(image_name)
+        for image in self.request("images"):
+            if image_name in (image.get("RepoTags") or []):
+                return True
+        return False
+
+    def pull(self, image_name):
+        repository, tag = parse_repository_tag(image_name)
+        try:
+            for event in self.api.pull(
+                    repository, tag=tag or "latest", stream=True, decode=True):
+                if "error" in event:
+                    raise NetemError("Unable to pull %s image: "
+                                     "%s" % (image_name, event["error"]))
+                check_cancelled()
+                # skip the download/extract progress bars
+                if "status" in event and not event.get("progressDetail"):
+                    report_progress(" ".join(
+                        [event.get("id", ""), event["status"]]).strip())
+        except docker.errors.DockerException as err:
+            raise NetemError("Unable to pull %s image: %s" % (image_name, err))
+        self.inventory.add_image(image_name)
+
+    @classmethod
+    def __build_archive(cls, host_path, arcname):
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode="w") as tar:
+            tar.add(host_path, arcname=arcname, filter=cls.__root_owner)
+        return data.getvalue()
+
+    @staticmethod
+    def __root_owner(tarinfo):
+        # like docker cp, copied files belong to root in the container
+        tarinfo.uid, tarinfo.gid = 0, 0
+        tarinfo.uname, tarinfo.gname = "root", "root"
+        return tarinfo
@@ -0,0 +1,94 @@
+# pynetem: network emulator
+# Copyright (C) 2015-2021 Mickael Royer <mickael.royer@recherche.enac.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import threading
+from contextlib import contextmanager
+from pynetem import NetemError
+
+_local = threading.local()
+
+
+class JobCancelled(NetemError):
+    pass
+
+
+def current_job():
+    return getattr(_local, "job", None)
+
+
+def report_progress(content):
+    """Send a progress event if the current command runs as a job"""
+    job = current_job()
+    if job is not None:
+        job.send_event("progress", content)
+
+
+def check_cancelled():
+    """Stop the current command if its job has been cancelled"""
+    job = current_job()
+    if job is not None and job.cancelled.is_set():
+        raise JobCancelled("Job %d has been cancelled" % job.job_id)
+
+
+@contextmanager
+def job_context(job):
+    parent, _local.job = current_job(), job
+    try:
+        yield job
+    finally:
+        _local.job = parent
+
+
+class DaemonJob(object):
+
+    def __init__(self, job_id, send_event):
+        self.job_id = job_id
+        self.cancelled = threading.Event()
+        self.__send_event = send_event
+
+    def send_event(self, state, content):
+        self.__send_event(state, content)
+
+
+class JobRegistry(object):
+    """
+    Jobs submitted to the daemon, a job is identified by an id
+    shared by all the sessions
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__jobs = {}
+        self.__last_id = 0
+
+    def create(self, send_event):
+        with self.__lock:
+            self.__last_id += 1
+            job = DaemonJob(self.__last_id, send_event)
+            self.__jobs[job.job_id] = job
+        return job
+
+    def remove(self, job):
+        with self.__lock:
+            self.__jobs.pop(job.job_id, None)
+
+    def cancel(self, job_id):
+        with self.__lock:
+            job = self.__jobs.get(job_id)
+        if job is None:
+            raise NetemError("Job %d does not exist" % job_id)
+        job.cancelled.set()
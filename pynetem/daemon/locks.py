@@ -0,0 +1,66 @@
+# pynetem: network emulator
+# Copyright (C) 2015-2021 Mickael Royer <mickael.royer@recherche.enac.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import threading
+from contextlib import contextmanager
+
+
+class ResourceLocks(object):
+    """
+    Serialize commands which touch the same resources (bridge, netns,
+    container...). An exclusive owner waits until no other command
+    is running and blocks new ones until it has finished.
+    """
+
+    def __init__(self):
+        self.__cond = threading.Condition()
+        self.__busy = set()
+        self.__running = 0
+        self.__exclusive = False
+        self.__exclusive_waiting = 0
+
+    def __can_acquire(self, keys):
+        return not self.__exclusive \
+            and self.__exclusive_waiting == 0 \
+            and self.__busy.isdisjoint(keys)
+
+    def __can_acquire_exclusive(self):
+        return not self.__exclusive and self.__running == 0
+
+    @contextmanager
+    def hold(self, keys, exclusive=False):
+        keys = set(keys)
+        with self.__cond:
+            if exclusive:
+                self.__exclusive_waiting += 1
+                self.__cond.wait_for(self.__can_acquire_exclusive)
+                self.__exclusive_waiting -= 1
+                self.__exclusive = True
+            else:
+                self.__cond.wait_for(lambda: self.__can_acquire(keys))
+                self.__busy |= keys
+                self.__running += 1
+        try:
+            yield
+        finally:
+            with self.__cond:
+                if exclusive:
+                    self.__exclusive = False
+                else:
+                    self.__busy -= keys
+                    self.__running -= 1
+                self.__cond.notify_all()
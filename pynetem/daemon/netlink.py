@@ -0,0 +1,467 @@
+# pynetem: network emulator
+# Copyright (C) 2015-2021 Mickael Royer <mickael.royer@recherche.enac.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import pwd
+import time
+import ctypes
+import ctypes.util
+import logging
+import threading
+from collections import deque
+from errno import ENODEV
+from pyroute2 import IPRoute, NetlinkError
+from pynetem import NetemError
+
+NETNS_DIR = "/var/run/netns"
+CLONE_NEWNET = 0x40000000
+MS_BIND = 4096
+MS_REC = 16384
+MS_SHARED = 1 << 20
+MNT_DETACH = 2
+IFF_UP = 1
+# maximum length of a file name in the netns dir
+NAME_MAX = 255
+
+_libc = None
+
+
+def get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    return _libc
+
+
+def libc_check(ret, msg):
+    if ret != 0:
+        errno = ctypes.get_errno()
+        raise NetemError("%s: %s" % (msg, os.strerror(errno)))
+
+
+def run_in_thread(func, *args):
+    """
+    Run func in a dedicated thread. Namespace syscalls (unshare/setns)
+    only change the namespace of the calling thread, so the daemon
+    threads are never moved.
+    """
+    result = {}
+
+    def target():
+        try:
+            result["value"] = func(*args)
+        except Exception as ex:
+            result["error"] = ex
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    thread.join()
+    if "error" in result:
+        raise result["error"]
+    return result.get("value")
+
+
+def is_pid(name):
+    try:
+        int(name)
+    except ValueError:
+        return False
+    return True
+
+
+def netns_path(name):
+    # names are checked as "ip netns add" does, a netns is a file
+    # of the netns dir and must not point elsewhere
+    if not name or "/" in name or name in (".", "..") \
+            or len(name) > NAME_MAX:
+        raise NetemError("%s is not a valid netns name" % name)
+    return os.path.join(NETNS_DIR, name)
+
+
+def _netns_add(path):
+    # port of "ip netns add": the new namespace is bind mounted
+    # on a file of the netns dir
+    libc = get_libc()
+    run_dir = NETNS_DIR.encode("utf-8")
+    if libc.mount(b"", run_dir, b"none", MS_SHARED | MS_REC, None) != 0:
+        libc_check(libc.mount(run_dir, run_dir, b"none",
+                              MS_BIND | MS_REC, None),
+                   "Unable to bind mount %s" % NETNS_DIR)
+        libc_check(libc.mount(b"", run_dir, b"none",
+                              MS_SHARED | MS_REC, None),
+                   "Unable to share mount %s" % NETNS_DIR)
+
+    os.close(os.open(path, os.O_RDONLY | os.O_CREAT | os.O_EXCL, 0))
+    try:
+        libc_check(libc.unshare(CLONE_NEWNET), "Unable to create netns")
+        libc_check(libc.mount(b"/proc/thread-self/ns/net",
+                              path.encode("utf-8"), b"none", MS_BIND, None),
+                   "Unable to bind netns %s" % path)
+    except NetemError:
+        os.unlink(path)
+        raise
+
+
+class VethPool(object):
+    """
+    Pool of veth pairs created in advance in the background. A link
+    creation renames a pair of the pool instead of creating it
+    """
+    # must not start like a project id, clean would remove the pool
+    PREFIX = "vethpool"
+    RETRY_DELAY = 5
+
+    def __init__(self, netlink, size):
+        self.netlink = netlink
+        self.size = size
+        self.__pairs = deque()
+        self.__cond = threading.Condition()
+        self.__counter = 0
+        self.__running = False
+        self.__thread = None
+
+    def start(self):
+        # remove pairs left by a previous daemon
+        self.netlink.links_delete(self.PREFIX)
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__refill)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        with self.__cond:
+            self.__running = False
+            self.__cond.notify_all()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        self.__pairs.clear()
+        try:
+            self.netlink.links_delete(self.PREFIX)
+        except NetemError as err:
+            logging.warning("Unable to delete the veth pool: %s" % err)
+
+    def take(self):
+        with self.__cond:
+            if len(self.__pairs) == 0:
+                return None
+            pair = self.__pairs.popleft()
+            self.__cond.notify_all()
+            return pair
+
+    def __refill(self):
+        while True:
+            with self.__cond:
+                while self.__running and len(self.__pairs) >= self.size:
+                    self.__cond.wait()
+                if not self.__running:
+                    return
+                self.__counter = (self.__counter + 1) % 100000
+                pair = ("%s%d" % (self.PREFIX, self.__counter),
+                        "%s%dp" % (self.PREFIX, self.__counter))
+            try:
+                self.netlink.request(
+                    "link", "add", ifname=pair[0], kind="veth", peer=pair[1])
+            except NetemError as err:
+                logging.warning("Unable to fill the veth pool: %s" % err)
+                time.sleep(self.RETRY_DELAY)
+                continue
+            with self.__cond:
+                self.__pairs.append(pair)
+
+
+class NetlinkManager(object):
+    """
+    Manage links, bridges and net namespaces through a single
+    netlink socket instead of forking ip/brctl commands
+    """
+    __instance = None
+    __instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        with cls.__instance_lock:
+            if cls.__instance is None:
+                cls.__instance = cls()
+        return cls.__instance
+
+    def __init__(self):
+        self.__ipr = None
+        self.__lock = threading.RLock()
+        self.__pool = None
+
+    def start_pool(self, size):
+        if size > 0 and self.__pool is None:
+            self.__pool = VethPool(self, size)
+            self.__pool.start()
+
+    def stop_pool(self):
+        if self.__pool is not None:
+            self.__pool.stop()
+            self.__pool = None
+
+    def request(self, method, *args, **kwargs):
+        with self.__lock:
+            if self.__ipr is None:
+                self.__ipr = IPRoute()
+            try:
+                return getattr(self.__ipr, method)(*args, **kwargs)
+            except NetlinkError as err:
+                raise NetemError("Netlink request %s %s failed: %s"
+                                 % (method, args, err))
+
+    def close(self):
+        with self.__lock:
+            if self.__ipr is not None:
+                self.__ipr.close()
+                self.__ipr = None
+
+    def get_index(self, name, check=True):
+        indexes = self.request("link_lookup", ifname=name)
+        if len(indexes) == 0:
+            if check:
+                raise NetemError("interface %s does not exist" % name)
+            return None
+        return indexes[0]
+
+    def get_link(self, name):
+        idx = self.get_index(name, check=False)
+        if idx is None:
+            return None
+        links = self.request("get_links", idx)
+        return len(links) > 0 and links[0] or None
+
+    def get_link_names(self):
+        return [lk.get_attr("IFLA_IFNAME") for lk in self.request("get_links")]
+
+    def get_links_info(self):
+        infos = {}
+        for link in self.request("get_links"):
+            link_info = link.get_attr("IFLA_LINKINFO")
+            infos[link.get_attr("IFLA_IFNAME")] = {
+                "index": link["index"],
+                "kind": link_info is not None
+                and link_info.get_attr("IFLA_INFO_KIND") or None,
+                "master": link.get_attr("IFLA_MASTER"),
+            }
+        return infos
+
+    def link_exists(self, name):
+        return self.get_index(name, check=False) is not None
+
+    def link_kind(self, name):
+        link = self.get_link(name)
+        if link is None:
+            return None
+        link_info = link.get_attr("IFLA_LINKINFO")
+        if link_info is None:
+            return None
+        return link_info.get_attr("IFLA_INFO_KIND")
+
+    def link_is_up(self, name):
+        link = self.get_link(name)
+        if link is None:
+            raise NetemError("interface %s does not exist" % name)
+        return link["flags"] & IFF_UP == IFF_UP
+
+    def link_set_state(self, name, state):
+        self.request("link", "set", index=self.get_index(name), state=state)
+
+    def link_delete(self, name):
+        self.request("link", "del", index=self.get_index(name))
+
+    def links_delete(self, prefix):
+        """
+        Delete all the links whose name starts with prefix with one dump
+        of the links. Return the number of deleted links
+        """
+        with self.__lock:
+            links = {}
+            for link in self.request("get_links"):
+                name = link.get_attr("IFLA_IFNAME")
+                if name is not None and name.startswith(prefix):
+                    links[link["index"]] = link
+            deleted = 0
+            for idx, link in links.items():
+                try:
+                    self.__ipr.link("del", index=idx)
+                except NetlinkError as err:
+                    # the other end of a veth is deleted with its peer,
+                    # IFLA_LINK can not tell it since the peer index may
+                    # belong to another netns
+                    if err.code != ENODEV:
+                        raise NetemError("Unable to delete link %s: "
+                                         "%s" % (link.get_attr("IFLA_IFNAME"),
+                                                 err))
+                    continue
+                deleted += 1
+            return deleted
+
+    def veth_create(self, if1, if2):
+        pair = self.__pool is not None and self.__pool.take() or None
+        if pair is not None and self.__rename_pair(pair, (if1, if2)):
+            return
+        self.request("link", "add", ifname=if1, kind="veth", peer=if2)
+
+    def __rename_pair(self, pair, names):
+        indexes = [self.get_index(n, check=False) for n in pair]
+        try:
+            if None in indexes:
+                raise NetemError("pair %s-%s has been removed" % pair)
+            for idx, name in zip(indexes, names):
+                self.request("link", "set", index=idx, ifname=name)
+        except NetemError as err:
+            logging.debug("Unable to use veth pair of the pool: %s" % err)
+            for idx in [i for i in indexes if i is not None]:
+                try:
+                    self.request("link", "del", index=idx)
+                except NetemError:
+                    pass  # already removed with its peer
+            return False
+        return True
+
+    def link_set_netns(self, name, netns):
+        idx = self.get_index(name)
+        if is_pid(netns):
+            self.request("link", "set", index=idx, net_ns_pid=int(netns))
+        else:
+            self.request("link", "set", index=idx, net_ns_fd=netns)
+
+    def link_attach(self, name, pid, target_name):
+        # move, rename and set up the link with one RTM_NEWLINK message
+        self.request("link", "set", index=self.get_index(name),
+                     net_ns_pid=int(pid), ifname=target_name, state="up")
+
+    def tap_create(self, name, user):
+        try:
+            uid = pwd.getpwnam(user).pw_uid
+        except KeyError:
+            raise NetemError("User %s does not exist" % user)
+        self.request("link", "add", ifname=name,
+                     kind="tuntap", mode="tap", uid=uid)
+        self.link_set_state(name, "up")
+
+    def is_bridge(self, name):
+        return self.link_kind(name) == "bridge"
+
+    def bridge_create(self, name):
+        self.request("link", "add", ifname=name, kind="bridge")
+        self.link_set_state(name, "up")
+
+    def bridge_addif(self, br_name, if_name):
+        self.request("link", "set", index=self.get_index(if_name),
+                     master=self.get_index(br_name), state="up")
+
+    def bridge_delif(self, br_name, if_name):
+        self.request("link", "set", index=self.get_index(if_name), master=0)
+
+    def reconcile(self, prefix, bridges, links):
+        """
+        Make the bridges and veth whose name starts with prefix match
+        bridges, a dict {bridge name: [member names]}, and links, a list
+        of veth pairs. Return the changes
+        """
+        changes = dict.fromkeys(
+            ("bridges_added", "bridges_removed", "members_added",
+             "members_removed", "links_added", "links_removed"), 0)
+        wanted_links = set([name for pair in links for name in pair])
+        with self.__lock:
+            infos = self.get_links_info()
+            for name, info in infos.items():
+                if not name.startswith(prefix):
+                    continue
+                if info["kind"] == "bridge" and name not in bridges:
+                    if self.__delete_index(info["index"]):
+                        changes["bridges_removed"] += 1
+                elif info["kind"] == "veth" and name not in wanted_links:
+                    if self.__delete_index(info["index"]):
+                        changes["links_removed"] += 1
+
+            for if1, if2 in links:
+                # the peer may have been moved in another namespace
+                if if1 not in infos:
+                    self.veth_create(if1, if2)
+                    changes["links_added"] += 1
+            for br_name in bridges:
+                if infos.get(br_name, {}).get("kind") != "bridge":
+                    self.bridge_create(br_name)
+                    changes["bridges_added"] += 1
+
+            infos = self.get_links_info()
+            for br_name, members in bridges.items():
+                br_idx = infos[br_name]["index"]
+                current = set([n for n, i in infos.items()
+                               if i["master"] == br_idx])
+                for if_name in set(members) - current:
+                    self.bridge_addif(br_name, if_name)
+                    changes["members_added"] += 1
+                for if_name in current - set(members):
+                    self.request("link", "set",
+                                 index=infos[if_name]["index"], master=0)
+                    changes["members_removed"] += 1
+        return changes
+
+    def __delete_index(self, idx):
+        try:
+            self.__ipr.link("del", index=idx)
+        except NetlinkError as err:
+            if err.code != ENODEV:
+                raise NetemError("Unable to delete link %d: %s" % (idx, err))
+            return False  # already deleted with its peer
+        return True
+
+    def netns_reconcile(self, names):
+        """
+        Remove the links to the netns of dead processes and create
+        the missing netns of names. Return the changes
+        """
+        changes = {"netns_added": 0, "netns_removed": 0}
+        if os.path.isdir(NETNS_DIR):
+            for name in os.listdir(NETNS_DIR):
+                path = os.path.join(NETNS_DIR, name)
+                if is_pid(name) and os.path.islink(path) \
+                        and not os.path.exists(path):
+                    os.unlink(path)
+                    changes["netns_removed"] += 1
+        for name in names:
+            if not os.path.exists(netns_path(name)):
+                self.netns_create(name)
+                changes["netns_added"] += 1
+        return changes
+
+    def netns_create(self, name):
+        path = netns_path(name)
+        try:
+            if not os.path.isdir(NETNS_DIR):
+                os.makedirs(NETNS_DIR)
+            if is_pid(name):
+                os.symlink("/proc/%s/ns/net" % name, path)
+            else:
+                run_in_thread(_netns_add, path)
+        except OSError as err:
+            raise NetemError("Unable to create netns %s: %s" % (name, err))
+
+    def netns_delete(self, name):
+        path = netns_path(name)
+        try:
+            if not is_pid(name):
+                libc = get_libc()
+                libc_check(libc.umount2(path.encode("utf-8"), MNT_DETACH),
+                           "Unable to umount netns %s" % name)
+            os.unlink(path)
+        except OSError as err:
+            raise NetemError("Unable to delete netns %s: %s" % (name, err))
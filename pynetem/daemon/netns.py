@@ -0,0 +1,165 @@
+# pynetem: network emulator
+# Copyright (C) 2015-2021 Mickael Royer <mickael.royer@recherche.enac.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import re
+import array
+import fcntl
+import socket
+import struct
+from pyroute2 import IPRoute, NetlinkError
+from pynetem import NetemError
+from pynetem.daemon.netlink import CLONE_NEWNET, get_libc, libc_check
+from pynetem.daemon.netlink import run_in_thread
+
+SYSCTL_NET_DIR = "/proc/sys/net"
+SIOCETHTOOL = 0x8946
+ETHTOOL_STXCSUM = 0x17
+
+
+class _NetnsContext(object):
+    """
+    Resources opened inside the namespace of a container. Sockets keep
+    the namespace where they have been created
+    """
+
+    def __init__(self):
+        self.__ipr = None
+        self.__sock = None
+
+    @property
+    def ipr(self):
+        if self.__ipr is None:
+            self.__ipr = IPRoute()
+        return self.__ipr
+
+    @property
+    def sock(self):
+        if self.__sock is None:
+            self.__sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        return self.__sock
+
+    def get_index(self, name):
+        indexes = self.ipr.link_lookup(ifname=name)
+        if len(indexes) == 0:
+            raise NetemError("interface %s does not exist" % name)
+        return indexes[0]
+
+    def close(self):
+        if self.__ipr is not None:
+            self.__ipr.close()
+        if self.__sock is not None:
+            self.__sock.close()
+
+
+def _link_state(ctx, name, state):
+    ctx.ipr.link("set", index=ctx.get_index(name), state=state)
+
+
+def _link_rename(ctx, name, new_name):
+    ctx.ipr.link("set", index=ctx.get_index(name), ifname=new_name)
+
+
+def sysctl_path(key):
+    """
+    Return the file of a net sysctl key. In keys, a '/' stands for a
+    '.' in the file name (e.g. net.ipv4.conf.eth0/10.forwarding)
+    """
+    parts = [p.replace("/", ".") for p in key.split(".")]
+    if len(parts) < 2 or parts[0] != "net" \
+            or any([p in ("", ".", "..") for p in parts]):
+        raise NetemError("%s is not a valid sysctl key" % key)
+    path = os.path.realpath(os.path.join("/proc/sys", *parts))
+    if not path.startswith(SYSCTL_NET_DIR + os.sep):
+        raise NetemError("%s is not a valid sysctl key" % key)
+    return path
+
+
+def _sysctl(ctx, key, value):
+    with open(sysctl_path(key), "w") as hdl:
+        hdl.write(value)
+
+
+def _tx_offload_off(ctx, name):
+    # equivalent of "ethtool -K <if> tx off" with the SIOCETHTOOL ioctl
+    ecmd = array.array("I", [ETHTOOL_STXCSUM, 0])
+    addr, _ = ecmd.buffer_info()
+    ifreq = struct.pack("16sP", name.encode("utf-8"), addr).ljust(40, b"\0")
+    fcntl.ioctl(ctx.sock.fileno(), SIOCETHTOOL, ifreq)
+
+
+# network-only commands which are run without docker exec
+NET_COMMANDS = [
+    (re.compile(r"^ip link set (?:dev )?(\S+) (up|down)$"), _link_state),
+    (re.compile(r"^ip link set (?:dev )?(\S+) name (\S+)$"), _link_rename),
+    (re.compile(r"^sysctl -w (net\.[\w./-]+)=(\S+)$"), _sysctl),
+    (re.compile(r"^ethtool -K (\S+) tx off$"), _tx_offload_off),
+]
+
+
+def parse_net_command(cmd_line):
+    """
+    Return (func, args) if cmd_line only touches the network namespace
+    and can be run by the fast path, None otherwise
+    """
+    cmd_line = cmd_line.strip()
+    for regexp, func in NET_COMMANDS:
+        match_obj = regexp.match(cmd_line)
+        if match_obj is not None:
+            return func, match_obj.groups()
+    return None
+
+
+def is_net_script(commands):
+    return len(commands) > 0 and all(
+        [parse_net_command(c) is not None for c in commands])
+
+
+def _netns_exec(pid, commands, stop_on_error):
+    fd = os.open("/proc/%d/ns/net" % pid, os.O_RDONLY)
+    try:
+        libc_check(get_libc().setns(fd, CLONE_NEWNET),
+                   "Unable to enter netns of process %d" % pid)
+    finally:
+        os.close(fd)
+
+    ctx, results = _NetnsContext(), []
+    try:
+        for cmd_line in commands:
+            func, args = parse_net_command(cmd_line)
+            code, output = 0, ""
+            try:
+                func(ctx, *args)
+            except (NetemError, NetlinkError, OSError) as err:
+                code, output = 1, "%s" % err
+            results.append({"cmd": cmd_line, "code": code, "output": output})
+            if code != 0 and stop_on_error:
+                break
+    finally:
+        ctx.close()
+    return results
+
+
+def netns_exec(pid, commands, stop_on_error=True):
+    """
+    Run network-only commands in the net namespace of process pid.
+    The results have the same format as the docker_script command
+    """
+    for cmd_line in commands:
+        if parse_net_command(cmd_line) is None:
+            raise NetemError("%s is not a network command" % cmd_line)
+    return run_in_thread(_netns_exec, int(pid), commands, stop_on_error)
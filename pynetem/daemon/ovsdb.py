@@ -0,0 +1,339 @@
+# pynetem: network emulator
+# Copyright (C) 2015-2021 Mickael Royer <mickael.royer@recherche.enac.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import json
+import socket
+import logging
+import threading
+from pynetem import NetemError
+from pynetem.ui.config import NetemConfig
+
+OVS_DB = "Open_vSwitch"
+
+
+def named_uuid(name):
+    return ["named-uuid", name]
+
+
+def uuid_set(uuids):
+    return ["set", [["uuid", u] for u in uuids]]
+
+
+def uuid_list(value):
+    # decode a set of uuids returned by the server
+    if value[0] == "uuid":
+        return [value[1]]
+    return [v[1] for v in value[1]]
+
+
+def tag_value(value):
+    # an empty optional column is returned as an empty set
+    if isinstance(value, list):
+        return None
+    return value
+
+
+class OVSDBClient(object):
+    """
+    Minimal OVSDB client (RFC 7047) which uses one persistent
+    connection with ovsdb-server instead of launching ovs-vsctl
+    """
+    __instance = None
+    __instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        with cls.__instance_lock:
+            if cls.__instance is None:
+                s_path = NetemConfig.instance().get(
+                    "daemon", "ovsdb_socket")
+                cls.__instance = cls(s_path)
+        return cls.__instance
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.__sock = None
+        self.__buffer = ""
+        self.__decoder = json.JSONDecoder()
+        self.__last_id = 0
+        self.__lock = threading.Lock()
+
+    def close(self):
+        with self.__lock:
+            self.__disconnect()
+
+    def __connect(self):
+        if self.__sock is not None:
+            return
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except socket.error as err:
+            sock.close()
+            raise NetemError("Unable to connect to ovsdb-server: %s" % err)
+        self.__sock, self.__buffer = sock, ""
+
+    def __disconnect(self):
+        if self.__sock is not None:
+            self.__sock.close()
+            self.__sock, self.__buffer = None, ""
+
+    def __send(self, msg):
+        self.__sock.sendall(json.dumps(msg).encode("utf-8"))
+
+    def __recv(self):
+        while True:
+            data = self.__buffer.lstrip()
+            if data:
+                try:
+                    msg, idx = self.__decoder.raw_decode(data)
+                except ValueError:
+                    pass  # incomplete message
+                else:
+                    self.__buffer = data[idx:]
+                    return msg
+            chunk = self.__sock.recv(65536)
+            if not chunk:
+                raise socket.error("connection closed by ovsdb-server")
+            self.__buffer += chunk.decode("utf-8")
+
+    def __call(self, method, params):
+        self.__last_id += 1
+        req_id = self.__last_id
+        self.__send({"method": method, "params": params, "id": req_id})
+        while True:
+            msg = self.__recv()
+            if msg.get("method") == "echo":
+                # keep alive request sent by the server
+                self.__send({"result": msg["params"],
+                             "error": None, "id": msg["id"]})
+            elif msg.get("id") == req_id:
+                if msg.get("error") is not None:
+                    raise NetemError("OVSDB error: %s" % msg["error"])
+                return msg["result"]
+
+    def call(self, method, params):
+        with self.__lock:
+            for attempt in (1, 2):
+                self.__connect()
+                try:
+                    return self.__call(method, params)
+                except (socket.error, UnicodeDecodeError) as err:
+                    # the server has probably been restarted, retry once
+                    self.__disconnect()
+                    if attempt == 2:
+                        raise NetemError("OVSDB request failed: %s" % err)
+                    logging.warning("Reconnect to ovsdb-server: %s" % err)
+
+    def transact(self, *operations):
+        result = self.call("transact", [OVS_DB] + list(operations))
+        for res in result:
+            if isinstance(res, dict) and "error" in res:
+                raise NetemError("OVSDB transaction failed: %s (%s)" % (
+                    res["error"], res.get("details", "")))
+        return result
+
+    def select(self, table, where, columns):
+        return self.transact({
+            "op": "select", "table": table,
+            "where": where, "columns": columns
+        })[0]["rows"]
+
+    def list_bridges(self):
+        rows = self.select("Bridge", [], ["name"])
+        return [row["name"] for row in rows]
+
+    def bridge_exists(self, name):
+        rows = self.select("Bridge", [["name", "==", name]], ["name"])
+        return len(rows) > 0
+
+    def add_bridge(self, name):
+        self.transact(*self.__bridge_ops(name, "bridge"))
+
+    @staticmethod
+    def __bridge_ops(name, uuid_name, port_uuids=None):
+        return [{
+            "op": "insert", "table": "Interface",
+            "row": {"name": name, "type": "internal"},
+            "uuid-name": "%s_iface" % uuid_name
+        }, {
+            "op": "insert", "table": "Port",
+            "row": {"name": name,
+                    "interfaces": named_uuid("%s_iface" % uuid_name)},
+            "uuid-name": "%s_port" % uuid_name
+        }, {
+            "op": "insert", "table": "Bridge",
+            "row": {"name": name, "ports": ["set", [
+                named_uuid("%s_port" % uuid_name)] + (port_uuids or [])]},
+            "uuid-name": uuid_name
+        }, {
+            "op": "mutate", "table": OVS_DB, "where": [],
+            "mutations": [["bridges", "insert", named_uuid(uuid_name)]]
+        }]
+
+    def del_bridges(self, names):
+        rows = self.select("Bridge", [], ["_uuid", "name"])
+        uuids = [row["_uuid"][1] for row in rows if row["name"] in names]
+        if len(uuids) > 0:
+            # ports and interfaces are garbage collected by the server
+            self.transact({
+                "op": "mutate", "table": OVS_DB, "where": [],
+                "mutations": [["bridges", "delete", uuid_set(uuids)]]
+            })
+        return len(uuids)
+
+    def add_ports(self, sw_name, ports):
+        """
+        Add ports to a bridge in one transaction, ports is a list
+        of (port name, vlan tag or None)
+        """
+        operations, port_uuids = self.__ports_ops(ports, "port")
+        operations.append({
+            "op": "mutate", "table": "Bridge",
+            "where": [["name", "==", sw_name]],
+            "mutations": [["ports", "insert", ["set", port_uuids]]]
+        })
+        result = self.transact(*operations)
+        if result[len(operations)-1]["count"] != 1:
+            raise NetemError("OVS bridge %s does not exist" % sw_name)
+
+    @staticmethod
+    def __ports_ops(ports, uuid_prefix):
+        operations, port_uuids = [], []
+        for idx, (p_name, tag) in enumerate(ports):
+            uuid_name = "%s%d" % (uuid_prefix, idx)
+            p_row = {"name": p_name,
+                     "interfaces": named_uuid("%s_iface" % uuid_name)}
+            if tag is not None:
+                p_row["tag"] = int(tag)
+            operations.extend([{
+                "op": "insert", "table": "Interface",
+                "row": {"name": p_name}, "uuid-name": "%s_iface" % uuid_name
+            }, {
+                "op": "insert", "table": "Port",
+                "row": p_row, "uuid-name": uuid_name
+            }])
+            port_uuids.append(named_uuid(uuid_name))
+        return operations, port_uuids
+
+    def reconcile(self, prefix, switches):
+        """
+        Make the bridges whose name starts with prefix match switches,
+        a dict {bridge name: {port name: vlan tag or None}}. All the
+        changes are done in one transaction. Return the changes and
+        the list of added ports
+        """
+        changes = dict.fromkeys(
+            ("switches_added", "switches_removed", "ports_added",
+             "ports_removed", "tags_updated"), 0)
+        bridges = self.select("Bridge", [], ["_uuid", "name", "ports"])
+        ports = dict([
+            (row["_uuid"][1], row)
+            for row in self.select("Port", [], ["_uuid", "name", "tag"])
+        ])
+
+        operations, del_uuids, added_ports = [], [], []
+        existing = set()
+        for idx, bridge in enumerate(bridges):
+            br_name, br_uuid = bridge["name"], bridge["_uuid"][1]
+            if not br_name.startswith(prefix):
+                continue
+            existing.add(br_name)
+            if br_name not in switches:
+                del_uuids.append(br_uuid)
+                changes["switches_removed"] += 1
+                continue
+
+            desired, current = switches[br_name], {}
+            for p_uuid in uuid_list(bridge["ports"]):
+                port = ports.get(p_uuid)
+                if port is not None and port["name"] != br_name:
+                    current[port["name"]] = (p_uuid, tag_value(port["tag"]))
+            old_uuids = [current[p][0] for p in current if p not in desired]
+            new_ports = [(p, desired[p]) for p in desired if p not in current]
+            for p_name in desired:
+                if p_name not in current:
+                    continue
+                tag = desired[p_name]
+                if tag is not None:
+                    tag = int(tag)
+                if tag != current[p_name][1]:
+                    operations.append({
+                        "op": "update", "table": "Port",
+                        "where": [["_uuid", "==", ["uuid",
+                                                   current[p_name][0]]]],
+                        "row": {"tag": tag is None and ["set", []] or tag}
+                    })
+                    changes["tags_updated"] += 1
+            p_ops, p_uuids = self.__ports_ops(new_ports, "br%dport" % idx)
+            operations.extend(p_ops)
+            if len(old_uuids) > 0 or len(p_uuids) > 0:
+                operations.append({
+                    "op": "mutate", "table": "Bridge",
+                    "where": [["_uuid", "==", ["uuid", br_uuid]]],
+                    "mutations": [
+                        ["ports", "delete", uuid_set(old_uuids)],
+                        ["ports", "insert", ["set", p_uuids]]
+                    ]
+                })
+            changes["ports_removed"] += len(old_uuids)
+            changes["ports_added"] += len(new_ports)
+            added_ports.extend([p for p, _ in new_ports])
+
+        for idx, br_name in enumerate(sorted(switches)):
+            if br_name in existing:
+                continue
+            new_ports = list(switches[br_name].items())
+            p_ops, p_uuids = self.__ports_ops(new_ports, "new%dport" % idx)
+            operations.extend(p_ops)
+            operations.extend(
+                self.__bridge_ops(br_name, "new%d" % idx, p_uuids))
+            changes["switches_added"] += 1
+            changes["ports_added"] += len(new_ports)
+            added_ports.extend([p for p, _ in new_ports])
+
+        if len(del_uuids) > 0:
+            # ports and interfaces are garbage collected by the server
+            operations.append({
+                "op": "mutate", "table": OVS_DB, "where": [],
+                "mutations": [["bridges", "delete", uuid_set(del_uuids)]]
+            })
+        if len(operations) > 0:
+            self.transact(*operations)
+        return changes, added_ports
+
+    def set_port_tag(self, p_name, tag):
+        result = self.transact({
+            "op": "update", "table": "Port",
+            "where": [["name", "==", p_name]],
+            "row": {"tag": int(tag)}
+        })
+        if result[0]["count"] != 1:
+            raise NetemError("OVS port %s does not exist" % p_name)
+
+    def del_ports(self, sw_name, p_names):
+        rows = self.select("Port", [], ["_uuid", "name"])
+        uuids = [row["_uuid"][1] for row in rows if row["name"] in p_names]
+        if len(uuids) != len(p_names):
+            raise NetemError("OVS ports %s do not exist" % ", ".join(p_names))
+        result = self.transact({
+            "op": "mutate", "table": "Bridge",
+            "where": [["name", "==", sw_name]],
+            "mutations": [["ports", "delete", uuid_set(uuids)]]
+        })
+        if result[0]["count"] != 1:
+            raise NetemError("OVS bridge %s does not exist" % sw_name)
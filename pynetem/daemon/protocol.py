@@ -0,0 +1,65 @@
+# pynetem: network emulator
+# Copyright (C) 2015-2021 Mickael Royer <mickael.royer@recherche.enac.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import json
+import struct
+from pynetem import NetemError
+
+# each message is a json object preceded by its length (4 bytes)
+HEADER = struct.Struct("!I")
+# biggest accepted message, a bogus length must not exhaust the memory
+MAX_MSG_SIZE = 16 * 1024 * 1024
+
+
+def dumps_msg(msg):
+    data = json.dumps(msg).encode("utf-8")
+    return HEADER.pack(len(data)) + data
+
+
+def read_msg(r_file):
+    """
+    Read the next message from a binary file object, return None
+    when the connection has been closed
+    """
+    header = r_file.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    (length,) = HEADER.unpack(header)
+    if length > MAX_MSG_SIZE:
+        raise NetemError("Daemon message too long (%d bytes)" % length)
+    data = r_file.read(length)
+    if len(data) < length:
+        return None
+    try:
+        return json.loads(data.decode("utf-8"))
+    except ValueError:
+        raise NetemError("Malformed daemon message")
+
+
+def build_request(req_id, cmd, args):
+    return dumps_msg({"id": req_id, "cmd": cmd, "args": list(args)})
+
+
+def build_answer(req_id, state, content):
+    return dumps_msg({"id": req_id, "state": state, "content": content})
+
+
+def build_event(req_id, state, content):
+    # event of the job submitted by the request req_id
+    return dumps_msg({
+        "id": req_id, "event": "job", "state": state, "content": content
+    })
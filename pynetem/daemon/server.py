@@ -18,16 +18,26 @@
 import re
 import os
 import threading
-from socketserver import UnixStreamServer, BaseRequestHandler
+import time
+from socketserver import ThreadingMixIn, UnixStreamServer
+from socketserver import StreamRequestHandler
 import subprocess
 import logging
 import shlex
-from pyroute2 import IPDB
-import docker
-from pynetem import __version__
+from concurrent.futures import ThreadPoolExecutor
+from pynetem import __version__, NETEM_ID
 from pynetem import NetemError
 from pynetem.utils import get_exc_desc
-from pynetem.utils import cmd_call
+from pynetem.ui.config import NetemConfig
+from pynetem.daemon.docker import DockerManager, check_script_results
+from pynetem.daemon.locks import ResourceLocks
+from pynetem.daemon.netlink import NetlinkManager
+from pynetem.daemon.netns import is_net_script, netns_exec
+from pynetem.daemon.ovsdb import OVSDBClient
+from pynetem.daemon.jobs import JobRegistry, job_context
+from pynetem.daemon.jobs import report_progress, check_cancelled
+from pynetem.daemon.protocol import read_msg, build_answer, build_event
+from pynetem.daemon.stats import DaemonStats, count_spawn
 
 CMD_LIST = {
     "version": r"^version$",
@@ -39,6 +49,7 @@ CMD_LIST = {
     "link_delete": r"^link_delete (\S+)$",
     "link_netns": r"^link_netns (\S+) (\S+)$",
     "link_set_vtap": r"^link_set_vtap (\S+) (\S+)$",
+    "link_attach": r"^link_attach (\S+) ([0-9]+) (\S+)$",
     "br_create": r"^br_create (\S+)$",
     "br_delete": r"^br_delete (\S+)$",
     "br_addif": r"^br_addif (\S+) (\S+)$",
@@ -65,11 +76,126 @@ CMD_LIST = {
     "docker_pull": r"^docker_pull (\S+)$",
     "clean": r"^clean (\S+)$",
     "chown": r"^chown \"([^\0]+)\" (\d+) (\d+)$",
+    "stats": r"^stats (show|reset)$",
+    "job_cancel": r"^job_cancel ([0-9]+)$",
 }
+# commands with json arguments: name -> number of arguments
+JSON_CMD_LIST = {
+    "batch": 2,
+    "docker_put_files": 2,
+    "docker_get_files": 2,
+    "docker_script": 3,
+    "apply": 2,
+}
+# command used to run another command as a job, its arguments are
+# the name and the arguments of the command
+JOB_CMD = "job_submit"
+# commands used to undo an applied command when a batch fails
+ROLLBACK_CMDS = {
+    "tap_create": lambda args: ("tap_delete", args[:1]),
+    "netns_create": lambda args: ("netns_delete", args[:1]),
+    "link_create": lambda args: ("link_delete", args[:1]),
+    "br_create": lambda args: ("br_delete", args[:1]),
+    "br_addif": lambda args: ("br_delif", args[:2]),
+    "ovs_create": lambda args: ("ovs_delete", args[:1]),
+    "ovs_add_port": lambda args: ("ovs_del_port", args[:2]),
+    "docker_create": lambda args: ("docker_rm", args[1:2]),
+    "docker_start": lambda args: ("docker_stop", args[:1]),
+}
+# arguments which identify the objects (interface, bridge, netns,
+# container...) touched by a command. Commands which share an object
+# are serialized, the others run in parallel
+CMD_RESOURCES = {
+    "tap_create": (0,),
+    "tap_delete": (0,),
+    "netns_create": (0,),
+    "netns_delete": (0,),
+    "link_create": (0, 1),
+    "link_delete": (0,),
+    "link_netns": (0, 1),
+    "link_set_vtap": (0, 1),
+    "link_attach": (0, 1),
+    "br_create": (0,),
+    "br_delete": (0,),
+    "br_addif": (0, 1),
+    "br_delif": (0, 1),
+    "ifup": (0,),
+    "ifdown": (0,),
+    "ovs_create": (0,),
+    "ovs_delete": (0,),
+    "ovs_add_port": (0, 1),
+    "ovs_port_vlan": (0,),
+    "ovs_add_mirror_port": (0, 1),
+    "ovs_del_port": (0, 1),
+    "docker_create": (1,),
+    "docker_start": (0,),
+    "docker_stop": (0,),
+    "docker_rm": (0,),
+    "docker_attach_interface": (0, 1),
+    "docker_pid": (0,),
+    "docker_cp": lambda args: [a.split(":", 1)[0] for a in args if ":" in a],
+    "docker_exec": (0,),
+    "docker_put_files": (0,),
+    "docker_get_files": (0,),
+    "docker_script": (0,),
+    "docker_shell": (0,),
+    "docker_capture": (1,),
+    "docker_image_present": (0,),
+    "docker_pull": (0,),
+    "chown": (0,),
+}
+# commands which can not run in parallel with any other command
+EXCLUSIVE_CMDS = ("clean", "apply")
+# commands answered by the session thread, without lock nor worker,
+# a job has to be cancelled while it holds the locks
+SESSION_CMDS = ("job_cancel", "stats")
+# consecutive port commands of a batch done in one ovsdb transaction
+OVS_PORT_CMDS = ("ovs_add_port", "ovs_port_vlan", "ovs_del_port")
+
+
+def check_apply_state(prj_id, state):
+    """
+    Verify that every object of the desired state belongs to the
+    project, apply must not reconcile resources of other projects
+    """
+    if not isinstance(prj_id, str) or not prj_id \
+            or not isinstance(state, dict):
+        raise NetemError("Malformed state for project %s" % prj_id)
+
+    def check_name(name, host_if=False):
+        # a bridge can also contain a host interface, which can not
+        # be an object of another pynetem project
+        if not isinstance(name, str) or not (
+                name.startswith(prj_id)
+                or host_if and not name.startswith(NETEM_ID)):
+            raise NetemError("%s does not belong to project %s"
+                             % (name, prj_id))
+
+    try:
+        for sw_name, ports in state.get("switches", {}).items():
+            check_name(sw_name)
+            for p_name, tag in ports.items():
+                check_name(p_name)
+                if tag is not None:
+                    int(tag)
+        for br_name, members in state.get("bridges", {}).items():
+            check_name(br_name)
+            for if_name in members:
+                check_name(if_name, host_if=True)
+        for if1, if2 in state.get("links", []):
+            check_name(if1)
+            check_name(if2)
+        for ns_name in state.get("netns", []):
+            # the netns of a container is named by its pid
+            if not (isinstance(ns_name, str) and ns_name.isdigit()):
+                check_name(ns_name)
+    except (AttributeError, TypeError, ValueError):
+        raise NetemError("Malformed state for project %s" % prj_id)
 
 
 def run_command(cmd_line, check_output=False, shell=False):
     args = shlex.split(cmd_line)
+    count_spawn()
     if check_output:
         try:
             result = subprocess.check_output(args, shell=shell)
@@ -88,21 +214,143 @@ def run_command(cmd_line, check_output=False, shell=False):
             raise NetemError(msg)
 
 
-class NetemDaemonHandler(BaseRequestHandler):
+class NetemDaemonHandler(StreamRequestHandler):
+
+    def setup(self):
+        super(NetemDaemonHandler, self).setup()
+        self.write_lock = threading.Lock()
 
     def handle(self):
-        cmd = self.request.recv(1024).decode("utf-8").strip()
-        logging.debug("Receive data: %s" % cmd)
+        logging.debug("Open a new daemon session")
+        while True:
+            try:
+                request = read_msg(self.rfile)
+            except NetemError as err:
+                logging.error("Close the daemon session: %s" % err)
+                break
+            if request is None:
+                break
+
+            logging.debug("Receive data: %s" % request)
+            if request.get("cmd") in SESSION_CMDS:
+                state, content = self.run_cmd(
+                    request.get("cmd"), request.get("args", []))
+                self.send_answer(request.get("id"), state, content)
+                continue
+            # requests of a session are executed by the worker pool
+            self.server.executor.submit(self.process_request, request)
+        logging.debug("Close a daemon session")
+
+    def process_request(self, request):
+        cmd_name, args = request.get("cmd"), request.get("args", [])
+        if cmd_name == JOB_CMD:
+            return self.process_job(request.get("id"), args)
+        keys, exclusive = self.get_resources(cmd_name, args)
+        with self.server.locks.hold(keys, exclusive=exclusive):
+            state, content = self.run_cmd(cmd_name, args)
+        self.send_answer(request.get("id"), state, content)
+
+    def process_job(self, req_id, args):
+        if not isinstance(args, list) or len(args) != 2 \
+                or not isinstance(args[1], list) or args[0] == JOB_CMD:
+            self.send_answer(req_id, "error", "Malformed job request")
+            return
+        cmd_name, cmd_args = args
+        job = self.server.jobs.create(
+            lambda state, content: self.send_event(req_id, state, content))
+        # the job id is returned before the execution of the command
+        self.send_answer(req_id, "OK", job.job_id)
+        logging.debug("Start job %d: %s" % (job.job_id, cmd_name))
+
+        keys, exclusive = self.get_resources(cmd_name, cmd_args)
+        try:
+            with self.server.locks.hold(keys, exclusive=exclusive):
+                if job.cancelled.is_set():
+                    state, content = "cancelled", None
+                else:
+                    with job_context(job):
+                        state, content = self.run_cmd(cmd_name, cmd_args)
+                    if state != "OK" and job.cancelled.is_set():
+                        state = "cancelled"
+        finally:
+            self.server.jobs.remove(job)
+        job.send_event(state, content)
+
+    def send_event(self, req_id, state, content):
+        event = build_event(req_id, state, content)
+        with self.write_lock:
+            try:
+                self.wfile.write(event)
+            except (OSError, ValueError) as err:
+                logging.warning("Unable to send event %s: %s" % (req_id, err))
+
+    def send_answer(self, req_id, state, content):
+        answer = build_answer(req_id, state, content)
+        with self.write_lock:
+            try:
+                self.wfile.write(answer)
+            except (OSError, ValueError) as err:
+                logging.warning("Unable to send answer %s: %s" % (req_id, err))
+
+    def get_resources(self, cmd_name, args):
+        try:
+            if cmd_name == "batch":
+                keys, exclusive = set(), False
+                for command in args[0]:
+                    c_keys, c_exclusive = self.get_resources(
+                        command[0], command[1:])
+                    keys |= c_keys
+                    exclusive = exclusive or c_exclusive
+                return keys, exclusive
+            if cmd_name in EXCLUSIVE_CMDS:
+                return set(), True
+            if cmd_name not in CMD_RESOURCES:
+                return set(), False
+
+            if cmd_name in JSON_CMD_LIST:
+                groups = args
+            else:
+                cmd = " ".join([cmd_name] + args)
+                match_obj = re.match(CMD_LIST[cmd_name], cmd)
+                if match_obj is None:
+                    return set(), False
+                groups = match_obj.groups()
+            resources = CMD_RESOURCES[cmd_name]
+            if callable(resources):
+                return set(resources(groups)), False
+            return set([groups[idx] for idx in resources]), False
+        except (TypeError, IndexError, KeyError):
+            # malformed request, run_cmd returns the error
+            return set(), False
+
+    def run_cmd(self, cmd_name, args):
+        if cmd_name == "stats":
+            return self.__run_cmd(cmd_name, args)
+        if not isinstance(cmd_name, str) or (
+                cmd_name not in CMD_LIST and cmd_name not in JSON_CMD_LIST):
+            stats_name = "unknown"
+        else:
+            stats_name = cmd_name
+        with self.server.stats.measure(stats_name) as state:
+            result = self.__run_cmd(cmd_name, args)
+            state.append(result[0])
+        return result
 
-        msg = ""
+    def __run_cmd(self, cmd_name, args):
         try:
-            cmd_args = cmd.split()
-            if len(cmd_args) < 1:
+            if not cmd_name:
                 raise NetemError("The sent command is empty")
-
-            cmd_name = cmd_args[0]
+            if cmd_name in JSON_CMD_LIST:
+                if len(args) != JSON_CMD_LIST[cmd_name]:
+                    raise NetemError("Wrong number of args for "
+                                     "command %s" % cmd_name)
+                return "OK", getattr(self, cmd_name)(*args)
             if cmd_name not in CMD_LIST:
-                raise NetemError("Unknown command %s" % cmd)
+                raise NetemError("Unknown command %s" % cmd_name)
+            if not all([isinstance(arg, str) for arg in args]):
+                raise NetemError("Wrong args type for "
+                                 "command %s" % cmd_name)
+            cmd = " ".join([cmd_name] + args)
             cmd_regexp = CMD_LIST[cmd_name]
             # verify arguments
             match_obj = re.match(cmd_regexp, cmd)
@@ -112,93 +360,227 @@ class NetemDaemonHandler(BaseRequestHandler):
             # execute command
             ret = getattr(self, cmd_name)(*match_obj.groups())
         except NetemError as err:
-            msg = "%s" % err
+            return "error", "%s" % err
         except Exception:
             logging.error(get_exc_desc())
-            msg = "Unknown exception happen see log for details"
-        else:
-            msg = "OK"
-            if ret is not None:
-                msg += " %s" % ret
-        self.request.sendall(msg.encode("utf-8"))
+            return "error", "Unknown exception happen see log for details"
+        return "OK", ret
 
     @staticmethod
     def version():
         return __version__
 
+    def job_cancel(self, job_id):
+        logging.debug("Cancel job %s" % job_id)
+        self.server.jobs.cancel(int(job_id))
+
+    def stats(self, action):
+        if action == "reset":
+            self.server.stats.reset()
+            return None
+        return self.server.stats.show()
+
+    def batch(self, commands, rollback):
+        logging.debug("Run a batch of %d commands" % len(commands))
+        results, applied = [], []
+        idx = 0
+        while idx < len(commands):
+            command = commands[idx]
+            if not isinstance(command, list) or len(command) < 1:
+                raise NetemError("Malformed command in batch")
+            if command[0] == "batch":
+                raise NetemError("Nested batch are not supported")
+            # consecutive ovs port commands are done in one transaction
+            group = self.__ovs_port_group(commands, idx)
+            if len(group) > 1:
+                states = self.__run_ovs_port_group(group)
+            else:
+                states = [self.run_cmd(command[0], command[1:])]
+            for (state, content), (cmd_name, cmd_args) in zip(
+                    states, [(c[0], c[1:]) for c in group or [command]]):
+                results.append({"state": state, "content": content})
+                if state == "OK" and content != "EXIST":
+                    applied.append((cmd_name, cmd_args))
+            if states[-1][0] != "OK":
+                if rollback:
+                    self.__rollback(applied)
+                break
+            idx += max(len(group), 1)
+        return results
+
     @staticmethod
-    def docker_pull(image_name):
-        client = docker.from_env()
+    def __ovs_port_group(commands, start):
+        group, sw_name, ports = [], None, []
+        for command in commands[start:]:
+            if not isinstance(command, list) or len(command) != 3 \
+                    or command[0] not in OVS_PORT_CMDS:
+                break
+            if not all([isinstance(arg, str) for arg in command]) \
+                    or re.match(CMD_LIST[command[0]], " ".join(command)) \
+                    is None:
+                break
+            # port additions and deletions are not mixed in a group
+            if len(group) > 0 and (command[0] == "ovs_del_port") \
+                    != (group[0][0] == "ovs_del_port"):
+                break
+            if command[0] in ("ovs_add_port", "ovs_del_port"):
+                if sw_name is not None and sw_name != command[1]:
+                    break
+                sw_name = command[1]
+                ports.append(command[2])
+            elif command[1] not in ports:
+                break
+            group.append(command)
+        return group
+
+    def __run_ovs_port_group(self, group):
+        ports, tags = [], {}
+        for command in group:
+            if command[0] in ("ovs_add_port", "ovs_del_port"):
+                sw_name = command[1]
+                ports.append(command[2])
+            else:
+                tags[command[1]] = command[2]
         try:
-            client.images.pull(image_name)
-        except docker.errors.APIError as ex:
-            raise NetemError(
-                "Unable to pull {} image: {}".format(image_name, ex)
-            )
+            if group[0][0] == "ovs_del_port":
+                self.ovs_del_ports(sw_name, ports)
+            else:
+                self.ovs_add_ports(
+                    sw_name, [(p, tags.get(p)) for p in ports])
+        except NetemError as err:
+            # the group is one transaction, all its commands have failed
+            return [("error", "%s" % err)] * len(group)
+        except Exception:
+            logging.error(get_exc_desc())
+            return [("error", "Unknown exception happen see log "
+                              "for details")] * len(group)
+        return [("OK", None)] * len(group)
+
+    def __rollback(self, applied):
+        for cmd_name, cmd_args in reversed(applied):
+            if cmd_name not in ROLLBACK_CMDS:
+                continue
+            r_name, r_args = ROLLBACK_CMDS[cmd_name](cmd_args)
+            logging.debug("Rollback %s -> %s %s" % (cmd_name, r_name, r_args))
+            state, content = self.run_cmd(r_name, r_args)
+            if state != "OK":
+                logging.error("Unable to rollback %s: "
+                              "%s" % (cmd_name, content))
+
+    @staticmethod
+    def docker_pull(image_name):
+        logging.debug("Pull docker image %s" % image_name)
+        DockerManager.instance().pull(image_name)
 
     @staticmethod
     def docker_image_present(image_name):
-        client = docker.from_env()
-        images = client.images.list()
-        for img in images:
-            if image_name in img.tags:
-                return "yes"
+        if DockerManager.instance().image_present(image_name):
+            return "yes"
         return "no"
 
     @staticmethod
     def docker_create(name, container_name, image, ipv6):
         logging.debug("Create docker container %s" % container_name)
-        cmd = "docker create --privileged --cap-add=ALL --net=none"
-        if ipv6 == "yes":
-            cmd += " --sysctl net.ipv6.conf.all.disable_ipv6=0"
-        cmd += " -h %s --name %s %s"
-        run_command(cmd % (name, container_name, image))
+        DockerManager.instance().create(
+            name, container_name, image, ipv6=ipv6 == "yes")
 
-    @staticmethod
-    def docker_attach_interface(container_name, if_name, target_name):
+    @classmethod
+    def docker_attach_interface(cls, container_name, if_name, target_name):
         logging.debug("Docker : attach if %s to container "
                       "%s" % (if_name, container_name))
-        run_command("docker exec %s ip link set %s "
-                    "name %s" % (container_name, if_name, target_name))
-        run_command("docker exec %s ip link set %s "
-                    "up" % (container_name, target_name))
+        cls.docker_script(container_name, [
+            "ip link set %s name %s" % (if_name, target_name),
+            "ip link set %s up" % target_name,
+        ], True, check=True)
 
     @staticmethod
     def docker_start(container_name):
         logging.debug("Start docker container %s" % container_name)
-        run_command("docker start %s" % container_name)
+        DockerManager.instance().start(container_name)
 
-    @classmethod
-    def docker_stop(cls, container_name):
+    @staticmethod
+    def docker_stop(container_name):
         logging.debug("Stop docker container %s" % container_name)
-        container = cls.__get_container_list(container_name)
-        if len(container) == 1:
-            run_command("docker stop -t 2 %s" % container_name)
+        DockerManager.instance().stop(container_name, timeout=2)
 
-    @classmethod
-    def docker_rm(cls, container_name):
+    @staticmethod
+    def docker_rm(container_name):
         logging.debug("Delete docker container %s" % container_name)
-        container = cls.__get_container_list(container_name)
-        if len(container) == 1:
-            run_command("docker stop -t 2 %s" % container_name)
-            run_command("docker rm %s" % container_name)
+        # the container is removed, no need to wait for a clean stop
+        DockerManager.instance().remove(container_name, force=True)
 
     @staticmethod
     def docker_pid(container_name):
         logging.debug("Get PID of docker container %s" % container_name)
-        pid = run_command("docker inspect --format '{{.State.Pid}}' "
-                          "%s" % container_name, check_output=True)
-        return pid
+        return str(DockerManager.instance().pid(container_name))
 
     @staticmethod
     def docker_cp(source, dest):
         logging.debug("Docker cp from %s to %s" % (source, dest))
-        run_command("docker cp \"%s\" \"%s\"" % (source, dest))
+        DockerManager.instance().copy(source, dest)
+
+    @classmethod
+    def docker_put_files(cls, container_name, files):
+        logging.debug("Docker put %d files in %s" % (len(files),
+                                                      container_name))
+        DockerManager.instance().put_files(
+            container_name, cls.__check_files(files))
+
+    @classmethod
+    def docker_get_files(cls, container_name, files):
+        logging.debug("Docker get %d files from %s" % (len(files),
+                                                        container_name))
+        DockerManager.instance().get_files(
+            container_name, cls.__check_files(files))
+
+    @staticmethod
+    def docker_script(container_name, commands, stop_on_error, check=False):
+        logging.debug("Docker %s : exec script of %d commands"
+                      % (container_name, len(commands)))
+        if not isinstance(commands, list) \
+                or not all([isinstance(c, str) for c in commands]):
+            raise NetemError("Script commands have to be a list of string")
+        docker_manager = DockerManager.instance()
+        pid = 0
+        if is_net_script(commands):
+            pid = docker_manager.pid(container_name)
+        if pid != 0:
+            # fast path, enter the container netns without dockerd
+            results = netns_exec(pid, commands, bool(stop_on_error))
+            check_script_results(
+                container_name, commands, results, bool(stop_on_error))
+        else:
+            results = docker_manager.exec_script(
+                container_name, commands, stop_on_error=bool(stop_on_error))
+        if check:
+            for result in results:
+                if result["code"] != 0:
+                    raise NetemError(
+                        "Unable to excecute command %s in %s: %s" % (
+                            result["cmd"], container_name, result["output"]))
+        return results
 
     @staticmethod
-    def docker_exec(container_name, cmd_line):
+    def __check_files(files):
+        if not isinstance(files, list) or not all([
+                isinstance(f, list) and len(f) == 2
+                and all([isinstance(p, str) for p in f]) for f in files]):
+            raise NetemError("Files have to be a list of path pairs")
+        return files
+
+    @classmethod
+    def docker_exec(cls, container_name, cmd_line):
         logging.debug("Docker %s : exec %s" % (container_name, cmd_line))
-        run_command("docker exec %s %s" % (container_name, cmd_line))
+        if is_net_script([cmd_line]):
+            cls.docker_script(container_name, [cmd_line], True, check=True)
+            return
+        ret, output = DockerManager.instance().exec_run(
+            container_name, cmd_line)
+        if ret != 0:
+            msg = "Unable to excecute command %s in %s: %s" % (
+                cmd_line, container_name, output.strip())
+            logging.error(msg)
+            raise NetemError(msg)
 
     @classmethod
     def docker_shell(cls, c_name, name, shell, display, term_cmd):
@@ -208,6 +590,7 @@ class NetemDaemonHandler(BaseRequestHandler):
             "cmd": "docker exec -it %s %s" % (c_name, shell)
         }
         args = shlex.split(term_cmd)
+        count_spawn()
         try:
             subprocess.Popen(
                 args, shell=False,
@@ -223,6 +606,7 @@ class NetemDaemonHandler(BaseRequestHandler):
         cmd = "/bin/bash -c 'docker exec {0} tcpdump -s 0 -U -w - -i {1} "\
               "2>/dev/null | wireshark -o 'gui.window_title:{1}@{2}' "\
               "-k -i - &'".format(c_name, if_name, pretty_name)
+        count_spawn()
         subprocess.call(
             shlex.split(cmd),
             env={"DISPLAY": display, "HOME": "/root"})
@@ -230,56 +614,49 @@ class NetemDaemonHandler(BaseRequestHandler):
     @staticmethod
     def tap_create(name, user):
         logging.debug("Create tap %s" % name)
-        run_command("tunctl -u %s -t %s" % (user, name))
-        run_command("ip link set %s up" % (name,))
+        NetlinkManager.instance().tap_create(name, user)
 
     @staticmethod
     def tap_delete(name):
         logging.debug("Delete tap %s" % name)
-        run_command("tunctl -d %s" % (name,))
+        NetlinkManager.instance().link_delete(name)
 
     @staticmethod
-    def __is_pid(pid):
-        try:
-            int(pid)
-        except ValueError:
-            return False
-        else:
-            return True
-
-    @classmethod
-    def netns_create(cls, name):
+    def netns_create(name):
         logging.debug("Create netns %s" % name)
-        if not cls.__is_pid(name):
-            run_command("ip netns add %s" % name)
-        else:
-            if not os.path.isdir("/var/run/netns"):
-                os.mkdir("/var/run/netns")
-            run_command("ln -s /proc/%s/ns/net "
-                        "/var/run/netns/%s" % (name, name))
+        NetlinkManager.instance().netns_create(name)
 
-    @classmethod
-    def netns_delete(cls, name):
+    @staticmethod
+    def netns_delete(name):
         logging.debug("Delete netns %s" % name)
-        if not cls.__is_pid(name):
-            run_command("ip netns del %s" % name)
-        else:
-            run_command("rm /var/run/netns/%s" % name)
+        NetlinkManager.instance().netns_delete(name)
 
     @staticmethod
     def link_create(if1, if2):
         logging.debug("Create link %s<-->%s" % (if1, if2))
-        run_command("ip link add %s type veth peer name %s" % (if1, if2))
+        NetlinkManager.instance().veth_create(if1, if2)
 
     @staticmethod
     def link_delete(if_name):
         logging.debug("Delete link %s" % if_name)
-        run_command("ip link del %s" % if_name)
+        NetlinkManager.instance().link_delete(if_name)
 
     @staticmethod
     def link_netns(if_name, netns):
         logging.debug("Attach link %s to namespace %s" % (if_name, netns))
-        run_command("ip link set %s netns %s" % (if_name, netns))
+        NetlinkManager.instance().link_set_netns(if_name, netns)
+
+    @staticmethod
+    def link_attach(if_name, pid, target_name):
+        logging.debug("Attach link %s to process %s as %s"
+                      % (if_name, pid, target_name))
+        NetlinkManager.instance().link_attach(if_name, pid, target_name)
+        # disable tcp offloading (segmentation / checksum)
+        cmd_line = "ethtool -K %s tx off" % target_name
+        result = netns_exec(pid, [cmd_line])[0]
+        if result["code"] != 0:
+            raise NetemError("Unable to excecute command %s in netns %s: %s"
+                             % (cmd_line, pid, result["output"]))
 
     @staticmethod
     def link_set_vtap(if_name, netns):
@@ -288,121 +665,156 @@ class NetemDaemonHandler(BaseRequestHandler):
                     "type macvtap mode vepa" % (netns, if_name))
         run_command("ip netns exec %s ip link set macvtap0 up" % netns)
 
-    @classmethod
-    def ifup(cls, if_name):
+    @staticmethod
+    def ifup(if_name):
         logging.debug("Ifup %s" % if_name)
-        with IPDB() as ipdb:
-            if if_name not in ipdb.interfaces:
-                raise NetemError("interface %s does not exist" % if_name)
-            # be sure that host if is UP
-            if_obj = ipdb.interfaces[if_name]
-            if if_obj.operstate != 'UP':
-                if_obj.freeze()
-                if_obj.up().commit()
-                if_obj.unfreeze()
+        netlink = NetlinkManager.instance()
+        if not netlink.link_is_up(if_name):
+            netlink.link_set_state(if_name, "up")
 
-    @classmethod
-    def ifdown(cls, if_name):
+    @staticmethod
+    def ifdown(if_name):
         logging.debug("Ifdown %s" % if_name)
-        with IPDB() as ipdb:
-            if if_name not in ipdb.interfaces:
-                raise NetemError("interface %s does not exist" % if_name)
-            # be sure that host if is UP
-            if_obj = ipdb.interfaces[if_name]
-            if if_obj.operstate == 'UP':
-                if_obj.freeze()
-                if_obj.down().commit()
-                if_obj.unfreeze()
+        netlink = NetlinkManager.instance()
+        if netlink.link_is_up(if_name):
+            netlink.link_set_state(if_name, "down")
 
     @staticmethod
-    def __is_bridge_exist(br_name):
-        return cmd_call("brctl show %s" % br_name) == 0
-
-    @classmethod
-    def br_create(cls, br_name):
+    def br_create(br_name):
         logging.debug("Create bridge %s" % br_name)
-        if cls.__is_bridge_exist(br_name):
+        netlink = NetlinkManager.instance()
+        if netlink.is_bridge(br_name):
             return "EXIST"
-        run_command("brctl addbr %s" % br_name)
-        run_command("ip link set %s up" % br_name)
+        netlink.bridge_create(br_name)
 
-    @classmethod
-    def br_delete(cls, br_name):
+    @staticmethod
+    def br_delete(br_name):
         logging.debug("Delete bridge %s" % br_name)
-        if cls.__is_bridge_exist(br_name):
-            run_command("ip link set %s down" % br_name)
-            run_command("brctl delbr %s" % br_name)
+        netlink = NetlinkManager.instance()
+        if netlink.is_bridge(br_name):
+            netlink.link_delete(br_name)
 
-    @classmethod
-    def br_addif(cls, br_name, if_name):
+    @staticmethod
+    def br_addif(br_name, if_name):
         logging.debug("Addif %s to bridge %s" % (if_name, br_name))
-        if cls.__is_bridge_exist(br_name):
-            run_command("ip link set %s up" % if_name)
-            run_command("brctl addif %s %s" % (br_name, if_name))
+        netlink = NetlinkManager.instance()
+        if netlink.is_bridge(br_name):
+            netlink.bridge_addif(br_name, if_name)
 
-    @classmethod
-    def br_delif(cls, br_name, if_name):
+    @staticmethod
+    def br_delif(br_name, if_name):
         logging.debug("Delif %s to bridge %s" % (if_name, br_name))
-        if cls.__is_bridge_exist(br_name):
-            run_command("brctl delif %s %s" % (br_name, if_name))
+        netlink = NetlinkManager.instance()
+        if netlink.is_bridge(br_name):
+            netlink.bridge_delif(br_name, if_name)
 
     @staticmethod
-    def __is_ovsbr_exist(sw_name):
-        return cmd_call("ovs-vsctl br-exists %s" % sw_name) != 2
-
-    @classmethod
-    def ovs_create(cls, sw_name):
+    def ovs_create(sw_name):
         logging.debug("Create switch %s" % sw_name)
-        if cls.__is_ovsbr_exist(sw_name):
+        ovsdb = OVSDBClient.instance()
+        if ovsdb.bridge_exists(sw_name):
             return "EXIST"
-        run_command("ovs-vsctl add-br %s" % sw_name)
+        ovsdb.add_bridge(sw_name)
 
-    @classmethod
-    def ovs_delete(cls, sw_name):
+    @staticmethod
+    def ovs_delete(sw_name):
         logging.debug("Delete switch %s" % sw_name)
-        if cls.__is_ovsbr_exist(sw_name):
-            run_command("ovs-vsctl del-br %s" % sw_name)
+        OVSDBClient.instance().del_bridges([sw_name])
 
     @staticmethod
-    def ovs_add_port(sw_name, p_name):
-        logging.debug("Add port %s to switch %s" % (p_name, sw_name))
-        run_command("ovs-vsctl add-port %s %s" % (sw_name, p_name))
-        run_command("ip link set %s up" % p_name)
+    def ovs_add_ports(sw_name, ports):
+        logging.debug("Add ports %s to switch %s" % (ports, sw_name))
+        OVSDBClient.instance().add_ports(sw_name, ports)
+        netlink = NetlinkManager.instance()
+        for p_name, tag in ports:
+            netlink.link_set_state(p_name, "up")
+
+    @classmethod
+    def ovs_add_port(cls, sw_name, p_name):
+        cls.ovs_add_ports(sw_name, [(p_name, None)])
 
     @staticmethod
     def ovs_port_vlan(p_name, vlan):
         logging.debug("Set port %s to belong to vlan %s" % (p_name, vlan))
-        run_command("ovs-vsctl set port %s tag=%s" % (p_name, vlan))
+        OVSDBClient.instance().set_port_tag(p_name, vlan)
 
     @staticmethod
-    def ovs_del_port(sw_name, p_name):
-        logging.debug("Delete port %s from switch %s" % (p_name, sw_name))
-        run_command("ovs-vsctl del-port %s %s" % (sw_name, p_name))
+    def ovs_del_ports(sw_name, p_names):
+        logging.debug("Delete ports %s from switch %s" % (p_names, sw_name))
+        OVSDBClient.instance().del_ports(sw_name, p_names)
 
     @classmethod
-    def clean(cls, prj_id):
+    def ovs_del_port(cls, sw_name, p_name):
+        cls.ovs_del_ports(sw_name, [p_name])
+
+    @staticmethod
+    def apply(prj_id, state):
+        """
+        Reconcile the objects of the project with the desired state
+        {"switches": {name: {port: tag}}, "bridges": {name: [members]},
+         "links": [[if1, if2]], "netns": [names]}
+        """
+        logging.debug("Apply state of project %s" % prj_id)
+        check_apply_state(prj_id, state)
+        switches = state.get("switches", {})
+        bridges = state.get("bridges", {})
+        links = state.get("links", [])
+
+        changes, added_ports = OVSDBClient.instance().reconcile(
+            prj_id, switches)
+        netlink = NetlinkManager.instance()
+        changes.update(netlink.netns_reconcile(state.get("netns", [])))
+        changes.update(netlink.reconcile(prj_id, bridges, links))
+        for p_name in added_ports:
+            if netlink.link_exists(p_name):
+                netlink.link_set_state(p_name, "up")
+        logging.info("Apply state of project %s: %s" % (prj_id, changes))
+        return changes
+
+    @staticmethod
+    def clean(prj_id):
         logging.debug("Clean project %s" % prj_id)
-        # remove existing docker containers for this project
-        for container_name in cls.__get_container_list(prj_id):
-            cls.docker_stop(container_name)
-            cls.docker_rm(container_name)
-
-        # remove existing ovs switches
-        s_cmd = "ovs-vsctl list-br"
-        switches = run_command(s_cmd, check_output=True).split("\n")
-        for s_name in switches:
-            if s_name.startswith(prj_id):
-                cls.ovs_delete(s_name)
+        report, errors = [], []
+
+        # kill and remove docker containers of this project concurrently
+        start = time.time()
+        docker_manager = DockerManager.instance()
+        containers = docker_manager.get_container_names(prj_id)
+        errors.extend(docker_manager.remove_all(containers))
+        report.append("%d containers removed in %.2fs"
+                      % (len(containers), time.time() - start))
+        report_progress(report[-1])
+        check_cancelled()
+
+        # remove existing ovs switches in one transaction
+        start = time.time()
+        ovsdb = OVSDBClient.instance()
+        switches = [s for s in ovsdb.list_bridges() if s.startswith(prj_id)]
+        try:
+            ovsdb.del_bridges(switches)
+        except NetemError as err:
+            errors.append("%s" % err)
+        report.append("%d switches removed in %.2fs"
+                      % (len(switches), time.time() - start))
+        report_progress(report[-1])
+        check_cancelled()
 
         # delete remaining links
-        with IPDB() as ipdb:
-            for if_name in ipdb.interfaces:
-                if isinstance(if_name, int):
-                    continue
-                if if_name.startswith(prj_id):
-                    print(str(if_name))
-                    ipdb.interfaces[if_name].remove()
-            ipdb.commit()
+        start = time.time()
+        try:
+            nb_links = NetlinkManager.instance().links_delete(prj_id)
+        except NetemError as err:
+            errors.append("%s" % err)
+            nb_links = 0
+        report.append("%d links removed in %.2fs"
+                      % (nb_links, time.time() - start))
+
+        report = ", ".join(report)
+        logging.info("Clean project %s: %s" % (prj_id, report))
+        if len(errors) > 0:
+            raise NetemError("Unable to clean project %s properly (%s):\n\t%s"
+                             % (prj_id, report, "\n\t".join(errors)))
+        return report
 
     @staticmethod
     def chown(host_path, uid, gid):
@@ -412,11 +824,21 @@ class NetemDaemonHandler(BaseRequestHandler):
         cmd = "chown -R %s:%s \"%s\"" % (uid, gid, host_path)
         run_command(cmd)
 
-    @staticmethod
-    def __get_container_list(prefix):
-        d_cmd = "docker container list --format '{{.Names}}' --all"
-        containers = run_command(d_cmd, check_output=True).split("\n")
-        return [c for c in containers if c.startswith(prefix)]
+
+class NetemDaemonServer(ThreadingMixIn, UnixStreamServer):
+    # each client session is served by its own thread
+    daemon_threads = True
+
+    def __init__(self, socket, workers):
+        super(NetemDaemonServer, self).__init__(socket, NetemDaemonHandler)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.locks = ResourceLocks()
+        self.stats = DaemonStats()
+        self.jobs = JobRegistry()
+
+    def server_close(self):
+        super(NetemDaemonServer, self).server_close()
+        self.executor.shutdown(wait=False)
 
 
 class NetemDaemonThread(threading.Thread):
@@ -426,12 +848,25 @@ class NetemDaemonThread(threading.Thread):
 
         self.__server = None
         self.__socket = socket
+        self.__workers = NetemConfig.instance().getint("daemon", "workers")
+        self.__veth_pool = NetemConfig.instance().getint(
+            "daemon", "veth_pool")
         self.running = False
 
     def run(self):
         self.running = True
-        self.__server = UnixStreamServer(self.__socket, NetemDaemonHandler)
+        self.__server = NetemDaemonServer(self.__socket, self.__workers)
         os.chmod(self.__socket, 0o666)
+        # load the docker inventory before the first request
+        try:
+            DockerManager.instance()
+        except NetemError as err:
+            logging.warning("Docker engine is not available: %s" % err)
+        # prepare veth pairs for the first link creations
+        try:
+            NetlinkManager.instance().start_pool(self.__veth_pool)
+        except NetemError as err:
+            logging.warning("Unable to start the veth pool: %s" % err)
 
         logging.info("Start pynetem daemon")
         self.__server.serve_forever()
@@ -440,5 +875,7 @@ class NetemDaemonThread(threading.Thread):
         if self.__server is not None:
             logging.info("Stop pynetem daemon")
             self.__server.shutdown()
+            self.__server.server_close()
             self.__server = None
+            NetlinkManager.instance().stop_pool()
         self.running = False
@@ -0,0 +1,123 @@
+# pynetem: network emulator
+# Copyright (C) 2015-2021 Mickael Royer <mickael.royer@recherche.enac.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import time
+import threading
+from contextlib import contextmanager
+
+# upper bounds (in ms) of the latency histogram buckets
+LATENCY_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+_local = threading.local()
+
+
+def count_spawn():
+    """Record a child process launched by the current command"""
+    _local.spawns = getattr(_local, "spawns", 0) + 1
+
+
+def bucket_name(idx):
+    if idx < len(LATENCY_BUCKETS):
+        return "<=%dms" % LATENCY_BUCKETS[idx]
+    return ">%dms" % LATENCY_BUCKETS[-1]
+
+
+class CommandStats(object):
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.spawns = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, duration, error, spawns):
+        self.count += 1
+        self.spawns += spawns
+        if error:
+            self.errors += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+        latency, idx = duration * 1000, 0
+        while idx < len(LATENCY_BUCKETS) and latency > LATENCY_BUCKETS[idx]:
+            idx += 1
+        self.histogram[idx] += 1
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "spawns": self.spawns,
+            "total_time": round(self.total_time, 6),
+            "mean_time": round(self.total_time / max(self.count, 1), 6),
+            "max_time": round(self.max_time, 6),
+            "histogram": dict([
+                (bucket_name(idx), nb)
+                for idx, nb in enumerate(self.histogram)
+            ]),
+        }
+
+
+class DaemonStats(object):
+    """
+    Call count, error count, latency histogram and number of
+    spawned processes of each daemon command
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__commands = {}
+        self.__since = time.time()
+
+    @contextmanager
+    def measure(self, cmd_name):
+        """
+        Measure the command executed in the block, the yielded list
+        has to receive the state of the command
+        """
+        parent_spawns = getattr(_local, "spawns", 0)
+        _local.spawns = 0
+        state = []
+        start = time.time()
+        try:
+            yield state
+        finally:
+            duration = time.time() - start
+            spawns = _local.spawns
+            # spawns of a sub command are also counted by its parent
+            _local.spawns = parent_spawns + spawns
+            error = len(state) == 0 or state[0] != "OK"
+            with self.__lock:
+                if cmd_name not in self.__commands:
+                    self.__commands[cmd_name] = CommandStats()
+                self.__commands[cmd_name].add(duration, error, spawns)
+
+    def show(self):
+        with self.__lock:
+            return {
+                "since": self.__since,
+                "commands": dict([
+                    (name, c_stats.to_dict())
+                    for name, c_stats in self.__commands.items()
+                ]),
+            }
+
+    def reset(self):
+        with self.__lock:
+            self.__commands = {}
+            self.__since = time.time()
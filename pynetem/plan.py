@@ -0,0 +1,209 @@
+# pynetem: network emulator
+# Copyright (C) 2015-2021 Mickael Royer <mickael.royer@recherche.enac.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import re
+import hashlib
+import threading
+from collections import namedtuple, OrderedDict
+from configobj import ConfigObj, ConfigObjError
+from pynetem import NetemError
+from pynetem.check import check_network
+from pynetem.wrapper import gen_ifname
+
+# number of compiled topologies kept in memory
+CACHE_SIZE = 16
+# first vlan tag used for p2p links
+P2P_FIRST_TAG = 10
+# peers of a node interface in the network file
+SW_PEER = re.compile(r"^sw\.(\w+)$")
+BR_PEER = re.compile(r"^br\.(\w+)$")
+NODE_PEER = re.compile(r"^(\w+)\.(\d+)$")
+
+InterfacePlan = namedtuple(
+    "InterfacePlan",
+    ["if_number", "peer_type", "peer_id", "peer_if", "ifname"])
+NodePlan = namedtuple(
+    "NodePlan", ["name", "type", "save_state", "interfaces"])
+SwitchPlan = namedtuple("SwitchPlan", ["name", "type", "full_name"])
+BridgePlan = namedtuple("BridgePlan", ["name", "host_if", "full_name"])
+
+
+class TopologyPlan(namedtuple("TopologyPlan", [
+        "digest", "prj_id", "network", "image_dir", "config_dir",
+        "lazy", "idle_timeout", "nodes", "switches", "bridges",
+        "p2p_tags"])):
+    """
+    Compiled topology. network is the parsed network file, it is shared
+    by all the users of the plan and must not be modified
+    """
+
+    def apply_state(self):
+        """
+        Desired state of the switches and bridges for the daemon apply
+        command, before nodes are started
+        """
+        return {
+            "switches": dict([(s.full_name, {}) for s in self.switches
+                              if s.type == "ovs"]),
+            "bridges": dict([(b.full_name, [b.host_if])
+                             for b in self.bridges]),
+            "links": [],
+            "netns": [],
+        }
+
+
+def parse_peer(peer_name):
+    """
+    Return (peer_type, peer_id, peer_if) for the peer of an interface,
+    peer_type is null, switch, bridge or node
+    """
+    if peer_name == "__null__":
+        return "null", None, None
+    for peer_type, regexp in (("switch", SW_PEER), ("bridge", BR_PEER)):
+        match_obj = regexp.match(peer_name)
+        if match_obj is not None:
+            return peer_type, match_obj.group(1), None
+    match_obj = NODE_PEER.match(peer_name)
+    if match_obj is None:
+        raise NetemError("%s is not a valid interface peer" % peer_name)
+    return "node", match_obj.group(1), match_obj.group(2)
+
+
+def _compile_node(prj_id, network, n_name):
+    n_config = network["nodes"][n_name]
+    interfaces = []
+    for if_number in range(n_config.as_int("if_numbers")):
+        peer_type, peer_id, peer_if = parse_peer(
+            n_config["if%d" % if_number])
+        ifname = None
+        if peer_type == "node" or (
+                peer_type == "switch"
+                and network["switches"][peer_id]["type"] == "ovs") \
+                or peer_type == "bridge":
+            ifname = gen_ifname(prj_id, n_name, if_number, peer_id, peer_if)
+        interfaces.append(InterfacePlan(
+            if_number, peer_type, peer_id, peer_if, ifname))
+
+    save_state = True
+    if "save_state" in n_config:
+        save_state = n_config.as_bool("save_state")
+    return NodePlan(n_name, n_config["type"], save_state, tuple(interfaces))
+
+
+def _compile_p2p_tags(nodes):
+    # both ends of a p2p link share a tag, allocated in the order of
+    # the network file to be the same from a load to another
+    tags, tag = {}, P2P_FIRST_TAG
+    by_name = dict([(n.name, n) for n in nodes])
+    for node in nodes:
+        for interface in node.interfaces:
+            if interface.peer_type != "node":
+                continue
+            peer = by_name[interface.peer_id]
+            peer_if = peer.interfaces[int(interface.peer_if)]
+            key = frozenset([interface.ifname, peer_if.ifname])
+            if key not in tags:
+                tags[key] = tag
+                tag += 1
+    return tags
+
+
+def _compile(prj_id, netfile, content, digest, daemon):
+    try:
+        network = ConfigObj(content.decode("utf-8").splitlines())
+    except (ConfigObjError, UnicodeDecodeError) as err:
+        raise NetemError("Syntax error in the network file: %s" % err)
+
+    # check network files before start it
+    errors = check_network(network, daemon)
+    if len(errors) > 0:
+        msg = ""
+        for e_mod in errors:
+            err_msg = "\n\t".join(errors[e_mod]["errors"])
+            msg += "%s:\n\t%s\n" % (errors[e_mod]["desc"], err_msg)
+        raise NetemError("The network file has errors\n  %s" % msg)
+
+    config = network["config"]
+    switches = network.get("switches", {})
+    bridges = network.get("bridges", {})
+    nodes = tuple([_compile_node(prj_id, network, n)
+                   for n in network.get("nodes", {})])
+    return TopologyPlan(
+        digest=digest,
+        prj_id=prj_id,
+        network=network,
+        image_dir=os.path.join(os.path.dirname(netfile), config["image_dir"]),
+        config_dir=os.path.join(
+            os.path.dirname(netfile), config["config_dir"]),
+        lazy="lazy" in config and config.as_bool("lazy"),
+        idle_timeout="idle_timeout" in config
+        and config.as_int("idle_timeout") or 0,
+        nodes=nodes,
+        switches=tuple([
+            SwitchPlan(s, switches[s]["type"], "%s.%s" % (prj_id, s))
+            for s in switches]),
+        bridges=tuple([
+            BridgePlan(b, bridges[b]["host_if"], "%s.%s" % (prj_id, b))
+            for b in bridges]),
+        p2p_tags=_compile_p2p_tags(nodes))
+
+
+class PlanCache(object):
+    """
+    Compiled topologies indexed by a hash of the network file, a plan
+    is compiled and checked once for a given content
+    """
+    __instance = None
+
+    @classmethod
+    def instance(cls):
+        if cls.__instance is None:
+            cls.__instance = cls()
+        return cls.__instance
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__plans = OrderedDict()
+
+    def compile(self, prj_id, netfile, daemon):
+        try:
+            with open(netfile, "rb") as hdl:
+                content = hdl.read()
+        except IOError as err:
+            raise NetemError("Unable to read the network file: %s" % err)
+        digest = hashlib.sha256(
+            b"\0".join([prj_id.encode("utf-8"),
+                        os.path.abspath(netfile).encode("utf-8"),
+                        content])).hexdigest()
+
+        with self.__lock:
+            plan = self.__plans.get(digest)
+            if plan is not None:
+                self.__plans.move_to_end(digest)
+                return plan
+
+        plan = _compile(prj_id, netfile, content, digest, daemon)
+        with self.__lock:
+            self.__plans[digest] = plan
+            while len(self.__plans) > CACHE_SIZE:
+                self.__plans.popitem(last=False)
+        return plan
+
+    def clear(self):
+        with self.__lock:
+            self.__plans.clear()
@@ -112,8 +112,11 @@ class NetemProject(object):
         except Exception as ex:
             logging.error("Unable to close the project properly: %s" % ex)
         # what happen before, clean the project
-        self.daemon.clean(self.get_id())
+        # clean is run by the daemon while the tmp folder is removed
+        job = self.daemon.submit("clean", self.get_id())
         shutil.rmtree(self.tmp_folder)
+        report = job.wait()
+        logging.debug("Project %s cleaned: %s" % (self.get_id(), report))
 
     def __strip_path(self, path):
         return path.replace(self.tmp_folder, "")
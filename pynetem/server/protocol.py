@@ -120,6 +120,10 @@ class NetemProtocol(asyncio.Protocol):
     def do_reload(self):
         self.project.topology.reload()
 
+    @cmd()
+    def do_update(self):
+        self.project.topology.update()
+
     @cmd()
     def do_save(self):
         self.project.save()
@@ -140,6 +144,7 @@ class NetemProtocol(asyncio.Protocol):
                 raise NetemError("Node {} does not exist".format(name))
             elif node.get_type() != "node.docker":
                 raise NetemError("Copy cmd works only with docker nodes")
+            self.project.topology.touch(node)
             return node
 
         s_type, s_name, s_path = get_path_type(source)
@@ -213,6 +218,7 @@ class NetemProtocol(asyncio.Protocol):
         if len(nodes) == 0:
             raise NetemError("Node '%s' does not exist" % node_id)
         for node in nodes:
+            self.project.topology.touch(node)
             node.open_shell(bash=bash)
 
     @cmd(cmd_args=[r"^\S+$"])
@@ -234,7 +240,7 @@ class NetemProtocol(asyncio.Protocol):
             nodes = []
             n_ids = arg.split()
             for n_id in n_ids:
-                node = self.project.topology.get_node(arg)
+                node = self.project.topology.get_node(n_id)
                 if node is not None:
                     nodes.append(node)
             return nodes
@@ -16,17 +16,106 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import os
-import re
+import time
 import logging
-from configobj import ConfigObj, ConfigObjError
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pynetem import NetemError
-from pynetem.check import check_network
+from pynetem.plan import PlanCache
 from pynetem.signals import ALL_SIGNALS
+from pynetem.ui.config import NetemConfig
 from pynetem.wrapper.switch import build_sw_instance
 from pynetem.wrapper.node import build_node_instance
 from pynetem.wrapper.p2p import NetemP2PSwitch
 from pynetem.wrapper.bridge import BridgeInstance
 
+# instances created by the daemon apply command
+STATE_TYPES = ("switch.ovs", "bridge")
+# max period (in s) between two checks of idle nodes in lazy mode
+IDLE_CHECK_PERIOD = 10
+
+
+def diff_sections(old, new, ignore=()):
+    """
+    Compare two sections of the network file, return the lists of
+    added, removed and changed entries
+    """
+    def entry(section, name):
+        conf = section[name].dict()
+        for key in ignore:
+            conf.pop(key, None)
+        return conf
+
+    added = [name for name in new if name not in old]
+    removed = [name for name in old if name not in new]
+    changed = [name for name in new if name in old
+               and entry(old, name) != entry(new, name)]
+    return added, removed, changed
+
+
+class TopologyRegistry(object):
+    """
+    Instances of the topology indexed by name and table of the links
+    between node interfaces and their peers
+    """
+
+    def __init__(self):
+        self.nodes, self.switches, self.bridges = {}, {}, {}
+        # (node name, if number) -> interface plan
+        self.links = {}
+        # (type, name) of a switch/bridge/node -> connected nodes
+        self.adjacency = {}
+
+    def add_node(self, instance):
+        self.nodes[instance.get_name()] = instance
+
+    def add_switch(self, instance):
+        self.switches[instance.get_name()] = instance
+
+    def add_bridge(self, instance):
+        self.bridges[instance.get_name()] = instance
+
+    def remove_node(self, name):
+        return self.nodes.pop(name)
+
+    def remove_switch(self, name):
+        return self.switches.pop(name)
+
+    def remove_bridge(self, name):
+        return self.bridges.pop(name)
+
+    def set_links(self, plan):
+        self.links, self.adjacency = {}, {}
+        for n_plan in plan.nodes:
+            for interface in n_plan.interfaces:
+                self.links[(n_plan.name, interface.if_number)] = interface
+                if interface.peer_id is None:
+                    continue
+                self.adjacency.setdefault(
+                    (interface.peer_type, interface.peer_id),
+                    set()).add(n_plan.name)
+                if interface.peer_type == "node":
+                    self.adjacency.setdefault(
+                        ("node", n_plan.name), set()).add(interface.peer_id)
+
+    def get_links(self, n_name):
+        links, if_number = [], 0
+        while (n_name, if_number) in self.links:
+            links.append(self.links[(n_name, if_number)])
+            if_number += 1
+        return links
+
+    def get_peer_instance(self, peer_type, peer_id):
+        return {
+            "switch": self.switches,
+            "bridge": self.bridges,
+            "node": self.nodes,
+        }[peer_type].get(peer_id)
+
+    def get_neighbours(self, peer_type, name):
+        """Return the names of the nodes connected to a switch/bridge/node"""
+        return self.adjacency.get((peer_type, name), set())
+
 
 class TopologyManager(object):
 
@@ -36,10 +125,19 @@ class TopologyManager(object):
         self.daemon = daemon
         self.p2p_switch = NetemP2PSwitch(prj_id)
         self.signal = ALL_SIGNALS["node"]
+        self.workers = NetemConfig.instance().getint("topology", "workers")
+        self.__junos_slots = threading.BoundedSemaphore(
+            NetemConfig.instance().getint("topology", "junos_workers"))
 
         self.saved_state = []
         self.is_loaded = False
-        self.nodes, self.switches, self.bridges = [], [], []
+        self.plan = None
+        self.registry = TopologyRegistry()
+        # lazy mode: last use of the nodes and stop event of the thread
+        # which stops idle nodes
+        self.__lock = threading.RLock()
+        self.__last_use = {}
+        self.__idle_stop = None
 
     def load(self):
         if not self.is_loaded:
@@ -47,132 +145,279 @@ class TopologyManager(object):
             self.is_loaded = True
 
     def check(self):
-        try:
-            network = ConfigObj(self.netfile)
-        except ConfigObjError as err:
-            raise NetemError("Syntax error in the network file: %s" % err)
-
-        # first, be sure we can record images and configs
-        image_dir = os.path.join(
-            os.path.dirname(self.netfile), network["config"]["image_dir"])
-        config_dir = os.path.join(
-            os.path.dirname(self.netfile), network["config"]["config_dir"])
-        for path in (image_dir, config_dir):
+        """
+        Return the compiled plan of the network file, the file is parsed
+        and checked only when its content changes
+        """
+        plan = PlanCache.instance().compile(
+            self.prj_id, self.netfile, self.daemon)
+        # be sure we can record images and configs
+        for path in (plan.image_dir, plan.config_dir):
             if not os.path.isdir(path):
                 os.mkdir(path)
+        return plan
 
-        # check network files before start it
-        errors = check_network(network, self.daemon)
-        if len(errors) > 0:
-            msg = ""
-            for e_mod in errors:
-                err_msg = "\n\t".join(errors[e_mod]["errors"])
-                msg += "%s:\n\t%s\n" % (errors[e_mod]["desc"], err_msg)
-            raise NetemError("The network file has errors\n  %s" % msg)
-
-        return network
-
-    def __load_switches(self, sw_section):
-        for s_name in sw_section:
+    def __load_switches(self, sw_section, names, start=False):
+        for s_name in names:
             s_inst = build_sw_instance(self.prj_id, s_name, sw_section[s_name])
-            s_inst.start()
-            self.switches.append(s_inst)
+            # ovs switches are created by __apply_state at load
+            if start or s_inst.get_type() not in STATE_TYPES:
+                s_inst.start()
+            self.registry.add_switch(s_inst)
 
-    def __load_bridges(self, br_section):
-        for br_name in br_section:
+    def __load_bridges(self, br_section, names, start=False):
+        for br_name in names:
             br = BridgeInstance(self.prj_id, br_name, br_section[br_name])
-            br.start()
-            self.bridges.append(br)
-
-    def __load_nodes(self, network):
-        nodes_section = network["nodes"]
-        image_dir = os.path.join(
-            os.path.dirname(self.netfile), network["config"]["image_dir"])
-        config_dir = os.path.join(
-            os.path.dirname(self.netfile), network["config"]["config_dir"])
-
-        for n_name in nodes_section:
-            n_inst = build_node_instance(
-                self.prj_id, self.p2p_switch,
-                image_dir, config_dir, n_name, nodes_section[n_name])
-
-            self.nodes.append(n_inst)
-
-            # record save_state option
-            need_save = True
-            if "save_state" in nodes_section[n_name]:
-                need_save = nodes_section[n_name].as_bool("save_state")
-            if need_save:
-                self.saved_state.append(n_inst)
-
-        # load nodes connections and start node
-        for n_name in nodes_section:
+            if start:
+                br.start()
+            self.registry.add_bridge(br)
+
+    def __apply_state(self):
+        # switches and bridges are created/updated in one daemon request
+        state = self.plan.apply_state()
+        self.p2p_switch.fill_state(state)
+        instances = [i for i in self.__get_sw_bridges()
+                     if i.get_type() in STATE_TYPES]
+        changes = self.daemon.apply(self.prj_id, state)
+        logging.debug("Topology state applied: %s" % changes)
+        for instance in instances:
+            instance.set_started()
+
+    def __load_nodes(self, plan, n_names):
+        nodes_section = plan.network["nodes"]
+
+        # create node instances (containers, disk images) in parallel
+        def create_node(n_name):
+            return build_node_instance(
+                self.prj_id, self.p2p_switch, plan.image_dir,
+                plan.config_dir, n_name, nodes_section[n_name])
+
+        results, errors = self.__run_parallel(create_node, n_names, n_names)
+        # keep created nodes to be able to clean them
+        for n_inst in results:
+            if n_inst is not None:
+                self.registry.add_node(n_inst)
+        self.__update_saved_state(plan)
+        if len(errors) > 0:
+            raise NetemError("\n".join(errors))
+
+        # load nodes connections
+        self.registry.set_links(plan)
+        for n_name in n_names:
             n_inst = self.get_node(n_name)
-            nb_if = nodes_section[n_name].as_int("if_numbers")
-            for i in range(nb_if):
-                if_name = "if%d" % i
-                peer_name = nodes_section[n_name][if_name]
-                if peer_name == "__null__":
+            for interface in self.registry.get_links(n_name):
+                if interface.peer_type == "null":
                     n_inst.add_null_if()
-                elif peer_name.startswith("sw."):
-                    (s_name,) = re.match("^sw\.(\w+)$", peer_name).groups()
-                    n_inst.add_sw_if(self.get_switch(s_name))
-                elif peer_name.startswith("br."):
-                    (br_name,) = re.match("^br\.(\w+)$", peer_name).groups()
-                    n_inst.add_br_if(self.get_bridge(br_name))
+                    continue
+                peer = self.registry.get_peer_instance(
+                    interface.peer_type, interface.peer_id)
+                if interface.peer_type == "switch":
+                    n_inst.add_sw_if(peer)
+                elif interface.peer_type == "bridge":
+                    n_inst.add_br_if(peer)
                 else:  # this is a connection to a node
-                    p_id, p_if = re.match("^(\w+)\.(\d+)$",
-                                            peer_name).groups()
-                    n_inst.add_node_if(self.get_node(p_id), p_if)
+                    n_inst.add_node_if(peer, interface.peer_if)
+
+        # start nodes, in lazy mode they start when they are used
+        if not plan.lazy:
+            self.__start_nodes([self.get_node(n) for n in n_names])
+
+    def __update_saved_state(self, plan):
+        # record save_state option
+        self.saved_state = [
+            self.get_node(n.name) for n in plan.nodes
+            if n.save_state and self.get_node(n.name) is not None]
+
+    def __node_dependencies(self, node):
+        # switches and bridges must be running before the node start.
+        # Links with other nodes only share the p2p switch, which is
+        # always running, and a tag allocated for the pair of interfaces
+        deps = []
+        for interface in self.registry.get_links(node.get_name()):
+            if interface.peer_type in ("switch", "bridge"):
+                peer = self.registry.get_peer_instance(
+                    interface.peer_type, interface.peer_id)
+                if peer is not None:
+                    deps.append(peer)
+        return deps
+
+    def __start_nodes(self, nodes):
+        def start_node(node):
+            for dep in self.__node_dependencies(node):
+                if not dep.is_running():
+                    raise NetemError("%s is not running" % dep.get_name())
+            self.__start_node(node)
 
-            self.__start_node(n_inst)
+        _, errors = self.__run_parallel(
+            start_node, nodes, [n.get_name() for n in nodes], progress="node")
+        if len(errors) > 0:
+            raise NetemError("\n".join(errors))
+
+    def __run_parallel(self, func, items, names, progress=None):
+        """
+        Call func for each item on a bounded pool of threads, return the
+        results in the order of items (None on error) and the errors.
+        Signals are sent from the calling thread since the transports of
+        the clients are not thread safe
+        """
+        results, errors = [None] * len(items), []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = dict([
+                (executor.submit(func, item), idx)
+                for idx, item in enumerate(items)])
+            for done, future in enumerate(as_completed(futures), 1):
+                idx, state = futures[future], "loaded"
+                try:
+                    results[idx] = future.result()
+                except NetemError as ex:
+                    errors.append("%s: %s" % (names[idx], ex))
+                    state = "error"
+                if progress is not None:
+                    self.__send_signal(
+                        type=progress, state="progress", node=names[idx],
+                        node_state=state, done=done, total=len(items))
+        return results, errors
 
     def __load(self):
         logging.debug("Start to load topology")
-        network = self.check()
+        self.plan = self.check()
+        network = self.plan.network
+        self.p2p_switch.set_tags(self.plan.p2p_tags)
 
         def load_sw_bridge():
             if "switches" in network:
-                self.__load_switches(network["switches"])
+                self.__load_switches(
+                    network["switches"], list(network["switches"]))
             if "bridges" in network:
-                self.__load_bridges(network["bridges"])
+                self.__load_bridges(
+                    network["bridges"], list(network["bridges"]))
+            self.__apply_state()
 
         self.__signaling_cmd({"type": "switch_bridge"}, load_sw_bridge)
 
-        if "nodes" in network:
-            # load nodes
-            self.__signaling_cmd({"type": "node"}, self.__load_nodes, network)
+        if len(self.plan.nodes) > 0:
+            self.__start_new_nodes([n.name for n in self.plan.nodes])
+        if self.plan.lazy and self.plan.idle_timeout > 0:
+            self.__start_idle_watcher(self.plan.idle_timeout)
+
+    def __start_new_nodes(self, n_names):
+        # load nodes
+        self.__signaling_cmd(
+            {"type": "node"}, self.__load_nodes, self.plan, n_names)
+
+        # load configuration
+        j_nodes = [self.get_node(n) for n in n_names]
+        j_nodes = [n for n in j_nodes
+                   if n is not None and n.get_type() == "node.junos"]
+        if len(j_nodes) > 0:
+            self.__signaling_cmd(
+                {"type": "config"},
+                lambda: [self.__load_configuration(n) for n in j_nodes])
+
+    def update(self):
+        """
+        Apply the changes of the network file to the running topology.
+        Only new or modified nodes, switches and bridges are (re)built,
+        the other nodes keep running
+        """
+        # the idle watcher must not stop a node which is rebuilt
+        with self.__lock:
+            self.__update()
+
+    def __update(self):
+        if not self.is_loaded:
+            return self.load()
+        plan = self.check()
+        if plan.digest == self.plan.digest:
+            return  # nothing has changed
+        network, old_network = plan.network, self.plan.network
+        if network["config"].dict() != old_network["config"].dict():
+            # image and config dirs are used by all nodes
+            return self.reload()
+
+        sw_add, sw_del, sw_mod = diff_sections(
+            old_network.get("switches", {}), network.get("switches", {}))
+        br_add, br_del, br_mod = diff_sections(
+            old_network.get("bridges", {}), network.get("bridges", {}))
+        n_add, n_del, n_mod = diff_sections(
+            old_network.get("nodes", {}), network.get("nodes", {}),
+            ignore=("save_state",))
+
+        # nodes connected to a rebuilt switch/bridge have to be rewired
+        n_mod = set(n_mod)
+        for name in sw_del + sw_mod:
+            n_mod |= self.registry.get_neighbours("switch", name)
+        for name in br_del + br_mod:
+            n_mod |= self.registry.get_neighbours("bridge", name)
+        n_mod -= set(n_del)
+        logging.debug(
+            "Update topology: nodes +%s -%s ~%s, switches +%s -%s ~%s, "
+            "bridges +%s -%s ~%s" % (n_add, n_del, sorted(n_mod), sw_add,
+                                     sw_del, sw_mod, br_add, br_del, br_mod))
+
+        # remove old nodes, switches and bridges
+        old_nodes = [self.registry.remove_node(n)
+                     for n in n_del + sorted(n_mod)]
+        _, errors = self.__run_parallel(
+            self.__clean_node, old_nodes, [n.get_name() for n in old_nodes])
+        for name in sw_del + sw_mod:
+            self.registry.remove_switch(name).stop()
+        for name in br_del + br_mod:
+            self.registry.remove_bridge(name).stop()
+        for error in errors:
+            logging.error(error)
 
-            # load configuration
-            j_nodes = [n for n in self.nodes if n.get_type() == "node.junos"]
-            if len(j_nodes) > 0:
-                self.__signaling_cmd(
-                    {"type": "config"},
-                    lambda: [self.__load_configuration(n) for n in j_nodes])
+        def load_sw_bridge():
+            self.__load_switches(
+                network.get("switches", {}), sw_add + sw_mod, start=True)
+            self.__load_bridges(
+                network.get("bridges", {}), br_add + br_mod, start=True)
+
+        if len(sw_add + sw_mod + br_add + br_mod) > 0:
+            self.__signaling_cmd({"type": "switch_bridge"}, load_sw_bridge)
+        self.plan = plan
+
+        n_new = set(n_add) | n_mod
+        n_names = [n.name for n in plan.nodes if n.name in n_new]
+        if len(n_names) > 0:
+            self.__start_new_nodes(n_names)
+        else:
+            self.registry.set_links(plan)
+            self.__update_saved_state(plan)
 
     def get_switch(self, sw_name):
-        for instance in self.switches:
-            if instance.get_name() == sw_name:
-                return instance
-        return None
+        return self.registry.switches.get(sw_name)
 
     def get_bridge(self, br_name):
-        for instance in self.bridges:
-            if instance.get_name() == br_name:
-                return instance
-        return None
+        return self.registry.bridges.get(br_name)
 
     def get_all_switches(self):
-        return self.switches
+        return list(self.registry.switches.values())
 
     def get_node(self, name):
-        return next((i for i in self.nodes if i.get_name() == name), None)
+        return self.registry.nodes.get(name)
 
     def get_all_nodes(self):
-        return self.nodes
+        return list(self.registry.nodes.values())
+
+    def __get_sw_bridges(self):
+        return self.get_all_switches() + \
+            list(self.registry.bridges.values())
+
+    def touch(self, node):
+        """
+        Record the use of a node (console, shell, capture, copy...). In
+        lazy mode, the node is started on its first use
+        """
+        with self.__lock:
+            self.__last_use[node.get_name()] = time.time()
+            if self.plan is not None and self.plan.lazy \
+                    and not node.is_running():
+                self.start(node.get_name())
 
     def capture(self, if_id):
         node, if_number = self.__get_node_if(if_id)
+        self.touch(node)
         node.capture(if_number)
 
     def set_if_state(self, if_id, state):
@@ -187,45 +432,108 @@ class TopologyManager(object):
     def start(self, name):
         node = self.get_node(name)
         if node is not None:
-            self.__start_node(node)
-            if node.get_type() == "node.junos":
-                self.__load_configuration(node)
+            with self.__lock:
+                self.__last_use[name] = time.time()
+                self.__start_node(node)
+                if node.get_type() == "node.junos":
+                    self.__load_configuration(node)
 
     def stopall(self):
-        for n in self.nodes:
-            try:
-                self.__stop_node(n)
-            except NetemError as ex:
-                logging.error(str(ex))
-        for s in self.switches:
-            s.stop()
-        for b in self.bridges:
-            b.stop()
+        self.__teardown(self.__stop_node)
 
     def reload(self):
+        self.__stop_idle_watcher()
         if self.is_loaded:
-            self.stopall()
-            for n in self.nodes:
-                n.clean()
+            self.__teardown(self.__clean_node)
 
-        self.nodes, self.switches, self.bridges = [], [], []
+        self.registry = TopologyRegistry()
         self.saved_state = []
+        self.plan = None
         self.__load()
         self.is_loaded = True
 
     def save(self, conf_path=None):
-        for n in self.saved_state:
-            n.save(conf_path=conf_path)
+        nodes = self.saved_state
+        if self.plan is not None and self.plan.lazy:
+            # other nodes are not started or have been saved when idle
+            nodes = [n for n in nodes if n.is_running()]
+
+        _, errors = self.__run_parallel(
+            lambda node: self.__save_node(node, conf_path),
+            nodes, [n.get_name() for n in nodes])
+        if len(errors) > 0:
+            raise NetemError(
+                "Unable to save some nodes:\n\t%s" % "\n\t".join(errors))
+
+    def __save_node(self, node, conf_path=None):
+        if node.get_type() == "node.junos":
+            # the number of telnet sessions is limited
+            with self.__junos_slots:
+                node.save(conf_path=conf_path)
+        else:
+            node.save(conf_path=conf_path)
 
     def get_nodes_status(self):
-        return [n.get_status() for n in self.nodes]
+        return [n.get_status() for n in self.get_all_nodes()]
 
     def close(self):
-        self.stopall()
-        for node in self.nodes:
-            node.clean()
+        self.__stop_idle_watcher()
+        self.__teardown(self.__clean_node)
         self.p2p_switch.close()
 
+    def __start_idle_watcher(self, timeout):
+        self.__idle_stop = threading.Event()
+        watcher = threading.Thread(
+            target=self.__watch_idle_nodes, args=(self.__idle_stop, timeout))
+        watcher.daemon = True
+        watcher.start()
+
+    def __stop_idle_watcher(self):
+        if self.__idle_stop is not None:
+            # wait for the end of a running idle stop
+            with self.__lock:
+                self.__idle_stop.set()
+            self.__idle_stop = None
+
+    def __watch_idle_nodes(self, stop_event, timeout):
+        while not stop_event.wait(min(timeout, IDLE_CHECK_PERIOD)):
+            for node in self.get_all_nodes():
+                with self.__lock:
+                    if stop_event.is_set():
+                        return
+                    last_use = self.__last_use.get(node.get_name(), 0)
+                    if not node.is_running() \
+                            or time.time() - last_use < timeout:
+                        continue
+                    logging.info("Stop idle node %s" % node.get_name())
+                    try:
+                        # the configuration is pushed again at start
+                        if node in self.saved_state:
+                            self.__save_node(node)
+                        self.__stop_node(node)
+                    except NetemError as ex:
+                        logging.error("Unable to stop idle node %s: %s"
+                                      % (node.get_name(), ex))
+
+    def __teardown(self, node_func):
+        # switches and bridges are stopped first, each one detaches all
+        # its interfaces in one batch and nodes only remove their links
+        for instance in self.__get_sw_bridges():
+            try:
+                instance.stop()
+            except NetemError as ex:
+                logging.error(str(ex))
+        try:
+            self.p2p_switch.delete_connections()
+        except NetemError as ex:
+            logging.error(str(ex))
+
+        nodes = self.get_all_nodes()
+        _, errors = self.__run_parallel(
+            node_func, nodes, [n.get_name() for n in nodes])
+        for error in errors:
+            logging.error(error)
+
     def __send_signal(self, **kwargs):
         self.signal.send(self, name="node", attrs=kwargs)
 
@@ -249,6 +557,10 @@ class TopologyManager(object):
             return
         node.stop()
 
+    def __clean_node(self, node):
+        # nodes stop themselves if needed
+        node.clean()
+
     def __load_configuration(self, node):
         if node.is_running():
             node.load_configuration()
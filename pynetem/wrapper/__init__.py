@@ -25,6 +25,20 @@ from pynetem.signals import ALL_SIGNALS
 from pynetem.daemon.client import NetemDaemonClient
 
 
+def short_name(name):
+    if len(name) > 2:
+        return name[:2] + name[-1]
+    return name
+
+
+def gen_ifname(prj_id, name, if_id, peer_name, p_if=None):
+    ifname = "{}{}{}.{}".format(
+        prj_id, short_name(name), if_id, short_name(peer_name))
+    if p_if is not None:
+        ifname += "{}".format(p_if)
+    return ifname
+
+
 class _BaseWrapper(object):
 
     def __init__(self, prj_id):
@@ -56,19 +70,11 @@ class _BaseWrapper(object):
         raise NotImplementedError
 
     def gen_ifname(self, if_id, peer, p_if=None):
-        name = "{}{}{}.{}".format(
-            self.prj_id,
-            self.short(self.get_name()),
-            if_id, self.short(peer.get_name())
-        )
-        if p_if is not None:
-            name += "{}".format(p_if)
-        return name
+        return gen_ifname(
+            self.prj_id, self.get_name(), if_id, peer.get_name(), p_if)
 
     def short(self, name):
-        if len(name) > 2:
-            return name[:2] + name[-1]
-        return name
+        return short_name(name)
 
     def clean(self):
         pass
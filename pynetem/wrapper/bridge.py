@@ -16,6 +16,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import logging
+import threading
 from pynetem.wrapper import _BaseWrapper
 
 
@@ -28,6 +29,8 @@ class BridgeInstance(_BaseWrapper):
         self.__is_started = False
         self.__host_interface = config["host_if"]
         self.__br_interfaces = []
+        # interfaces of several nodes can be attached in parallel
+        self.__lock = threading.Lock()
         self.__br_name = "%s.%s" % (prj_id, name)
 
     def get_type(self):
@@ -40,14 +43,37 @@ class BridgeInstance(_BaseWrapper):
         return self.__is_started
 
     def attach_interface(self, if_name):
-        if self.__is_started and if_name not in self.__br_interfaces:
-            self.daemon.br_addif(self.__br_name, if_name)
-            self.__br_interfaces.append(if_name)
+        with self.__lock:
+            if not self.__is_started or if_name in self.__br_interfaces:
+                return
+        self.daemon.br_addif(self.__br_name, if_name)
+        # the interface is recorded once its transaction has been committed
+        self.daemon.on_commit(lambda: self.__add_interface(if_name))
 
     def detach_interface(self, if_name):
-        if self.__is_started and if_name in self.__br_interfaces:
-            self.daemon.br_delif(self.__br_name, if_name)
-            self.__br_interfaces.remove(if_name)
+        with self.__lock:
+            if not self.__is_started or if_name not in self.__br_interfaces:
+                return
+        self.daemon.br_delif(self.__br_name, if_name)
+        self.daemon.on_commit(lambda: self.__remove_interface(if_name))
+
+    def __add_interface(self, if_name):
+        with self.__lock:
+            if if_name not in self.__br_interfaces:
+                self.__br_interfaces.append(if_name)
+
+    def __remove_interface(self, if_name):
+        with self.__lock:
+            if if_name in self.__br_interfaces:
+                self.__br_interfaces.remove(if_name)
+
+    def fill_state(self, state):
+        # desired state of the bridge for the daemon apply command
+        state["bridges"][self.__br_name] = \
+            [self.__host_interface] + self.__br_interfaces
+
+    def set_started(self):
+        self.__is_started = True
 
     def start(self):
         if self.__is_started:
@@ -62,9 +88,11 @@ class BridgeInstance(_BaseWrapper):
 
     def stop(self):
         if self.__is_started:
-            for if_name in self.__br_interfaces:
-                self.daemon.br_delif(self.__br_name, if_name)
-            self.daemon.br_delif(self.__br_name, self.__host_interface)
-            self.daemon.br_delete(self.__br_name)
+            # all the interfaces are detached in one batch
+            with self.daemon.transaction(rollback=False):
+                for if_name in self.__br_interfaces:
+                    self.daemon.br_delif(self.__br_name, if_name)
+                self.daemon.br_delif(self.__br_name, self.__host_interface)
+                self.daemon.br_delete(self.__br_name)
             self.__is_started = False
             self.__br_interfaces = []
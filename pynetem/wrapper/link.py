@@ -16,66 +16,108 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import logging
+import threading
+from pynetem import NetemError
 from pynetem.wrapper import _BaseWrapper
 
 
 class NetemLinkFactory(_BaseWrapper):
     __instance = None
+    __instance_lock = threading.Lock()
 
     @classmethod
     def instance(cls):
-        if cls.__instance is None:
-            cls.__instance = cls()
+        with cls.__instance_lock:
+            if cls.__instance is None:
+                cls.__instance = cls()
         return cls.__instance
 
     def __init__(self):
         super(NetemLinkFactory, self).__init__(None)
         self.__links = []
         self.__ns_list = []
+        # links of several nodes can be created in parallel
+        self.__lock = threading.RLock()
 
-    def create(self, ifname, ns):
-        if self.__is_exists(ifname):
-            logging.warning("Links %s already exist" % ifname)
-            return
-        # create the link
+    def create(self, ifname, ns, target_if=None):
+        with self.__lock:
+            if self.__is_exists(ifname):
+                logging.warning("Links %s already exist" % ifname)
+                return
+        # create the link and attach it to net namespace in one batch
         p_ifname = self.__peer_ifname(ifname)
-        self.daemon.link_create(ifname, self.__peer_ifname(ifname))
-        self.__links.append({"ifname": ifname, "ns": ns})
-        # attach to net namespace
-        self.set_ns(p_ifname, ns)
+        with self.daemon.transaction():
+            self.daemon.link_create(ifname, p_ifname)
+            if target_if is None:
+                self.set_ns(p_ifname, ns)
+            else:
+                # move, rename and set up the peer in one command
+                self.__add_ns(p_ifname, ns)
+                self.daemon.link_attach(p_ifname, ns, target_if)
+            # the link is recorded once its transaction has been committed
+            self.daemon.on_commit(lambda: self.__add_link(ifname, ns))
 
-        return self.__peer_ifname(ifname)
+        return target_if or p_ifname
+
+    def __add_link(self, ifname, ns):
+        with self.__lock:
+            self.__links.append({"ifname": ifname, "ns": ns})
 
     def set_ns(self, ifname, netns):
-        if netns not in self.__ns_list:
-            logging.debug("Create netns %s for node %s" % (netns, ifname))
-            self.daemon.netns_create(netns)
-            self.__ns_list.append(netns)
+        self.__add_ns(ifname, netns)
         self.daemon.link_netns(ifname, netns)
 
+    def __add_ns(self, ifname, netns):
+        # the netns is reserved to be created once by a transaction,
+        # the reservation is released if the creation fails
+        with self.__lock:
+            if netns in self.__ns_list:
+                return
+            self.__ns_list.append(netns)
+        logging.debug("Create netns %s for node %s" % (netns, ifname))
+        try:
+            self.daemon.netns_create(netns)
+        except NetemError:
+            self.__release_ns(netns)
+            raise
+        self.daemon.on_commit(
+            on_failure=lambda: self.__release_ns(netns))
+
+    def __release_ns(self, netns):
+        with self.__lock:
+            if netns in self.__ns_list:
+                self.__ns_list.remove(netns)
+
     def delete(self, ifname):
         link = None
-        for lk_infos in self.__links:
-            if lk_infos["ifname"] == ifname:
-                self.daemon.link_delete(lk_infos["ifname"])
-                self.__links.remove(lk_infos)
-                link = lk_infos
-                break
+        with self.__lock:
+            for lk_infos in self.__links:
+                if lk_infos["ifname"] == ifname:
+                    self.__links.remove(lk_infos)
+                    link = lk_infos
+                    break
         if link is not None:
-            if not self.__is_netns_used(link["ns"]):
+            self.daemon.link_delete(link["ifname"])
+            with self.__lock:
+                netns_used = self.__is_netns_used(link["ns"])
+            if not netns_used:
                 self.remove_netns(link["ns"])
 
     def remove_netns(self, netns):
-        if netns in self.__ns_list:
-            self.daemon.netns_delete(netns)
+        with self.__lock:
+            if netns not in self.__ns_list:
+                return
             self.__ns_list.remove(netns)
+        self.daemon.netns_delete(netns)
 
     def clear(self):
-        for lk_infos in self.__links:
-            self.daemon.link_delete(lk_infos["l_if"])
-        for netns in self.__ns_list:
+        with self.__lock:
+            links, ns_list = self.__links, self.__ns_list
+            self.__links, self.__ns_list = [], []
+        for lk_infos in links:
+            self.daemon.link_delete(lk_infos["ifname"])
+        for netns in ns_list:
             self.daemon.netns_delete(netns)
-        self.__links, self.__ns_list = [], []
 
     def __is_exists(self, ifname):
         for link in self.__links:
@@ -112,29 +112,26 @@ class DockerNode(_BaseWrapper):
 
     def start(self):
         if not self.running:
-            self.daemon.docker_start(self.container_name)
-            self.__pid = self.daemon.docker_pid(self.container_name)
+            with self.daemon.transaction(rollback=False) as t:
+                self.daemon.docker_start(self.container_name)
+                self.daemon.docker_pid(self.container_name)
+            self.__pid = t.results[1]
             self.running = True
-            # attach interfaces
-            for if_conf in self.interfaces:
-                if if_conf["peer"] == "null":
-                    continue  # skip this interface
-                p_if = self.__lk_factory.create(if_conf["ifname"], self.__pid)
-                if if_conf["peer"] == "switch":
-                    sw_instance = if_conf["peer_instance"]
-                    sw_instance.attach_interface(if_conf["ifname"])
-                elif if_conf["peer"] == "bridge":
-                    br_instance = if_conf["peer_instance"]
-                    br_instance.attach_interface(if_conf["ifname"])
-                elif if_conf["peer"] == "node":
-                    self.p2p_sw.add_connection(if_conf["ifname"])
-                self.__attach_interface(p_if, if_conf["target_if"])
-                # disable tcp offloading (segmentation / checksum)
-                self._docker_exec("ethtool -K {} tx off ".format(if_conf["target_if"]))
-
-    def __attach_interface(self, if_name, target_name):
-        self.daemon.docker_attach_interface(self.container_name, if_name,
-                                            target_name)
+            # attach interfaces, all commands are sent in one batch
+            with self.daemon.transaction(rollback=False):
+                for if_conf in self.interfaces:
+                    if if_conf["peer"] == "null":
+                        continue  # skip this interface
+                    self.__lk_factory.create(
+                        if_conf["ifname"], self.__pid, if_conf["target_if"])
+                    if if_conf["peer"] == "switch":
+                        sw_instance = if_conf["peer_instance"]
+                        sw_instance.attach_interface(if_conf["ifname"])
+                    elif if_conf["peer"] == "bridge":
+                        br_instance = if_conf["peer_instance"]
+                        br_instance.attach_interface(if_conf["ifname"])
+                    elif if_conf["peer"] == "node":
+                        self.p2p_sw.add_connection(if_conf["ifname"])
 
     @require_running
     def open_shell(self, bash=False):
@@ -197,8 +194,7 @@ class DockerNode(_BaseWrapper):
     def reset(self):
         raise NotImplementedError
 
-    @require_running
-    def stop(self):
+    def __detach_interfaces(self):
         for if_c in self.interfaces:
             if if_c["peer_instance"] is None:
                 continue
@@ -209,7 +205,12 @@ class DockerNode(_BaseWrapper):
             elif if_c["peer"] == "node":
                 self.p2p_sw.delete_connection(if_c["ifname"])
             self.__lk_factory.delete(if_c["ifname"])
-        self.daemon.docker_stop(self.container_name)
+
+    @require_running
+    def stop(self):
+        with self.daemon.transaction(rollback=False):
+            self.__detach_interfaces()
+            self.daemon.docker_stop(self.container_name)
         self.__pid = None
         self.running = False
 
@@ -231,9 +232,13 @@ class DockerNode(_BaseWrapper):
         self._docker_cp(host_source, dest)
 
     def clean(self):
-        if self.running:
-            self.stop()
-        self.daemon.docker_rm(self.container_name)
+        # the container is killed by docker_rm, no need to stop it first
+        with self.daemon.transaction(rollback=False):
+            if self.running:
+                self.__detach_interfaces()
+            self.daemon.docker_rm(self.container_name)
+        self.__pid = None
+        self.running = False
         self.interfaces = []
 
     def get_status(self):
@@ -252,9 +257,39 @@ class DockerNode(_BaseWrapper):
     def _docker_exec(self, cmd):
         self.daemon.docker_exec(self.container_name, cmd)
 
+    def _docker_script(self, commands):
+        # run commands in one exec session, stop at the first error
+        results = self.daemon.docker_script(
+            self.container_name, commands, True)
+        if results is not None:
+            self._check_script(commands, results)
+        return results
+
+    def _check_script(self, commands, results):
+        for result in results:
+            if result["code"] != 0:
+                raise NetemError("%s: command '%s' fails (%d): %s" % (
+                    self.name, result["cmd"], result["code"],
+                    result["output"]))
+        if len(results) != len(commands):
+            raise NetemError("%s: only %d of %d commands have been run"
+                             % (self.name, len(results), len(commands)))
+
     def _docker_cp(self, source, dest):
         self.daemon.docker_cp("\"%s\"" % source, "\"%s\"" % dest)
 
+    def _docker_put_files(self, files):
+        # files is a list of (host_path, container_path)
+        if len(files) > 0:
+            self.daemon.docker_put_files(
+                self.container_name, [list(f) for f in files])
+
+    def _docker_get_files(self, files):
+        # files is a list of (container_path, host_path)
+        if len(files) > 0:
+            self.daemon.docker_get_files(
+                self.container_name, [list(f) for f in files])
+
 
 class HostNode(DockerNode):
     IMG = DOCKER_IMAGES["host"]
@@ -267,29 +302,33 @@ class HostNode(DockerNode):
             "%s.%s" % (self.name, config_name)
         )
 
+    def get_config_files(self, conf_path=None):
+        # list of (host_path, container_path) saved with the node
+        return [
+            (self.fmt_conf_path("net.conf", conf_path), self.CONFIG_FILE),
+            (self.fmt_conf_path("ntp.conf", conf_path), self.NTP_FILE),
+        ]
+
     def start(self):
         super(HostNode, self).start()
+        # push available config files in one archive
+        self._docker_put_files([
+            (h_path, c_path) for h_path, c_path in self.get_config_files()
+            if os.path.isfile(h_path)
+        ])
         # set network config if available
-        netconf_path = self.fmt_conf_path("net.conf")
-        if os.path.isfile(netconf_path):
-            dest = "%s:%s" % (self.container_name, self.CONFIG_FILE)
-            self._docker_cp(netconf_path, dest)
+        if os.path.isfile(self.fmt_conf_path("net.conf")):
             self._docker_exec("network-config.py -l %s" % self.CONFIG_FILE)
-        # set ntp conf if available
-        ntpconf_path = self.fmt_conf_path("ntp.conf")
-        if os.path.isfile(ntpconf_path):
-            dest = "%s:%s" % (self.container_name, self.NTP_FILE)
-            self._docker_cp(ntpconf_path, dest)
 
     @require_running
     def save(self, conf_path=None):
         # save network config file
         self._docker_exec("network-config.py -s %s" % self.CONFIG_FILE)
-        source = "%s:%s" % (self.container_name, self.CONFIG_FILE)
-        self._docker_cp(source, self.fmt_conf_path("net.conf", conf_path))
-        # set ntp config file
-        source = "%s:%s" % (self.container_name, self.NTP_FILE)
-        self._docker_cp(source, self.fmt_conf_path("ntp.conf", conf_path))
+        # get all config files in one request
+        self._docker_get_files([
+            (c_path, h_path)
+            for h_path, c_path in self.get_config_files(conf_path)
+        ])
 
 
 class ServerNode(HostNode):
@@ -314,27 +353,17 @@ class ServerNode(HostNode):
         },
     }
 
-    def start(self):
-        super(ServerNode, self).start()
-        # set server configs if available
-        for server in self.SERVERS:
-            s_attrs = self.SERVERS[server]
-            for config in s_attrs["configs"]:
-                conf_path = self.fmt_conf_path(config["name"])
-                if os.path.isfile(conf_path):
-                    dest = "%s:%s" % (self.container_name, config["target"])
-                    self._docker_cp(conf_path, dest)
-
-    @require_running
-    def save(self, conf_path=None):
-        super(ServerNode, self).save(conf_path)
-        # save server configs
+    def get_config_files(self, conf_path=None):
+        files = super(ServerNode, self).get_config_files(conf_path)
+        # add server configs
         for server in self.SERVERS:
             s_attrs = self.SERVERS[server]
             for config in s_attrs["configs"]:
-                fconf_path = self.fmt_conf_path(config["name"], conf_path)
-                source = "%s:%s" % (self.container_name, config["target"])
-                self._docker_cp(source, fconf_path)
+                files.append((
+                    self.fmt_conf_path(config["name"], conf_path),
+                    config["target"]
+                ))
+        return files
 
 
 class FrrRouter(DockerNode):
@@ -359,44 +388,48 @@ class FrrRouter(DockerNode):
 
     def start(self):
         super(FrrRouter, self).start()
+        script = []
         # enable mpls if necessary
         if self.mpls_support:
-            self._docker_exec("sysctl -w net.mpls.platform_labels=100000")
-            self._docker_exec("sysctl -w net.mpls.conf.lo.input=1")
+            script.append("sysctl -w net.mpls.platform_labels=100000")
+            script.append("sysctl -w net.mpls.conf.lo.input=1")
             for if_conf in self.interfaces:
-                self._docker_exec("sysctl -w net.mpls.conf.{}.input=1".format(if_conf["target_if"]))
+                script.append("sysctl -w net.mpls.conf.{}.input=1".format(
+                    if_conf["target_if"]))
         # create vrfs
         for idx, vrf in enumerate(self.vrfs):
-            self._docker_exec("ip link add {} type vrf table {}".format(vrf, 10+idx))
-            self._docker_exec("ip link set {} up".format(vrf))
+            script.append(
+                "ip link add {} type vrf table {}".format(vrf, 10+idx))
+            script.append("ip link set {} up".format(vrf))
         # provide macvlan interfaces for vrrp support
         for vrrp_cnf in self.vrrps:
             ifname, vid, address = vrrp_cnf.split("|")
             vname = "vrrp-{}".format(ifname[-1])
-            self._docker_exec(
-                "ip link add %s link %s addrgenmode random type macvlan mode bridge" % (vname, ifname))
-            self._docker_exec(
+            script.append(
+                "ip link add %s link %s addrgenmode random type macvlan "
+                "mode bridge" % (vname, ifname))
+            script.append(
                 "ip link set dev {} address 00:00:5E:00:01:{:02X}".format(
                     vname, int(vid)))
-            self._docker_exec("ip addr add {} dev {}".format(address, vname))
-            self._docker_exec("ip link set dev {} up".format(vname))
+            script.append("ip addr add {} dev {}".format(address, vname))
+            script.append("ip link set dev {} up".format(vname))
             # modify kernel settings to disable routes when interface
             # is in linkdown state
-            self._docker_exec("sysctl -w net.ipv4.conf.{}.ignore_routes_with_linkdown=1".format(vname))
+            script.append("sysctl -w net.ipv4.conf.{}."
+                          "ignore_routes_with_linkdown=1".format(vname))
         # load frr config if available and start frr
         conf_path = self.__fmt_conf_path(None)
         if os.path.isfile(conf_path):
-            dest = "{}:{}".format(self.container_name, self.CONF)
-            self._docker_cp(conf_path, dest)
-            self._docker_exec("chown frr:frr {}".format(self.CONF))
-        self._docker_exec("/usr/lib/frr/frrinit.sh start")
+            self._docker_put_files([(conf_path, self.CONF)])
+            script.append("chown frr:frr {}".format(self.CONF))
+        script.append("/usr/lib/frr/frrinit.sh start")
+        # all start-up steps are executed in one exec session
+        self._docker_script(script)
 
     @require_running
     def save(self, conf_path=None):
-        self._docker_exec("vtysh -w")
-        self._docker_exec("chmod +r {}".format(self.CONF))
-        source = "{}:{}".format(self.container_name, self.CONF)
-        self._docker_cp(source, self.__fmt_conf_path(conf_path))
+        self._docker_script(["vtysh -w", "chmod +r {}".format(self.CONF)])
+        self._docker_get_files([(self.CONF, self.__fmt_conf_path(conf_path))])
 
 
 DOCKER_NODES = {
@@ -183,5 +183,6 @@ class JunosInstance(QEMUInstance):
         j_client.save(self.__fmt_conf_path(conf_path))
 
     def clean(self):
+        super(JunosInstance, self).clean()
         if os.path.isfile(self.img):
             os.unlink(self.img)
@@ -233,5 +233,9 @@ class QEMUInstance(_BaseInstance):
                     self.p2p_sw.delete_connection(if_c["tap"])
                 self.daemon.tap_delete(if_c["tap"])
 
+    def clean(self):
+        if self.is_started:
+            self.stop()
+
     def save(self, conf_path=None):
         pass  # nothing to do
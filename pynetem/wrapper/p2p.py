@@ -15,6 +15,7 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import threading
 from pynetem.daemon.client import NetemDaemonClient
 P2P_NAME = "p2p"
 
@@ -26,34 +27,76 @@ class NetemP2PSwitch(object):
         self.__prj_id = prj_id
         self.__sw_name = "{0}.{1}".format(prj_id, P2P_NAME)
         self.__connections = []
+        # nodes are started in parallel, tags are allocated under lock
+        self.__lock = threading.Lock()
+        self.__tags = {}
+        self.__last_tag = 9
 
         # create switch used for p2p connections
         self.daemon.ovs_create(self.__sw_name)
 
+    def set_tags(self, tags):
+        """
+        Use the tags of a compiled topology, a dict
+        {frozenset([ifname1, ifname2]): tag}
+        """
+        with self.__lock:
+            self.__tags = dict(tags)
+            self.__last_tag = max(list(self.__tags.values()) + [9])
+
     def add_connection(self, ifname):
         tag = self.get_tag(ifname)
         # just connect the left node
-        self.daemon.ovs_add_port(self.__sw_name, ifname)
-        self.daemon.ovs_port_vlan(ifname, str(tag))
-        # store connection informations
-        self.__connections.append({"ifname": ifname, "tag": tag})
+        with self.daemon.transaction():
+            self.daemon.ovs_add_port(self.__sw_name, ifname)
+            self.daemon.ovs_port_vlan(ifname, str(tag))
+            # store connection informations once the ports exist
+            self.daemon.on_commit(lambda: self.__add_connection(ifname, tag))
+
+    def __add_connection(self, ifname, tag):
+        with self.__lock:
+            self.__connections.append({"ifname": ifname, "tag": tag})
+
+    def fill_state(self, state):
+        # desired state of the switch for the daemon apply command
+        with self.__lock:
+            state["switches"][self.__sw_name] = dict(
+                [(c["ifname"], str(c["tag"])) for c in self.__connections])
 
     def delete_connection(self, ifname):
         conn = self.get_connection(ifname)
         if conn is not None:
             self.daemon.ovs_del_port(self.__sw_name, ifname)
-            self.__connections.remove(conn)
+            self.daemon.on_commit(lambda: self.__remove_connection(conn))
+
+    def __remove_connection(self, conn):
+        with self.__lock:
+            if conn in self.__connections:
+                self.__connections.remove(conn)
+
+    def delete_connections(self):
+        with self.__lock:
+            connections, self.__connections = self.__connections, []
+        # all the ports are deleted in one batch
+        with self.daemon.transaction(rollback=False):
+            for c in connections:
+                self.daemon.ovs_del_port(self.__sw_name, c["ifname"])
 
     def get_tag(self, ifname):
-        for c in self.__connections:
-            if c["ifname"] == self.__inverse_ifname(ifname):
-                return c["tag"]
-        return 10 + len(self.__connections)
+        # the tag is bound to the pair of interfaces, so both ends get
+        # the same tag whatever the order in which nodes are started
+        key = frozenset([ifname, self.__inverse_ifname(ifname)])
+        with self.__lock:
+            if key not in self.__tags:
+                self.__last_tag += 1
+                self.__tags[key] = self.__last_tag
+            return self.__tags[key]
 
     def get_connection(self, ifname):
-        for c in self.__connections:
-            if c["ifname"] == ifname:
-                return c
+        with self.__lock:
+            for c in self.__connections:
+                if c["ifname"] == ifname:
+                    return c
         return None
 
     def close(self):
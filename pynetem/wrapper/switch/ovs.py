@@ -16,6 +16,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import logging
+import threading
 from pynetem.wrapper import _BaseWrapper
 
 
@@ -27,6 +28,8 @@ class OVSwitchInstance(_BaseWrapper):
         self.name = sw_name
         self.__is_started = False
         self.__sw_interfaces = []
+        # interfaces of several nodes can be attached in parallel
+        self.__lock = threading.Lock()
         self.__sw_name = "%s.%s" % (prj_id, sw_name)
 
     def get_type(self):
@@ -39,14 +42,37 @@ class OVSwitchInstance(_BaseWrapper):
         return self.__is_started
 
     def attach_interface(self, if_name):
-        if self.__is_started and if_name not in self.__sw_interfaces:
-            self.daemon.ovs_add_port(self.__sw_name, if_name)
-            self.__sw_interfaces.append(if_name)
+        with self.__lock:
+            if not self.__is_started or if_name in self.__sw_interfaces:
+                return
+        self.daemon.ovs_add_port(self.__sw_name, if_name)
+        # the port is recorded once its transaction has been committed
+        self.daemon.on_commit(lambda: self.__add_interface(if_name))
 
     def detach_interface(self, if_name):
-        if self.__is_started and if_name in self.__sw_interfaces:
-            self.daemon.ovs_del_port(self.__sw_name, if_name)
-            self.__sw_interfaces.remove(if_name)
+        with self.__lock:
+            if not self.__is_started or if_name not in self.__sw_interfaces:
+                return
+        self.daemon.ovs_del_port(self.__sw_name, if_name)
+        self.daemon.on_commit(lambda: self.__remove_interface(if_name))
+
+    def __add_interface(self, if_name):
+        with self.__lock:
+            if if_name not in self.__sw_interfaces:
+                self.__sw_interfaces.append(if_name)
+
+    def __remove_interface(self, if_name):
+        with self.__lock:
+            if if_name in self.__sw_interfaces:
+                self.__sw_interfaces.remove(if_name)
+
+    def fill_state(self, state):
+        # desired state of the switch for the daemon apply command
+        state["switches"][self.__sw_name] = dict(
+            [(if_name, None) for if_name in self.__sw_interfaces])
+
+    def set_started(self):
+        self.__is_started = True
 
     def start(self):
         if self.__is_started:
@@ -59,8 +85,10 @@ class OVSwitchInstance(_BaseWrapper):
 
     def stop(self):
         if self.__is_started:
-            for if_name in self.__sw_interfaces:
-                self.daemon.ovs_del_port(self.__sw_name, if_name)
-            self.daemon.ovs_delete(self.__sw_name)
+            # all the ports are detached in one batch
+            with self.daemon.transaction(rollback=False):
+                for if_name in self.__sw_interfaces:
+                    self.daemon.ovs_del_port(self.__sw_name, if_name)
+                self.daemon.ovs_delete(self.__sw_name)
             self.__is_started = False
             self.__sw_interfaces = []
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# pynetem: network emulator
+# Copyright (C) 2015-2021 Mickael Royer <mickael.royer@recherche.enac.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import sys
+import os
+import json
+import time
+import shutil
+import argparse
+import asyncio
+import tempfile
+import subprocess
+from pynetem import __version__
+from pynetem.server.client import NetemClientProtocol
+from pynetem.server.rpc import RPCRequest
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER = os.path.join(SCRIPT_DIR, "..", "pynetem-server")
+GENERATOR = os.path.join(SCRIPT_DIR, "gen-topology.py")
+# RPC commands timed for each topology, quit closes the project
+COMMANDS = (("load", "load"), ("save", "save"),
+            ("reload", "reload"), ("close", "quit"))
+PHASES = ("switch_bridge", "node", "config")
+SHAPES = ("line", "ring", "mesh", "fat-tree", "star")
+
+
+class PhaseRecorder(object):
+    """
+    Measure the duration of each phase from the node signals sent by
+    the server while a command is running
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.errors = []
+        self.__started = {}
+
+    def on_signal(self, sig):
+        if sig["name"] != "node":
+            return
+        attrs, now = sig["attrs"], time.monotonic()
+        if attrs["state"] == "loading":
+            self.__started[attrs["type"]] = now
+        elif attrs["state"] in ("loaded", "error"):
+            start = self.__started.pop(attrs["type"], None)
+            if start is not None:
+                self.phases[attrs["type"]] = \
+                    self.phases.get(attrs["type"], 0.0) + now - start
+            if attrs["state"] == "error":
+                self.errors.append(attrs["msg"])
+
+
+def send_rpc_cmd(port, cmd_name, on_signal):
+    async def __send_rpc_cmd():
+        request = RPCRequest(cmd_name, [])
+        loop = asyncio.get_running_loop()
+        on_answer = loop.create_future()
+
+        transport, _ = await loop.create_connection(
+            lambda: NetemClientProtocol(request, on_signal, on_answer),
+            "127.0.0.1",
+            port,
+        )
+        result = await on_answer
+        transport.close()
+        return result
+
+    return asyncio.run(__send_rpc_cmd())
+
+
+def generate(prj_path, shape, size, args):
+    cmd = [sys.executable, GENERATOR, "-f", "-s", shape,
+           "-n", str(size), "-t", args.n_type, prj_path]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        return result.stderr.decode("utf-8").strip()
+    return None
+
+
+def start_server(prj_path, args):
+    cmd = [SERVER, "--id", args.netid, "--port", str(args.port), prj_path]
+    if args.conffile is not None:
+        cmd[1:1] = ["--conf-file", args.conffile]
+    result = subprocess.run(cmd, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        sys.exit("Error: unable to start server: %s" % (
+            result.stderr.decode("utf-8").strip()))
+
+
+def run_benchmark(shape, size, args):
+    tmp_dir = tempfile.mkdtemp(prefix="ntm-bench")
+    prj_path = os.path.join(tmp_dir, "%s-%d.pnet" % (shape, size))
+    report = {"shape": shape, "nodes": size, "commands": {}}
+    try:
+        # some shapes can not be loaded at large sizes
+        report["error"] = generate(prj_path, shape, size, args)
+        if report["error"] is not None:
+            return report
+        start_server(prj_path, args)
+        for name, rpc_cmd in COMMANDS:
+            recorder = PhaseRecorder()
+            start = time.monotonic()
+            try:
+                ans = send_rpc_cmd(args.port, rpc_cmd, recorder.on_signal)
+            except OSError as err:
+                ans = {"state": "error", "content": str(err)}
+            duration = time.monotonic() - start
+
+            errors = recorder.errors
+            if ans is None:
+                errors.append("no valid answer has been received")
+            elif ans["state"] != "OK":
+                errors.append("%s" % ans["content"])
+            report["commands"][name] = {
+                "total": duration,
+                "phases": recorder.phases,
+                "errors": errors,
+            }
+            if ans is None or ans["state"] != "OK":
+                if rpc_cmd != "quit":
+                    # do not leave the server behind
+                    try:
+                        send_rpc_cmd(args.port, "quit", lambda sig: None)
+                    except OSError:
+                        pass
+                break
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return report
+
+
+def print_report(report):
+    print("%s / %d nodes" % (report["shape"], report["nodes"]))
+    if report["error"] is not None:
+        print("  skipped: %s" % report["error"])
+    for name, _ in COMMANDS:
+        if name not in report["commands"]:
+            continue
+        result = report["commands"][name]
+        phases = " ".join(["%s=%.2fs" % (p, result["phases"][p])
+                           for p in PHASES if p in result["phases"]])
+        print("  %-7s %8.2fs  %s" % (name, result["total"], phases))
+        for error in result["errors"]:
+            print("    error: %s" % error)
+
+
+parser = argparse.ArgumentParser(
+    description='Time load, save, reload and close of generated topologies')
+parser.add_argument(
+    "-s", "--shape", action="append", dest="shapes", default=[],
+    choices=SHAPES,
+    help="Shape of the topology, can be repeated (default: line)"
+)
+parser.add_argument(
+    "-n", "--nodes", type=str, dest="sizes", metavar="N1,N2,...",
+    default="10,50,100,500", help="Number of nodes of each topology"
+)
+parser.add_argument(
+    "-t", "--type", type=str, dest="n_type", choices=["host", "frr"],
+    default="host", help="Type of docker nodes"
+)
+parser.add_argument(
+    "-c", "--conf-file", type=str, dest="conffile",
+    metavar="FILE", default=None,
+    help="Custom conf file given to pynetem-server"
+)
+parser.add_argument(
+    "-i", "--id", type=str, dest="netid",
+    metavar="ID", default="ntmbc",
+    help="Net ID for the server, 5 chars as the ids of pynetem-emulator"
+)
+parser.add_argument(
+    "-p", "--port", type=int, dest="port",
+    metavar="P_NUMBER", default=10100, help="Port number of the server"
+)
+parser.add_argument(
+    "-o", "--output", type=str, dest="output", metavar="FILE",
+    default=None, help="Write results in FILE with json format"
+)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    try:
+        sizes = [int(s) for s in args.sizes.split(",")]
+    except ValueError:
+        sys.exit("Error: %s is not a valid list of sizes" % args.sizes)
+    shapes = args.shapes or ["line"]
+
+    results = []
+    for shape in shapes:
+        for size in sizes:
+            report = run_benchmark(shape, size, args)
+            print_report(report)
+            results.append(report)
+
+    if args.output is not None:
+        with open(args.output, "w") as hdl:
+            json.dump({
+                "version": __version__,
+                "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "node_type": args.n_type,
+                "results": results,
+            }, hdl, indent=2)
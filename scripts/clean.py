@@ -20,6 +20,7 @@
 import socket
 import sys
 import argparse
+from pynetem.daemon.protocol import build_request, read_msg
 
 
 if __name__ == "__main__":
@@ -40,12 +41,13 @@ if __name__ == "__main__":
 
     # send the clean command to pynetem daemon
     try:
-        cmd = "clean %s" % args.prefix
-        sock.sendall(cmd.encode("utf-8"))
-        ans = sock.recv(1024).decode("utf-8").strip()
-        if not ans.startswith("OK"):
-            print("Error: daemon returns an error: %s" % ans)
+        sock.sendall(build_request(1, "clean", [args.prefix]))
+        with sock.makefile("rb") as s_file:
+            ans = read_msg(s_file)
+        if ans is None or ans["state"] != "OK":
+            print("Error: daemon returns an error: %s" % (
+                ans and ans["content"]))
         else:
-            print("OK")
+            print("OK: %s" % ans["content"])
     finally:
         sock.close()
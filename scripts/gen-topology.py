@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# pynetem: network emulator
+# Copyright (C) 2015-2021 Mickael Royer <mickael.royer@recherche.enac.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import sys
+import os
+import argparse
+import zipfile
+
+SHAPES = ("line", "ring", "mesh", "fat-tree", "star")
+NODE_TYPES = {
+    "host": ("docker.host", "H"),
+    "frr": ("docker.frr", "R"),
+}
+# nodes attached to each switch of a star
+STAR_SW_SIZE = 16
+# names have 3 chars to be kept as is by pynetem.wrapper.short_name,
+# a letter followed by a base 36 index
+NAME_CHARS = "0123456789abcdefghijklmnopqrstuvwxyz"
+MAX_NAMES = len(NAME_CHARS) ** 2
+# size of net ids generated by pynetem-emulator, "ntm" and 2 letters
+NETID_SIZE = 5
+# max length of a linux interface name
+IFNAME_MAX = 15
+# p2p links use vlan tags from 10 to 4094
+P2P_FIRST_TAG = 10
+P2P_LAST_TAG = 4094
+
+
+class Topology(object):
+    """
+    Nodes and switches of a generated topology, a node interface is
+    appended by each connection
+    """
+
+    def __init__(self, n_type):
+        self.n_type, self.prefix = NODE_TYPES[n_type]
+        self.nodes = []
+        self.interfaces = {}
+        self.switches = []
+        self.p2p_links = 0
+        self.__counters = {}
+
+    def __gen_name(self, prefix):
+        idx = self.__counters.get(prefix, 0)
+        if idx >= MAX_NAMES:
+            raise ValueError("more than %d objects with prefix %s"
+                             % (MAX_NAMES, prefix))
+        self.__counters[prefix] = idx + 1
+        return "%s%s%s" % (prefix, NAME_CHARS[idx // len(NAME_CHARS)],
+                           NAME_CHARS[idx % len(NAME_CHARS)])
+
+    def add_node(self, prefix=None):
+        name = self.__gen_name(prefix or self.prefix)
+        self.nodes.append(name)
+        self.interfaces[name] = []
+        return name
+
+    def add_switch(self):
+        name = self.__gen_name("s")
+        self.switches.append(name)
+        return name
+
+    def connect(self, n1, n2):
+        if1, if2 = len(self.interfaces[n1]), len(self.interfaces[n2])
+        self.interfaces[n1].append("%s.%d" % (n2, if2))
+        self.interfaces[n2].append("%s.%d" % (n1, if1))
+        self.p2p_links += 1
+
+    def attach(self, node, sw_name):
+        self.interfaces[node].append("sw.%s" % sw_name)
+
+    def check(self):
+        """
+        Return the reasons why pynetem can not load this topology
+        """
+        errors = []
+        if P2P_FIRST_TAG + self.p2p_links - 1 > P2P_LAST_TAG:
+            errors.append("%d p2p links need more vlan tags than the "
+                          "%d available" % (self.p2p_links,
+                                            P2P_LAST_TAG - P2P_FIRST_TAG + 1))
+        for name in self.nodes:
+            for if_id, peer in enumerate(self.interfaces[name]):
+                # interface names built as pynetem.wrapper.gen_ifname
+                peer_name, peer_if = peer.split(".", 1)
+                if peer_name == "sw":
+                    peer_name, peer_if = peer_if, ""
+                size = NETID_SIZE + len(name) + len(str(if_id)) + 1 \
+                    + len(peer_name) + len(peer_if)
+                if size > IFNAME_MAX:
+                    errors.append("interface names of %s.%d are longer "
+                                  "than %d chars" % (name, if_id,
+                                                     IFNAME_MAX))
+                    return errors
+        return errors
+
+    def dump(self):
+        lines = ["[config]", "image_dir = images", "config_dir = configs",
+                 "", "[nodes]"]
+        for name in self.nodes:
+            lines += ["[[%s]]" % name, "type = %s" % self.n_type,
+                      "if_numbers = %d" % len(self.interfaces[name])]
+            lines += ["if%d = %s" % (if_id, peer)
+                      for if_id, peer in enumerate(self.interfaces[name])]
+            lines.append("")
+        lines.append("[switches]")
+        for name in self.switches:
+            lines += ["[[%s]]" % name, "type = ovs", ""]
+        lines += ["[bridges]", ""]
+        return "\n".join(lines)
+
+
+def gen_line(topo, size, args):
+    nodes = [topo.add_node() for _ in range(size)]
+    for n1, n2 in zip(nodes, nodes[1:]):
+        topo.connect(n1, n2)
+    return nodes
+
+
+def gen_ring(topo, size, args):
+    nodes = gen_line(topo, size, args)
+    if size > 2:
+        topo.connect(nodes[-1], nodes[0])
+
+
+def gen_mesh(topo, size, args):
+    nodes = [topo.add_node() for _ in range(size)]
+    for idx, n1 in enumerate(nodes):
+        for n2 in nodes[idx+1:]:
+            topo.connect(n1, n2)
+
+
+def gen_fat_tree(topo, size, args):
+    # two levels folded clos: each leaf is connected to every spine
+    spines = min(args.spines, size - 1)
+    spine_nodes = [topo.add_node("S") for _ in range(spines)]
+    for _ in range(size - spines):
+        leaf = topo.add_node()
+        for spine in spine_nodes:
+            topo.connect(leaf, spine)
+
+
+def gen_star(topo, size, args):
+    # nodes are spread on several switches, joined by a core node
+    core = topo.add_node("C")
+    sw_name = None
+    for idx in range(size - 1):
+        if idx % args.sw_size == 0:
+            sw_name = topo.add_switch()
+            topo.attach(core, sw_name)
+        topo.attach(topo.add_node(), sw_name)
+
+
+GENERATORS = {
+    "line": gen_line,
+    "ring": gen_ring,
+    "mesh": gen_mesh,
+    "fat-tree": gen_fat_tree,
+    "star": gen_star,
+}
+
+
+def write_project(prj_path, content):
+    with zipfile.ZipFile(prj_path, mode="w") as net_zip:
+        net_zip.writestr("network.ini", content)
+        net_zip.writestr("configs/", "")
+
+
+parser = argparse.ArgumentParser(
+    description='Generate a pynetem project for a given topology shape')
+parser.add_argument(
+    'project', metavar='PRJ', type=str, nargs=1,
+    default=None, help='Path for the generated pnet project'
+)
+parser.add_argument(
+    "-s", "--shape", type=str, dest="shape", choices=SHAPES,
+    default="line", help="Shape of the topology"
+)
+parser.add_argument(
+    "-n", "--nodes", type=int, dest="nodes",
+    metavar="NUMBER", default=10, help="Number of nodes"
+)
+parser.add_argument(
+    "-t", "--type", type=str, dest="n_type", choices=list(NODE_TYPES),
+    default="host", help="Type of docker nodes"
+)
+parser.add_argument(
+    "--spines", type=int, dest="spines",
+    metavar="NUMBER", default=4, help="Number of spines for fat-tree"
+)
+parser.add_argument(
+    "--sw-size", type=int, dest="sw_size", metavar="NUMBER",
+    default=STAR_SW_SIZE, help="Number of nodes by switch for star"
+)
+parser.add_argument(
+    "-f", "--force", action="store_true", dest="force", default=False,
+    help="Overwrite the project if it already exists"
+)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.nodes < 2:
+        sys.exit("Error: a topology needs at least 2 nodes")
+    if args.spines < 1 or args.sw_size < 1:
+        sys.exit("Error: spines and sw-size must be positive")
+
+    prj_path = args.project[0]
+    if not prj_path.endswith(".pnet"):
+        prj_path += ".pnet"
+    if os.path.exists(prj_path) and not args.force:
+        sys.exit("Error: project %s already exists" % prj_path)
+
+    topo = Topology(args.n_type)
+    try:
+        GENERATORS[args.shape](topo, args.nodes, args)
+    except ValueError as err:
+        sys.exit("Error: unable to generate the topology, %s" % err)
+    errors = topo.check()
+    if len(errors) > 0:
+        sys.exit("Error: pynetem can not load this topology:\n\t%s"
+                 % "\n\t".join(errors))
+    write_project(prj_path, topo.dump())
+    print("OK: %s generated with %d nodes and %d switches" % (
+        prj_path, len(topo.nodes), len(topo.switches)))
@@ -18,11 +18,13 @@
 
 import os
 import pytest
+import threading
+import time
 import docker
 from pyroute2 import IPRoute
 from pyroute2 import netns
 from tests.data import gen_rnd_string
-from pynetem import __version__
+from pynetem import __version__, NetemError
 
 
 class IPRouteUtilities(object):
@@ -49,6 +51,14 @@ class IPRouteUtilities(object):
 
         return False
 
+    def get_if_indexes(self, prefix):
+        indexes = {}
+        for link in self.ip.get_links():
+            name = link.get_attr('IFLA_IFNAME')
+            if name.startswith(prefix):
+                indexes[name] = link['index']
+        return indexes
+
     def is_ns_exists(self, ns_name):
         return ns_name in netns.listnetns()
 
@@ -66,6 +76,43 @@ def test_version(pynetem_daemon):
     assert version == __version__
 
 
+def test_message_size(pynetem_daemon):
+    import socket
+    from pynetem.daemon.protocol import HEADER, MAX_MSG_SIZE
+
+    # the session is closed on a message over the max size
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(pynetem_daemon.socket_path)
+        sock.sendall(HEADER.pack(MAX_MSG_SIZE + 1))
+        assert sock.recv(1) == b""
+    finally:
+        sock.close()
+    assert pynetem_daemon.version() == __version__
+
+
+def test_multiplexed_session(pynetem_daemon):
+    from pynetem import __version__
+    results = []
+
+    def send_version():
+        results.append(pynetem_daemon.version())
+
+    threads = [threading.Thread(target=send_version) for _ in range(20)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    assert results == [__version__] * 20
+
+
+def test_large_message(pynetem_daemon):
+    path = "/tmp/" + gen_rnd_string(min_size=4096, max_size=4096)
+    with pytest.raises(NetemError) as excinfo:
+        pynetem_daemon.chown("\"%s\"" % path, "0", "0")
+    assert path in str(excinfo.value)
+
+
 def test_tuntap(pynetem_daemon, iproute):
     current_user = os.environ["LOGNAME"]
     tap_name = gen_rnd_string(min_size=4, max_size=4)
@@ -85,6 +132,60 @@ def test_netns(pynetem_daemon, iproute):
     pynetem_daemon.netns_delete(ns_name)
     assert not iproute.is_ns_exists(ns_name)
 
+    # names must stay in the netns dir
+    for ns_name in ("../../tmp/ntm-netns", "..", "", "a" * 256):
+        with pytest.raises(NetemError):
+            pynetem_daemon.netns_create(ns_name)
+    assert not os.path.exists("/tmp/ntm-netns")
+
+
+def test_batch(pynetem_daemon, iproute):
+    ns_name = gen_rnd_string(min_size=4, max_size=4)
+    results = pynetem_daemon.batch([
+        ["netns_create", ns_name],
+        ["version"],
+    ], True)
+    assert [r["state"] for r in results] == ["OK", "OK"]
+    assert iproute.is_ns_exists(ns_name)
+    pynetem_daemon.netns_delete(ns_name)
+
+    # a failing command rollbacks previous commands
+    results = pynetem_daemon.batch([
+        ["netns_create", ns_name],
+        ["unknown_cmd"],
+        ["version"],
+    ], True)
+    assert [r["state"] for r in results] == ["OK", "error"]
+    assert not iproute.is_ns_exists(ns_name)
+
+
+def test_transaction_callbacks(pynetem_daemon):
+    calls = []
+
+    def on_commit():
+        pynetem_daemon.on_commit(lambda: calls.append("success"),
+                                 lambda: calls.append("failure"))
+
+    with pynetem_daemon.transaction():
+        pynetem_daemon.version()
+        on_commit()
+    assert calls == ["success"]
+
+    # callbacks are called once the batch has been committed
+    calls = []
+    with pytest.raises(NetemError):
+        with pynetem_daemon.transaction():
+            pynetem_daemon.version()
+            on_commit()
+            assert calls == []
+            pynetem_daemon.chown("\"/unknown/path\"", "0", "0")
+    assert calls == ["failure"]
+
+    # without transaction, on_success is called at once
+    calls = []
+    on_commit()
+    assert calls == ["success"]
+
 
 def test_bridge(pynetem_daemon, iproute):
     br_name = gen_rnd_string(min_size=4, max_size=4)
@@ -97,6 +198,51 @@ def test_bridge(pynetem_daemon, iproute):
     assert not iproute.is_if_exists(br_name)
 
 
+def test_ovs(pynetem_daemon, iproute):
+    from pynetem.daemon.ovsdb import OVSDBClient
+    ovsdb = OVSDBClient.instance()
+    sw_name = gen_rnd_string(min_size=4, max_size=4)
+    if1 = gen_rnd_string(min_size=4, max_size=4)
+    if2 = gen_rnd_string(min_size=4, max_size=4)
+
+    pynetem_daemon.ovs_create(sw_name)
+    assert ovsdb.bridge_exists(sw_name)
+    assert pynetem_daemon.ovs_create(sw_name) == "EXIST"
+
+    # add port and vlan tag in one transaction
+    pynetem_daemon.link_create(if1, if2)
+    with pynetem_daemon.transaction():
+        pynetem_daemon.ovs_add_port(sw_name, if1)
+        pynetem_daemon.ovs_port_vlan(if1, "12")
+    rows = ovsdb.select("Port", [["name", "==", if1]], ["tag"])
+    assert rows[0]["tag"] == 12
+    assert iproute.get_if(if1)["state"] == "up"
+
+    pynetem_daemon.ovs_del_port(sw_name, if1)
+    assert len(ovsdb.select("Port", [["name", "==", if1]], ["tag"])) == 0
+
+    # consecutive port deletions are done in one transaction
+    pynetem_daemon.ovs_add_port(sw_name, if1)
+    pynetem_daemon.ovs_add_port(sw_name, if2)
+    with pynetem_daemon.transaction():
+        pynetem_daemon.ovs_del_port(sw_name, if1)
+        pynetem_daemon.ovs_del_port(sw_name, if2)
+    for if_name in (if1, if2):
+        rows = ovsdb.select("Port", [["name", "==", if_name]], ["tag"])
+        assert len(rows) == 0
+
+    # a failed group returns one result by command
+    results = pynetem_daemon.batch([
+        ["ovs_add_port", "%s.unknown" % sw_name, if1],
+        ["ovs_add_port", "%s.unknown" % sw_name, if2],
+    ], True)
+    assert [r["state"] for r in results] == ["error", "error"]
+    pynetem_daemon.link_delete(if1)
+
+    pynetem_daemon.ovs_delete(sw_name)
+    assert not ovsdb.bridge_exists(sw_name)
+
+
 def test_docker(pynetem_daemon):
     client = docker.from_env()
     cname = gen_rnd_string(min_size=8, max_size=8)
@@ -128,3 +274,360 @@ def test_docker(pynetem_daemon):
     pynetem_daemon.docker_rm(cname)
     containers = [c.name for c in client.containers.list(all=True)]
     assert cname not in containers
+
+
+def test_docker_exec_cp(pynetem_daemon, tmp_path):
+    cname = gen_rnd_string(min_size=8, max_size=8)
+    image = "mroy31/pynetem-host:{}".format(__version__)
+    pynetem_daemon.docker_create(cname, cname, image, "no")
+    pynetem_daemon.docker_start(cname)
+
+    try:
+        # exec returns an error when the command fails
+        pynetem_daemon.docker_exec(cname, "sh -c 'echo test > /tmp/f1'")
+        with pytest.raises(NetemError):
+            pynetem_daemon.docker_exec(cname, "ls /unknown")
+
+        # copy a file from the container to the host
+        host_file = os.path.join(str(tmp_path), "f1.txt")
+        pynetem_daemon.docker_cp(
+            "\"%s:/tmp/f1\"" % cname, "\"%s\"" % host_file)
+        with open(host_file) as hdl:
+            assert hdl.read() == "test\n"
+
+        # copy a file from the host to a container file and directory
+        pynetem_daemon.docker_cp(
+            "\"%s\"" % host_file, "\"%s:/tmp/f2\"" % cname)
+        pynetem_daemon.docker_exec(cname, "test -f /tmp/f2")
+        pynetem_daemon.docker_cp(
+            "\"%s\"" % host_file, "\"%s:/tmp\"" % cname)
+        pynetem_daemon.docker_exec(cname, "test -f /tmp/f1.txt")
+    finally:
+        pynetem_daemon.docker_rm(cname)
+
+
+def test_docker_inventory(pynetem_daemon):
+    client = docker.from_env()
+    cname = gen_rnd_string(min_size=8, max_size=8)
+    image = "mroy31/pynetem-host:{}".format(__version__)
+    assert pynetem_daemon.docker_image_present(image) == "yes"
+
+    # a container created outside pynetem is known through docker events
+    client.containers.create(image, name=cname, network_mode="none")
+    time.sleep(1)
+    pynetem_daemon.docker_rm(cname)
+    containers = [c.name for c in client.containers.list(all=True)]
+    assert cname not in containers
+
+    # the late destroy event of a removed container does not hide
+    # a new container with the same name
+    pynetem_daemon.docker_create(cname, cname, image, "no")
+    pynetem_daemon.docker_rm(cname)
+    pynetem_daemon.docker_create(cname, cname, image, "no")
+    time.sleep(1)
+    pynetem_daemon.docker_rm(cname)
+    containers = [c.name for c in client.containers.list(all=True)]
+    assert cname not in containers
+
+
+def test_clean(pynetem_daemon, iproute):
+    client = docker.from_env()
+    prefix = gen_rnd_string(min_size=5, max_size=5)
+    image = "mroy31/pynetem-host:{}".format(__version__)
+    for idx in range(3):
+        c_name = "%s.node%d" % (prefix, idx)
+        pynetem_daemon.docker_create(c_name, c_name, image, "no")
+        pynetem_daemon.docker_start(c_name)
+    pynetem_daemon.ovs_create("%s.sw" % prefix)
+    pynetem_daemon.link_create("%s.if1" % prefix, "%s.if2" % prefix)
+    # the host end of a veth whose peer is in another netns
+    ns_name = gen_rnd_string(min_size=4, max_size=4)
+    pynetem_daemon.netns_create(ns_name)
+    pynetem_daemon.link_create("%s.if3" % prefix, "%s.if4" % prefix)
+    pynetem_daemon.link_netns("%s.if4" % prefix, ns_name)
+
+    report = pynetem_daemon.clean(prefix)
+    pynetem_daemon.netns_delete(ns_name)
+    assert "3 containers removed" in report
+    assert not iproute.is_if_exists("%s.if3" % prefix)
+    containers = [c.name for c in client.containers.list(all=True)]
+    assert len([c for c in containers if c.startswith(prefix)]) == 0
+    assert not iproute.is_if_exists("%s.if1" % prefix)
+    assert not iproute.is_if_exists("%s.if2" % prefix)
+
+
+def test_stats(pynetem_daemon):
+    pynetem_daemon.stats("reset")
+    pynetem_daemon.version()
+    pynetem_daemon.version()
+    with pytest.raises(NetemError):
+        pynetem_daemon.chown("\"/unknown/path\"", "0", "0")
+
+    stats = pynetem_daemon.stats("show")["commands"]
+    assert stats["version"]["count"] == 2
+    assert stats["version"]["errors"] == 0
+    assert stats["chown"]["errors"] == 1
+    assert sum(stats["version"]["histogram"].values()) == 2
+
+    pynetem_daemon.stats("reset")
+    assert pynetem_daemon.stats("show")["commands"] == {}
+
+
+def test_docker_files(pynetem_daemon, tmp_path):
+    cname = gen_rnd_string(min_size=8, max_size=8)
+    image = "mroy31/pynetem-host:{}".format(__version__)
+    pynetem_daemon.docker_create(cname, cname, image, "no")
+    pynetem_daemon.docker_start(cname)
+
+    try:
+        files = []
+        for idx in range(3):
+            host_file = os.path.join(str(tmp_path), "in%d.conf" % idx)
+            with open(host_file, "w") as hdl:
+                hdl.write("config %d\n" % idx)
+            files.append([host_file, "/tmp/d%d/f%d.conf" % (idx, idx)])
+        pynetem_daemon.docker_put_files(cname, files)
+
+        pynetem_daemon.docker_get_files(cname, [
+            [c_path, os.path.join(str(tmp_path), "out%d.conf" % idx)]
+            for idx, (_, c_path) in enumerate(files)
+        ])
+        for idx in range(3):
+            out_file = os.path.join(str(tmp_path), "out%d.conf" % idx)
+            with open(out_file) as hdl:
+                assert hdl.read() == "config %d\n" % idx
+
+        # an existing symlink is replaced, not followed
+        outside = os.path.join(str(tmp_path), "outside.conf")
+        with open(outside, "w") as hdl:
+            hdl.write("outside\n")
+        link = os.path.join(str(tmp_path), "link.conf")
+        os.symlink(outside, link)
+        pynetem_daemon.docker_get_files(cname, [[files[0][1], link]])
+        assert not os.path.islink(link)
+        with open(outside) as hdl:
+            assert hdl.read() == "outside\n"
+
+        # links of the container are refused
+        pynetem_daemon.docker_exec(cname, "ln -s /etc/passwd /tmp/lnk")
+        with pytest.raises(NetemError):
+            pynetem_daemon.docker_get_files(cname, [
+                ["/tmp/lnk", os.path.join(str(tmp_path), "lnk.conf")]])
+        assert not os.path.exists(os.path.join(str(tmp_path), "lnk.conf"))
+    finally:
+        pynetem_daemon.docker_rm(cname)
+
+
+def test_docker_script(pynetem_daemon):
+    cname = gen_rnd_string(min_size=8, max_size=8)
+    image = "mroy31/pynetem-host:{}".format(__version__)
+    pynetem_daemon.docker_create(cname, cname, image, "no")
+    pynetem_daemon.docker_start(cname)
+
+    try:
+        commands = ["echo test", "ls /unknown", "printf ok"]
+        results = pynetem_daemon.docker_script(cname, commands, False)
+        assert [r["code"] for r in results][0::2] == [0, 0]
+        assert results[1]["code"] != 0
+        assert results[0]["output"] == "test"
+        assert results[2]["output"] == "ok"
+
+        # the script stops at the first error
+        results = pynetem_daemon.docker_script(cname, commands, True)
+        assert len(results) == 2
+
+        # a killed script is an error, even without a failed command
+        commands = ["echo test", "kill -9 $$", "printf ok"]
+        for stop_on_error in (False, True):
+            with pytest.raises(NetemError):
+                pynetem_daemon.docker_script(cname, commands, stop_on_error)
+    finally:
+        pynetem_daemon.docker_rm(cname)
+
+
+def test_docker_netns_exec(pynetem_daemon):
+    cname = gen_rnd_string(min_size=8, max_size=8)
+    image = "mroy31/pynetem-host:{}".format(__version__)
+    pynetem_daemon.docker_create(cname, cname, image, "no")
+    pynetem_daemon.docker_start(cname)
+
+    try:
+        # network commands are run in the container netns
+        pynetem_daemon.docker_exec(cname, "sysctl -w net.ipv4.ip_forward=1")
+        pynetem_daemon.docker_exec(cname, "ip link set lo down")
+        results = pynetem_daemon.docker_script(cname, [
+            "cat /proc/sys/net/ipv4/ip_forward",
+            "ip -o link show lo",
+        ], True)
+        assert results[0]["output"] == "1"
+        assert "UP" not in results[1]["output"].split(">")[0]
+
+        with pytest.raises(NetemError):
+            pynetem_daemon.docker_exec(cname, "ip link set unknown up")
+        # sysctl keys can not leave /proc/sys/net
+        with pytest.raises(NetemError):
+            pynetem_daemon.docker_exec(
+                cname, "sysctl -w net.//.//.//.tmp.ntm-sysctl=1")
+        assert not os.path.exists("/tmp/ntm-sysctl")
+    finally:
+        pynetem_daemon.docker_rm(cname)
+
+
+def test_link_attach(pynetem_daemon, iproute):
+    cname = gen_rnd_string(min_size=8, max_size=8)
+    image = "mroy31/pynetem-host:{}".format(__version__)
+    pynetem_daemon.docker_create(cname, cname, image, "no")
+    pynetem_daemon.docker_start(cname)
+    if1 = gen_rnd_string(min_size=6, max_size=6)
+    if2 = gen_rnd_string(min_size=6, max_size=6)
+
+    try:
+        pid = pynetem_daemon.docker_pid(cname)
+        pynetem_daemon.link_create(if1, if2)
+        pynetem_daemon.link_attach(if2, pid, "eth5")
+        assert not iproute.is_if_exists(if2)
+
+        results = pynetem_daemon.docker_script(cname, [
+            "ip -o link show eth5",
+            "ethtool -k eth5",
+        ], True)
+        assert "UP" in results[0]["output"].split(">")[0]
+        assert "tx-checksumming: off" in results[1]["output"]
+    finally:
+        pynetem_daemon.link_delete(if1)
+        pynetem_daemon.docker_rm(cname)
+
+
+def test_veth_pool(pynetem_daemon, iproute):
+    from pynetem.ui.config import NetemConfig
+    from pynetem.daemon.netlink import VethPool
+
+    def wait_pool(size):
+        for _ in range(50):
+            pool = iproute.get_if_indexes(VethPool.PREFIX)
+            if len(pool) == size:
+                return pool
+            time.sleep(0.2)
+        return pool
+
+    pool_size = 2 * NetemConfig.instance().getint("daemon", "veth_pool")
+    assert pool_size > 0
+    pool = wait_pool(pool_size)
+    assert len(pool) == pool_size
+
+    # links are created by renaming pairs of the pool
+    links = [gen_rnd_string(min_size=6, max_size=6) for _ in range(4)]
+    try:
+        for idx in range(0, len(links), 2):
+            pynetem_daemon.link_create(links[idx], links[idx+1])
+        for link in links:
+            assert iproute.is_if_exists(link)
+            assert iproute.get_if(link)['index'] in pool.values()
+        left = iproute.get_if_indexes(VethPool.PREFIX)
+        assert len(set(pool.values()) & set(left.values())) \
+            == pool_size - len(links)
+
+        # the pool is refilled in the background
+        assert len(wait_pool(pool_size)) == pool_size
+    finally:
+        for idx in range(0, len(links), 2):
+            pynetem_daemon.link_delete(links[idx])
+
+
+def test_jobs(pynetem_daemon):
+    job = pynetem_daemon.submit("version")
+    assert job.wait(timeout=5) == __version__
+
+    # progress events are received before the result of the job
+    progress = []
+    prefix = gen_rnd_string(min_size=5, max_size=5)
+    job = pynetem_daemon.submit(
+        "clean", prefix, on_progress=lambda j, msg: progress.append(msg))
+    assert "0 containers removed" in job.wait(timeout=30)
+    assert len(progress) == 2
+
+    job = pynetem_daemon.submit("chown", "\"/unknown/path\"", "0", "0")
+    with pytest.raises(NetemError):
+        job.wait(timeout=5)
+    with pytest.raises(NetemError):
+        pynetem_daemon.job_cancel("100000")
+
+
+def test_job_cancel(pynetem_daemon, monkeypatch):
+    import pynetem.daemon.server
+    started, release = threading.Event(), threading.Event()
+    report_progress = pynetem.daemon.server.report_progress
+
+    def blocking_progress(content):
+        report_progress(content)
+        started.set()
+        release.wait(10)
+    monkeypatch.setattr(
+        pynetem.daemon.server, "report_progress", blocking_progress)
+
+    # clean holds the exclusive lock while it is cancelled
+    prefix = gen_rnd_string(min_size=5, max_size=5)
+    job = pynetem_daemon.submit("clean", prefix)
+    try:
+        assert started.wait(10)
+        job.cancel()
+        assert not job.is_done()
+        assert "job_cancel" in pynetem_daemon.stats("show")["commands"]
+    finally:
+        release.set()
+    with pytest.raises(NetemError, match="cancelled"):
+        job.wait(timeout=10)
+
+
+def test_apply(pynetem_daemon, iproute):
+    from pynetem.daemon.ovsdb import OVSDBClient
+    ovsdb = OVSDBClient.instance()
+    prefix = gen_rnd_string(min_size=4, max_size=4)
+    sw_name, br_name = "%s.sw" % prefix, "%s.br" % prefix
+    if1, if2 = "%s.if1" % prefix, "%s.if2" % prefix
+    if3, if4 = "%s.if3" % prefix, "%s.if4" % prefix
+
+    state = {
+        "switches": {sw_name: {if1: "12"}},
+        "bridges": {br_name: [if3]},
+        "links": [[if1, if2], [if3, if4]],
+        "netns": [],
+    }
+    changes = pynetem_daemon.apply(prefix, state)
+    assert changes["switches_added"] == 1
+    assert changes["links_added"] == 2
+    assert ovsdb.bridge_exists(sw_name)
+    rows = ovsdb.select("Port", [["name", "==", if1]], ["tag"])
+    assert rows[0]["tag"] == 12
+    assert iproute.get_if(if3).get_attr("IFLA_MASTER") == \
+        iproute.get_if(br_name)["index"]
+
+    # only the differences are applied
+    state["switches"][sw_name][if1] = "13"
+    changes = pynetem_daemon.apply(prefix, state)
+    assert changes["tags_updated"] == 1
+    assert changes["links_added"] == 0
+
+    # vlan 0 is a tag, not the absence of tag
+    state["switches"][sw_name][if1] = "0"
+    changes = pynetem_daemon.apply(prefix, state)
+    assert changes["tags_updated"] == 1
+    rows = ovsdb.select("Port", [["name", "==", if1]], ["tag"])
+    assert rows[0]["tag"] == 0
+
+    # objects of other projects are refused
+    other = "ntm%s" % gen_rnd_string(min_size=2, max_size=2)
+    for key, value in (
+            ("links", [[if1, if2], [if3, "%s.if" % other]]),
+            ("bridges", {br_name: [if3, "%s.if" % other]}),
+            ("netns", ["%s.ns" % other])):
+        with pytest.raises(NetemError):
+            pynetem_daemon.apply(prefix, dict(state, **{key: value}))
+
+    # an empty state removes all the objects of the project
+    changes = pynetem_daemon.apply(prefix, {})
+    assert changes["switches_removed"] == 1
+    assert changes["bridges_removed"] == 1
+    assert not ovsdb.bridge_exists(sw_name)
+    for if_name in (if1, if2, if3, if4, br_name):
+        assert not iproute.is_if_exists(if_name)
@@ -16,6 +16,8 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import os
+import shutil
+import zipfile
 import docker
 from tests.conftest import NETID
 
@@ -51,6 +53,25 @@ def test_status(pynetem_server, server_rpc_cmd):
     check_status(running=True)
 
 
+def test_load_progress(pynetem_server, server_rpc_cmd):
+    pynetem_server(get_project("simple.pnet"))
+
+    signals = []
+    answer = server_rpc_cmd(
+        "load", on_signal=lambda sig: signals.append(sig["attrs"]))
+    assert answer["state"] == "OK"
+
+    progress = [s for s in signals if s["state"] == "progress"]
+    assert len(progress) > 0
+    assert [s["done"] for s in progress] == list(range(1, len(progress)+1))
+    assert all([s["node_state"] == "loaded" for s in progress])
+    assert progress[-1]["total"] == len(progress)
+    # the node step is still signaled as a whole
+    states = [s["state"] for s in signals if s["type"] == "node"]
+    assert states[0] == "loading"
+    assert states[-1] == "loaded"
+
+
 def test_valid_check(pynetem_server, server_rpc_cmd):
     pynetem_server(get_project("simple.pnet"))
 
@@ -103,3 +124,133 @@ def test_topo_file(pynetem_server, server_rpc_cmd):
     answer = server_rpc_cmd("topologyFile")
     assert answer["state"] == "OK"
     assert os.path.isfile(answer["content"])
+
+
+def test_reload(pynetem_server, server_rpc_cmd):
+    pynetem_server(get_project("simple.pnet"))
+    server_rpc_cmd("load")
+
+    answer = server_rpc_cmd("reload")
+    assert answer["state"] == "OK"
+
+    # nodes have been cleaned and started again
+    client = docker.from_env()
+    container = client.containers.get("{}.R1".format(NETID))
+    assert container.status == "running"
+    answer = server_rpc_cmd("status")
+    assert all([n["isRunning"] for n in answer["content"]["nodes"]])
+
+
+def test_update(pynetem_server, server_rpc_cmd):
+    pynetem_server(get_project("simple.pnet"))
+    server_rpc_cmd("load")
+
+    client = docker.from_env()
+    r1 = client.containers.get("{}.R1".format(NETID))
+
+    # add a node to the topology
+    topo_file = server_rpc_cmd("topologyFile")["content"]
+    with open(topo_file) as hdl:
+        content = hdl.read()
+    content = content.replace("[switches]", "[[host2]]\n"
+                              "type = docker.host\n"
+                              "if_numbers = 1\n"
+                              "if0 = __null__\n\n"
+                              "[switches]")
+    with open(topo_file, "w") as hdl:
+        hdl.write(content)
+
+    answer = server_rpc_cmd("update")
+    assert answer["state"] == "OK"
+
+    container = client.containers.get("{}.host2".format(NETID))
+    assert container.status == "running"
+    # untouched nodes have not been restarted
+    container = client.containers.get("{}.R1".format(NETID))
+    assert container.id == r1.id
+    assert container.attrs["State"]["StartedAt"] == \
+        r1.attrs["State"]["StartedAt"]
+
+
+def test_check_cache(pynetem_server, server_rpc_cmd):
+    pynetem_server(get_project("simple.pnet"))
+    assert server_rpc_cmd("check")["state"] == "OK"
+    assert server_rpc_cmd("check")["state"] == "OK"
+
+    # the cache is indexed by the content of the file
+    topo_file = server_rpc_cmd("topologyFile")["content"]
+    with open(topo_file) as hdl:
+        content = hdl.read()
+    with open(topo_file, "w") as hdl:
+        hdl.write(content.replace("if0 = R1.0", "if0 = R2.0"))
+    assert server_rpc_cmd("check")["state"] == "error"
+
+    with open(topo_file, "w") as hdl:
+        hdl.write(content)
+    assert server_rpc_cmd("check")["state"] == "OK"
+
+
+def test_check_peer_interface(pynetem_server, server_rpc_cmd):
+    pynetem_server(get_project("simple.pnet"))
+
+    # the peer interface exists but is over if_numbers of the peer
+    topo_file = server_rpc_cmd("topologyFile")["content"]
+    with open(topo_file) as hdl:
+        content = hdl.read()
+    content = content.replace("if0 = R1.0", "if0 = R1.1")
+    content = content.replace("if0 = host.0", "if0 = __null__\n"
+                              "if1 = host.0")
+    with open(topo_file, "w") as hdl:
+        hdl.write(content)
+    answer = server_rpc_cmd("check")
+    assert answer["state"] == "error"
+    assert "peer node R1 has only 1 interfaces" in answer["content"]
+
+
+def test_lazy_mode(pynetem_server, server_rpc_cmd):
+    pynetem_server(get_project("simple.pnet"))
+
+    topo_file = server_rpc_cmd("topologyFile")["content"]
+    with open(topo_file) as hdl:
+        content = hdl.read()
+    with open(topo_file, "w") as hdl:
+        hdl.write(content.replace("[config]", "[config]\nlazy = yes"))
+
+    answer = server_rpc_cmd("load")
+    assert answer["state"] == "OK"
+    # containers are created but not started
+    client = docker.from_env()
+    container = client.containers.get("{}.R1".format(NETID))
+    assert container.status == "created"
+
+    # the node starts on its first use
+    answer = server_rpc_cmd("start", args=["R1"])
+    assert answer["state"] == "OK"
+    container.reload()
+    assert container.status == "running"
+    container = client.containers.get("{}.host".format(NETID))
+    assert container.status == "created"
+
+
+def test_save_unloaded(pynetem_server, server_rpc_cmd, tmp_path):
+    prj_path = str(tmp_path / "simple.pnet")
+    shutil.copy(get_project("simple.pnet"), prj_path)
+    pynetem_server(prj_path)
+
+    # a project can be saved before its topology is loaded
+    answer = server_rpc_cmd("save")
+    assert answer["state"] == "OK"
+    with zipfile.ZipFile(prj_path) as prj_zip:
+        assert "network.ini" in prj_zip.namelist()
+
+
+def test_save_config(pynetem_server, server_rpc_cmd, tmp_path):
+    pynetem_server(get_project("simple.pnet"))
+    server_rpc_cmd("load")
+
+    # configuration of all the nodes is saved in the target folder
+    answer = server_rpc_cmd("config", args=[str(tmp_path)])
+    assert answer["state"] == "OK"
+    saved = os.listdir(str(tmp_path))
+    assert "R1.frr.conf" in saved
+    assert "host.net.conf" in saved